@@ -0,0 +1,242 @@
+'''
+  Sharded counter that can be decremented but never drops below zero. Every
+  shard holds a non-negative part of the total (its budget). A decrement only
+  takes from a shard holding enough budget, in a single-shard transaction, so
+  decrements of different shards never conflict. Only when no single shard has
+  enough budget left are several shards drained in one cross-group
+  transaction. rebalance (run from cron) spreads the total evenly over all
+  shards again.
+'''
+import random
+from google.appengine.ext import ndb
+from google.appengine.api import datastore_errors
+from IncrementOnlyCounter import IncrementOnlyCounter
+from IncrementOnlyCounter import IncrementOnlyShard
+from IncrementOnlyCounter import MAX_ENTITIES_PER_TRANSACTION
+import CounterMetrics as metrics
+
+BOUNDED_SHARD_KEY_TEMPLATE = '{1}-{0}-bounded_shard'
+DECREMENT_ATTEMPTS = 3
+# Transactions spanning several shards also read or write the counter
+MAX_SHARDS_PER_TRANSACTION = MAX_ENTITIES_PER_TRANSACTION - 1
+
+class BoundedCounter(IncrementOnlyCounter):
+
+  def _format_shard_key(self, index):
+    return BOUNDED_SHARD_KEY_TEMPLATE.format(self.key.id(), index)
+
+  @classmethod
+  def get(cls, name, eventual=False):
+    '''
+      Returns the counter value, None if no counter is found or it is being
+      deleted. Bounded counters are not cached as their value is usually
+      checked before decrementing.
+    '''
+    options = {}
+    if eventual:
+      options['read_policy'] = ndb.EVENTUAL_CONSISTENCY
+    counter = ndb.Key(cls, name).get(**options)
+    if counter is None or counter.state == cls.DELETING:
+      return None
+    return counter.count_async(eventual).get_result()
+
+  @classmethod
+  def increment(cls, name, delta=1, idempotency=False, retry_policy=None,
+                idempotency_key=None):
+    '''
+      Adds budget to a random shard, see IncrementOnlyCounter.increment
+      Raises: ValueError if delta is negative, use decrement instead
+    '''
+    if delta < 0:
+      raise ValueError('Use decrement to lower a bounded counter')
+    return super(BoundedCounter, cls).increment(
+        name, delta, idempotency=idempotency, retry_policy=retry_policy,
+        idempotency_key=idempotency_key)
+
+  @classmethod
+  def increment_batch_async(cls, name, entries):
+    '''
+      See IncrementOnlyCounter.increment_batch_async
+      Raises: ValueError if a delta is negative, use decrement instead
+    '''
+    if any(delta < 0 for _, delta in entries):
+      raise ValueError('Use decrement to lower a bounded counter')
+    return super(BoundedCounter, cls).increment_batch_async(name, entries)
+
+  @classmethod
+  def set_multi(cls, values, wait=True):
+    '''
+      See IncrementOnlyCounter.set_multi, also used by set and reset
+      Raises: ValueError if a value is negative
+    '''
+    if any(value < 0 for value in values.itervalues()):
+      raise ValueError('A bounded counter cannot be set below zero')
+    return super(BoundedCounter, cls).set_multi(values, wait)
+
+  @classmethod
+  def _writable(cls, name):
+    '''
+      Reads the counter inside a decrement transaction, so that it conflicts
+      with a concurrent minify, reset or delete
+      Returns: True if the counter exists and is READ_WRITE
+    '''
+    counter = ndb.Key(cls, name).get()
+    return counter is not None and counter.state == cls.READ_WRITE
+
+  @classmethod
+  @ndb.transactional(xg=True)
+  def _decrement_shard(cls, name, shard_key, delta):
+    '''
+      Takes delta from a single shard if its budget allows
+      Returns: True if the shard was decremented
+    '''
+    if not cls._writable(name):
+      return False
+    shard = shard_key.get()
+    if shard is None or shard.count < delta:
+      return False
+    shard.count -= delta
+    shard.put()
+    return True
+
+  @classmethod
+  @ndb.transactional(xg=True)
+  def _decrement_spread(cls, name, shard_keys, delta):
+    '''
+      Takes delta from several shards, largest budgets first
+      Returns: True if the shards held enough budget
+    '''
+    if not cls._writable(name):
+      return False
+    shards = [shard for shard in ndb.get_multi(shard_keys)
+              if shard is not None]
+    if sum(shard.count for shard in shards) < delta:
+      return False
+    changed = []
+    for shard in sorted(shards, key=lambda shard: -shard.count):
+      if delta == 0:
+        break
+      taken = min(delta, shard.count)
+      shard.count -= taken
+      delta -= taken
+      changed.append(shard)
+    ndb.put_multi(changed)
+    return True
+
+  @classmethod
+  @metrics.timed('bounded.decrement')
+  def decrement(cls, name, delta=1, attempts=DECREMENT_ATTEMPTS):
+    '''
+      Lowers the counter by delta unless that would make it negative. Up to
+      attempts random shards are tried on their own first; if none of them
+      has enough budget, the richest shards are drained together.
+      Args:
+        name : Name of the counter
+        delta : Quantity to be subtracted (positive)
+        attempts : Number of single shards to try
+      Returns: True if the counter was decremented, False if its value is
+               lower than delta, no counter is found, it is not READ_WRITE
+               (being minified, reset or deleted) or the budget is spread over
+               more than MAX_SHARDS_PER_TRANSACTION shards
+      Raises: TransactionFailedError if every attempt conflicted
+    '''
+    if delta < 0:
+      raise ValueError('Use increment to raise a bounded counter')
+    counter = ndb.Key(cls, name).get()
+    if counter is None or counter.state != cls.READ_WRITE:
+      return False
+    keys = counter._get_existing_shard_keys()
+    random.shuffle(keys)
+    for shard_key in keys[:attempts]:
+      try:
+        if cls._decrement_shard(name, shard_key, delta):
+          return True
+      except datastore_errors.TransactionFailedError:
+        metrics.incr('bounded.decrement.conflict')
+
+    # No single shard could afford it. Drain the richest shards together
+    metrics.incr('bounded.decrement.spread')
+    shards = ndb.get_multi(keys)
+    richest = sorted((shard.count, shard.key) for shard in shards
+                     if shard is not None and shard.count > 0)
+    return cls._decrement_spread(
+        name, [key for _, key in richest[-MAX_SHARDS_PER_TRANSACTION:]], delta)
+
+  @classmethod
+  @ndb.transactional(xg=True)
+  def _rebalance_chunk(cls, name, indexes):
+    '''
+      Spreads the total of the given shards evenly over them
+      Returns: The total, None if no counter is found, False if the counter
+               is not READ_WRITE
+    '''
+    counter = ndb.Key(cls, name).get()
+    if counter is None:
+      return None
+    if counter.state != cls.READ_WRITE:
+      # Shards being merged or reset must not get budget back
+      return False
+    shards = ndb.get_multi([counter._get_shard_key(i) for i in indexes])
+    total = sum(shard.count for shard in shards if shard is not None)
+    share, extra = divmod(total, len(indexes))
+    changed = []
+    created = False
+    for position, (index, shard) in enumerate(zip(indexes, shards)):
+      count = share + (1 if position < extra else 0)
+      if shard is None:
+        if count == 0:
+          continue
+        shard = IncrementOnlyShard(id=counter._format_shard_key(index))
+        created = counter._mark_shard(index) or created
+      if shard.count != count:
+        shard.count = count
+        changed.append(shard)
+    if created:
+      changed.append(counter)
+    ndb.put_multi(changed)
+    return total
+
+  @classmethod
+  @metrics.timed('bounded.rebalance')
+  def rebalance(cls, name):
+    '''
+      Spreads the budget of a counter evenly over its shards. At most
+      MAX_SHARDS_PER_TRANSACTION shards fit into a transaction, so shards are
+      balanced in groups; every group gets an even mix of rich and poor
+      shards, so the groups end up with similar totals too.
+      Returns: None if no counter is found, False if it is not READ_WRITE,
+               True otherwise
+    '''
+    counter = ndb.Key(cls, name).get()
+    if counter is None:
+      return None
+    if counter.state != cls.READ_WRITE:
+      return False
+    indexes = range(counter.num_shards)
+    shards = ndb.get_multi(counter._get_shard_keys())
+    indexes.sort(key=lambda i: shards[i].count if shards[i] else 0)
+    groups = ((len(indexes) + MAX_SHARDS_PER_TRANSACTION - 1) //
+              MAX_SHARDS_PER_TRANSACTION)
+    for group in range(groups):
+      if cls._rebalance_chunk(name, indexes[group::groups]) is False:
+        return False
+    return True
+
+  @classmethod
+  def rebalance_all(cls):
+    '''
+      Rebalances every READ_WRITE bounded counter. Meant to run from cron.
+      Returns: The number of rebalanced counters
+    '''
+    rebalanced = 0
+    for key in cls.query(cls.state == cls.READ_WRITE).fetch(keys_only=True):
+      try:
+        if cls.rebalance(key.id()):
+          rebalanced += 1
+      except datastore_errors.TransactionFailedError:
+        metrics.incr('bounded.rebalance.conflict')
+    return rebalanced
+
+  # Useful Aliases
+  incr = increment
+  decr = decrement
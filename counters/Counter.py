@@ -0,0 +1,296 @@
+'''
+  Counter facade. Application code names a counter and optionally describes it
+  with a CounterPolicy (durability, freshness, expected QPS). The facade picks
+  the counter type, routes every call through CounterRouter and watches the
+  observed write rate:
+
+    * A counter writing faster than HOT_FACTOR x its expected QPS (or hitting a
+      failed transaction) is promoted. Durable counters get more shards,
+      buffered counters are migrated to MemcacheCounter.
+    * rebalance (run from cron) demotes promoted counters whose write rate fell
+      below COOL_FACTOR x their expected QPS.
+'''
+import math
+import time
+from google.appengine.ext import ndb
+from google.appengine.api import memcache
+from google.appengine.api import datastore_errors
+import CounterBackends
+import CounterMetrics as metrics
+from CounterMigration import CounterMigrator
+from CounterMigration import CounterRoute
+from CounterMigration import ROUTE_CACHE_TEMPLATE
+from CounterMigration import CounterRouter
+from IncrementOnlyCounter import IncrementOnlyCounter as IOC
+
+DURABLE = 'durable' # Never loses increments, stays on sharded counters
+BUFFERED = 'buffered' # May be buffered in memcache while it is hot
+LOSSY = 'lossy' # Always a memcache counter
+
+POLICY_CACHE_TEMPLATE = '{0}-counter-policy'
+POLICY_CACHE_SECONDS = 60
+VALUE_CACHE_TEMPLATE = '{0}-counter-value'
+RATE_KEY_TEMPLATE = '{0}-counter-rate-{1}'
+PROMOTE_LOCK_TEMPLATE = '{0}-counter-promote'
+RATE_WINDOW = 10 # seconds
+HOT_FACTOR = 2.0
+COOL_FACTOR = 0.5
+SHARD_WRITES_PER_SECOND = 1.0 # Sustained write rate of one entity group
+MIN_SHARDS = 1
+MAX_SHARDS = 200
+MAX_CREATED_NAMES = 10000
+
+# Counters known to exist, so that increments don't look them up again
+_created = set()
+
+def shards_for_qps(qps):
+  '''
+    Returns the number of shards needed for a given write rate
+  '''
+  shards = int(math.ceil(qps / SHARD_WRITES_PER_SECOND))
+  return max(MIN_SHARDS, min(MAX_SHARDS, shards))
+
+class CounterPolicy(ndb.Model):
+  durability = ndb.StringProperty(default=DURABLE, indexed=False,
+                                  choices=(DURABLE, BUFFERED, LOSSY))
+  freshness = ndb.IntegerProperty(default=0, indexed=False) # seconds
+  expected_qps = ndb.FloatProperty(default=1.0, indexed=False)
+  promoted = ndb.BooleanProperty(default=False)
+
+  def __str__(self):
+    return "(Durability = %s, Freshness = %d, QPS = %.1f, Promoted = %r)" % (
+        self.durability, self.freshness, self.expected_qps, self.promoted)
+
+  def __repr__(self):
+    return self.__str__()
+
+  def base_type(self):
+    if self.durability == LOSSY:
+      return CounterBackends.MEMCACHE
+    return CounterBackends.SHARDED
+
+  def base_shards(self):
+    return shards_for_qps(self.expected_qps)
+
+class Counter(object):
+  '''
+    A named counter. Usage:
+      Counter.configure('page-views', durability=BUFFERED, expected_qps=50)
+      Counter('page-views').increment()
+      Counter('page-views').get()
+  '''
+
+  def __init__(self, name, router=None):
+    self.name = name
+    self.router = router or CounterRouter()
+    self._policy = None
+
+  @classmethod
+  def configure(cls, name, durability=DURABLE, freshness=0, expected_qps=1.0):
+    '''
+      Stores the policy of a counter and creates the underlying counter
+      Returns: The new CounterPolicy
+    '''
+    policy = CounterPolicy(id=name, durability=durability, freshness=freshness,
+                           expected_qps=expected_qps)
+    policy.put()
+    memcache.delete(POLICY_CACHE_TEMPLATE.format(name))
+    if policy.base_type() == CounterBackends.SHARDED:
+      _create_sharded(name, policy)
+    else:
+      _set_route(name, policy.base_type())
+    return policy
+
+  @property
+  def policy(self):
+    '''
+      The policy of this counter. Counters that were never configured use the
+      default (durable) policy.
+    '''
+    if self._policy is None:
+      cache_id = POLICY_CACHE_TEMPLATE.format(self.name)
+      policy = memcache.get(cache_id)
+      if policy is None:
+        policy = ndb.Key(CounterPolicy, self.name).get()
+        if policy is None:
+          policy = CounterPolicy(id=self.name)
+        memcache.add(cache_id, policy, POLICY_CACHE_SECONDS)
+      self._policy = policy
+    return self._policy
+
+  def _record_write(self):
+    '''
+      Counts the write in the current rate window
+      Returns: The number of writes seen in the window so far
+    '''
+    window = int(time.time()) // RATE_WINDOW
+    return memcache.incr(RATE_KEY_TEMPLATE.format(self.name, window),
+                         initial_value=0) or 0
+
+  def write_rate(self):
+    '''
+      Returns the write rate (per second) of the last complete window
+    '''
+    window = int(time.time()) // RATE_WINDOW - 1
+    writes = memcache.get(RATE_KEY_TEMPLATE.format(self.name, window)) or 0
+    return float(writes) / RATE_WINDOW
+
+  def increment(self, delta=1, idempotency_key=None):
+    '''
+      Increments the counter. Durable counters that were never configured
+      are created with the default policy on their first increment.
+    '''
+    policy = self.policy
+    if (self.name not in _created and
+        policy.base_type() == CounterBackends.SHARDED):
+      _create_sharded(self.name, policy)
+    writes = self._record_write()
+    hot = writes > policy.expected_qps * HOT_FACTOR * RATE_WINDOW
+    try:
+      self.router.increment(self.name, delta, idempotency_key=idempotency_key)
+    except datastore_errors.TransactionFailedError:
+      self.promote()
+      raise
+    if hot and not policy.promoted:
+      self.promote()
+
+  def get(self):
+    '''
+      Returns the counter value. Values may be up to policy.freshness seconds
+      old.
+    '''
+    freshness = self.policy.freshness
+    cache_id = VALUE_CACHE_TEMPLATE.format(self.name)
+    if freshness:
+      value = memcache.get(cache_id)
+      if value is not None:
+        return value
+    value = self.router.get(self.name)
+    if freshness:
+      memcache.add(cache_id, value, freshness)
+    return value
+
+  def promote(self):
+    '''
+      Gives a hot counter more write capacity. Only one instance promotes a
+      counter at a time.
+      Returns: True if the counter was promoted
+    '''
+    policy = self.policy
+    if policy.durability == LOSSY:
+      return False
+    if not memcache.add(PROMOTE_LOCK_TEMPLATE.format(self.name), 1,
+                        RATE_WINDOW):
+      return False
+    if policy.durability == BUFFERED:
+      if not CounterMigrator(self.router).start([self.name],
+                                                CounterBackends.MEMCACHE):
+        return False
+    else:
+      _grow_shards(self.name, MAX_SHARDS)
+    metrics.incr('counter.promote')
+    _set_promoted(self.name, True)
+    self._policy = None
+    return True
+
+  def demote(self):
+    '''
+      Gives the write capacity added by promote back
+      Returns: True if the counter was demoted
+    '''
+    policy = self.policy
+    if policy.durability == BUFFERED:
+      # Wait for a running migration (e.g. the promotion) to finish first
+      if not CounterMigrator(self.router).start(
+          [self.name], policy.base_type(), num_shards=policy.base_shards()):
+        return False
+    else:
+      counter = ndb.Key(IOC, self.name).get()
+      while counter is not None and counter.num_shards > policy.base_shards():
+        if not IOC.minify_shards(self.name):
+          break
+        counter = ndb.Key(IOC, self.name).get()
+    metrics.incr('counter.demote')
+    _set_promoted(self.name, False)
+    self._policy = None
+    return True
+
+  @classmethod
+  def rebalance(cls, names=None):
+    '''
+      Demotes promoted counters that cooled down. Meant to run from cron.
+      Args:
+        names : Counters to check. Defaults to all promoted counters
+      Returns: The list of demoted counter names
+    '''
+    if names is None:
+      keys = CounterPolicy.query(CounterPolicy.promoted == True).fetch(
+          keys_only=True)
+      names = [key.id() for key in keys]
+    demoted = []
+    for name in names:
+      counter = cls(name)
+      policy = counter.policy
+      if policy.promoted and (counter.write_rate() <
+                              policy.expected_qps * COOL_FACTOR):
+        if counter.demote():
+          demoted.append(name)
+    return demoted
+
+  # Useful Aliases
+  incr = increment
+  value = count = get
+
+def _create_sharded(name, policy):
+  '''
+    Creates the sharded counter of a policy unless it exists
+  '''
+  shards = policy.base_shards()
+  IOC.get_or_insert(name, num_shards=shards,
+                    max_shards=min(MAX_SHARDS, shards * 4),
+                    shards_tracked=True)
+  if len(_created) >= MAX_CREATED_NAMES:
+    _created.clear()
+  _created.add(name)
+
+@ndb.transactional
+def _set_route(name, counter_type):
+  '''
+    Routes a counter without a route to counter_type
+  '''
+  if ndb.Key(CounterRoute, name).get() is None:
+    CounterRoute(id=name, source=counter_type).put()
+  memcache.delete(ROUTE_CACHE_TEMPLATE.format(name))
+
+@ndb.transactional
+def _set_promoted(name, promoted):
+  policy = ndb.Key(CounterPolicy, name).get() or CounterPolicy(id=name)
+  policy.promoted = promoted
+  policy.put()
+  memcache.delete(POLICY_CACHE_TEMPLATE.format(name))
+
+@ndb.transactional
+def _raise_max_shards(name, max_shards):
+  '''
+    Lets a sharded counter grow up to max_shards
+    Returns: False if no counter is found
+  '''
+  counter = ndb.Key(IOC, name).get()
+  if counter is None:
+    return False
+  if counter.max_shards < max_shards or not counter.dynamic_growth:
+    counter.max_shards = max(counter.max_shards, max_shards)
+    counter.dynamic_growth = True
+    counter.put()
+  return True
+
+def _grow_shards(name, max_shards):
+  '''
+    Raises max_shards of a sharded counter and doubles its shards, see
+    IncrementOnlyCounter.expand_shards (only READ_WRITE counters grow)
+    Returns: True if the counter grew, False if it did not, None if no
+             counter is found
+  '''
+  if not _raise_max_shards(name, max_shards):
+    return None
+  return IOC.expand_shards(name)
@@ -0,0 +1,207 @@
+'''
+  Audit of counter values kept both in memcache and in datastore. Counters are
+  scanned page by page; every page costs one query, one memcache get_multi and
+  (for sharded counters) concurrent batch gets of the shards. The cached and
+  stored values of a page are compared as numpy arrays.
+
+    * MemcacheCounter: memcache holds the live value and datastore a copy that
+      is written every few seconds. Drift means a failed or pending persist,
+      or an evicted (and re-initialized) memcache value.
+    * IncrementOnlyCounter: datastore holds the value and memcache a copy
+      cached for up to 30 seconds.
+
+  With repair set, the stale side is overwritten with the authoritative one.
+'''
+import time
+import numpy
+from google.appengine.ext import ndb
+from google.appengine.api import memcache
+from MemcacheCounter import MemcacheCounter as MC
+from MemcacheCounter import MIDDLE_VALUE
+from IncrementOnlyCounter import IncrementOnlyCounter as IOC
+import CounterMetrics as metrics
+
+PAGE_SIZE = 500
+TOP_DRIFTS = 10
+# Bucket i of a drift histogram counts drifts in [DRIFT_EDGES[i - 1],
+# DRIFT_EDGES[i]). Bucket 0 counts counters without drift.
+DRIFT_EDGES = numpy.array([1, 10, 100, 1000, 10000, 100000, 1000000],
+                          dtype=numpy.int64)
+IOC_CACHE_DURATION = 30
+
+class DriftReport(object):
+  '''
+    Drift statistics of one counter type, accumulated page by page
+  '''
+
+  def __init__(self, counter_type, top=TOP_DRIFTS):
+    self.counter_type = counter_type
+    self.top = top
+    self.scanned = 0
+    self.uncached = 0
+    self.drifted = 0
+    self.negative = 0 # Cached value below the stored one
+    self.repaired = 0
+    self.total_drift = 0
+    self.max_drift = 0
+    self.histogram = numpy.zeros(len(DRIFT_EDGES) + 1, dtype=numpy.int64)
+    self.worst = [] # (drift, name) pairs, largest first
+    self.cursor = None
+    self.done = False
+
+  def add(self, names, cached, stored, present):
+    '''
+      Folds a page into the report
+      Args:
+        names : List of counter names
+        cached : numpy int64 array of cached values (ignored if not present)
+        stored : numpy int64 array of stored values
+        present : boolean numpy array, True if the counter was cached
+      Returns: boolean numpy array, True for the cached counters with drift
+    '''
+    diff = numpy.where(present, cached - stored, 0)
+    drift = numpy.abs(diff)
+    self.scanned += len(names)
+    self.uncached += int(len(names) - numpy.count_nonzero(present))
+    self.drifted += int(numpy.count_nonzero(drift))
+    self.negative += int(numpy.count_nonzero(diff < 0))
+    self.total_drift += int(drift.sum())
+    if len(drift):
+      self.max_drift = max(self.max_drift, int(drift.max()))
+    self.histogram += numpy.bincount(
+        numpy.searchsorted(DRIFT_EDGES, drift[present], side='right'),
+        minlength=len(self.histogram))
+    # Only the largest drifts of the page can enter the top list
+    largest = numpy.argsort(-drift)[:self.top]
+    self.worst = sorted(self.worst + [(int(drift[i]), names[i])
+                                      for i in largest if drift[i]],
+                        reverse=True)[:self.top]
+    return drift > 0
+
+  def summary(self):
+    cached = self.scanned - self.uncached
+    return {
+        'type': self.counter_type,
+        'scanned': self.scanned,
+        'uncached': self.uncached,
+        'drifted': self.drifted,
+        'negative': self.negative,
+        'repaired': self.repaired,
+        'mean_drift': float(self.total_drift) / cached if cached else 0.0,
+        'max_drift': self.max_drift,
+        'histogram': self.histogram.tolist(),
+        'histogram_edges': DRIFT_EDGES.tolist(),
+        'worst': [[name, drift] for drift, name in self.worst],
+        'done': self.done,
+    }
+
+class CounterAudit(object):
+  '''
+    Usage:
+      audit = CounterAudit(repair=True)
+      reports = audit.run(deadline=time.time() + 50)
+    Reports which are not done carry the cursor to resume from.
+  '''
+
+  def __init__(self, page_size=PAGE_SIZE, repair=False, top=TOP_DRIFTS):
+    self.page_size = page_size
+    self.repair = repair
+    self.top = top
+
+  def _audit_memcache_page(self, counters, report):
+    '''
+      memcache is authoritative. Stale datastore copies are rewritten and
+      evicted counters are put back into memcache.
+    '''
+    ids = [counter.key.id() for counter in counters]
+    values = memcache.get_multi(ids)
+    present = numpy.array([counter_id in values for counter_id in ids],
+                          dtype=bool)
+    cached = numpy.array([values.get(counter_id, MIDDLE_VALUE) - MIDDLE_VALUE
+                          for counter_id in ids], dtype=numpy.int64)
+    stored = numpy.array([counter.data for counter in counters],
+                         dtype=numpy.int64)
+    drifted = report.add(ids, cached, stored, present)
+    if not self.repair:
+      return
+    stale = [counter for counter, drift in zip(counters, drifted) if drift]
+    for counter in stale:
+      counter.data = int(values[counter.key.id()]) - MIDDLE_VALUE
+    ndb.put_multi(stale)
+    evicted = dict((counter.key.id(), counter.data + MIDDLE_VALUE)
+                   for counter, cached in zip(counters, present) if not cached)
+    memcache.add_multi(evicted)
+    report.repaired += len(stale) + len(evicted)
+
+  def _audit_sharded_page(self, keys, report):
+    '''
+      The shards are authoritative. Stale cached totals are overwritten.
+    '''
+    names = [key.id() for key in keys]
+    values = memcache.get_multi(names)
+    totals = IOC.get_multi(names)
+    present = numpy.array([name in values for name in names], dtype=bool)
+    cached = numpy.array([values.get(name, 0) for name in names],
+                         dtype=numpy.int64)
+    stored = numpy.array([totals[name] or 0 for name in names],
+                         dtype=numpy.int64)
+    drifted = report.add(names, cached, stored, present)
+    if not self.repair:
+      return
+    stale = dict((name, totals[name] or 0)
+                 for name, drift in zip(names, drifted) if drift)
+    memcache.set_multi(stale, time=IOC_CACHE_DURATION)
+    report.repaired += len(stale)
+
+  def _scan(self, query, audit_page, report, cursor, deadline, keys_only):
+    '''
+      Audits pages until the query is exhausted or the deadline has passed.
+      At least one page is audited per call.
+    '''
+    while True:
+      page, cursor, more = query.fetch_page(
+          self.page_size, start_cursor=cursor, keys_only=keys_only)
+      if page:
+        audit_page(page, report)
+      if not more or cursor is None:
+        report.done = True
+        return report
+      if deadline is not None and time.time() >= deadline:
+        report.cursor = cursor
+        return report
+
+  @metrics.timed('audit.memcache')
+  def audit_memcache(self, cursor=None, deadline=None):
+    '''
+      Audits MemcacheCounters, starting at cursor, until all counters are
+      scanned or the deadline (a timestamp) has passed
+      Returns: A DriftReport
+    '''
+    return self._scan(MC.query(), self._audit_memcache_page,
+                      DriftReport('memcache', self.top), cursor, deadline,
+                      keys_only=False)
+
+  @metrics.timed('audit.sharded')
+  def audit_sharded(self, cursor=None, deadline=None):
+    '''
+      Audits the cached values of IncrementOnlyCounters
+      Returns: A DriftReport
+    '''
+    return self._scan(IOC.query(), self._audit_sharded_page,
+                      DriftReport('sharded', self.top), cursor, deadline,
+                      keys_only=True)
+
+  def run(self, cursors=None, deadline=None):
+    '''
+      Audits both counter types
+      Args:
+        cursors : Dictionary mapping counter types to the cursor to resume
+          from, as found in earlier reports
+        deadline : Timestamp after which no new page is started
+      Returns: A list of DriftReports
+    '''
+    cursors = cursors or {}
+    reports = [self.audit_memcache(cursors.get('memcache'), deadline)]
+    if reports[0].done:
+      reports.append(self.audit_sharded(cursors.get('sharded'), deadline))
+    return reports
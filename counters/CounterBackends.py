@@ -0,0 +1,138 @@
+'''
+  Uniform adapters over the three counter types, so that code routing
+  increments and reads between counter types (migration, facade ...) doesn't
+  need to know the API of each of them.
+'''
+import uuid
+from google.appengine.ext import ndb
+from IncrementOnlyCounter import IncrementOnlyCounter as IOC
+from IncrementOnlyCounter import NOT_FOUND
+from MemcacheCounter import MemcacheCounter as MC
+from DynamicCounter import DynamicCounter as DC
+
+SHARDED = 'sharded'
+MEMCACHE = 'memcache'
+DYNAMIC = 'dynamic'
+
+class IncrementOnlyBackend(object):
+  '''
+    Durable sharded counter. Increments are idempotent.
+  '''
+  type = SHARDED
+
+  def create_multi(self, names, **kwargs):
+    '''
+      Creates the missing counters. Keyword arguments are passed to the
+      IncrementOnlyCounter constructor.
+    '''
+    kwargs.setdefault('shards_tracked', True)
+    counters = ndb.get_multi([ndb.Key(IOC, name) for name in names])
+    ndb.put_multi([IOC(id=name, **kwargs) for name, counter
+                   in zip(names, counters) if counter is None])
+
+  def increment(self, name, delta=1, idempotency_key=None):
+    '''
+      Creates the counter (with the IncrementOnlyCounter defaults) if it does
+      not exist, so that no increment is dropped
+    '''
+    result = IOC.increment(name, delta, idempotency=True,
+                           idempotency_key=idempotency_key)
+    if result is None and ndb.Key(IOC, name).get() is None:
+      IOC.get_or_insert(name, shards_tracked=True)
+      result = IOC.increment(name, delta, idempotency=True,
+                             idempotency_key=idempotency_key)
+    return result
+
+  @ndb.tasklet
+  def _increment_async(self, name, delta):
+    '''
+      Batched increment of a single counter, creating it like increment
+    '''
+    entries = [(str(uuid.uuid4()), delta)]
+    status = yield IOC.increment_batch_async(name, entries)[0]
+    if NOT_FOUND in status.values():
+      yield IOC.get_or_insert_async(name, shards_tracked=True)
+      status = yield IOC.increment_batch_async(name, entries)[0]
+    raise ndb.Return(status)
+
+  def increment_multi_async(self, deltas):
+    '''
+      Returns: A list of futures, one per counter
+    '''
+    return [self._increment_async(name, delta)
+            for name, delta in deltas.iteritems()]
+
+  def increment_multi(self, deltas):
+    for future in self.increment_multi_async(deltas):
+      future.get_result()
+
+  def get_multi(self, names, exact=False):
+    #pylint: disable=unused-argument
+    values = IOC.get_multi(names)
+    return dict((name, value or 0) for name, value in values.iteritems())
+
+class MemcacheBackend(object):
+  '''
+    Fast, lossy counter living in memcache
+  '''
+  type = MEMCACHE
+
+  def create_multi(self, names, **kwargs):
+    pass
+
+  def increment(self, name, delta=1, idempotency_key=None):
+    return MC.increment(name, delta, idempotency_key=idempotency_key)
+
+  def increment_multi(self, deltas):
+    return MC.increment_multi(deltas)
+
+  def increment_multi_async(self, deltas):
+    '''
+      The memcache increments themselves are a single call, issued right away
+    '''
+    self.increment_multi(deltas)
+    return []
+
+  def get_multi(self, names, exact=False):
+    #pylint: disable=unused-argument
+    return MC.get_multi(names)
+
+class DynamicBackend(object):
+  '''
+    Append-only counter. Reads only see minified shards unless exact is set.
+  '''
+  type = DYNAMIC
+
+  def create_multi(self, names, **kwargs):
+    pass
+
+  def increment(self, name, delta=1, idempotency_key=None):
+    return DC.increment(name, delta, idempotency_key=idempotency_key)
+
+  def increment_multi(self, deltas):
+    return DC.increment_multi(deltas)
+
+  def increment_multi_async(self, deltas):
+    return DC.increment_multi_async(deltas)
+
+  def get_multi(self, names, exact=False):
+    if exact:
+      for name in names:
+        DC.minify(name)
+    return DC.get_multi(names)
+
+BACKENDS = {
+    SHARDED: IncrementOnlyBackend(),
+    MEMCACHE: MemcacheBackend(),
+    DYNAMIC: DynamicBackend(),
+}
+
+def get_backend(counter_type):
+  '''
+    Returns the backend of a counter type
+    Raises: ValueError if the type is unknown
+  '''
+  try:
+    return BACKENDS[counter_type]
+  except KeyError:
+    raise ValueError('Unknown counter type %r' % counter_type)
@@ -0,0 +1,145 @@
+'''
+  Request scoped batching of counter calls. Increments are collected and
+  applied with one batched (and, where the counter type allows, asynchronous)
+  call per counter type when the batch is flushed: on the first read, or at
+  the end of the request. Reads queued with prefetch are resolved together
+  with the first read, one get_multi per counter type.
+
+  Usage:
+    with CounterBatch():                    # or CounterBatchMiddleware
+      CounterBatch.add('page-views')        # applied directly without batch
+      CounterBatch.add('signups', counter_type=CounterBackends.DYNAMIC)
+      batch = CounterBatch.current()
+      batch.prefetch(['page-views', 'visits'])
+      batch.get('page-views')               # flushes, then reads both
+'''
+import logging
+import threading
+from google.appengine.api import datastore_errors
+import CounterBackends
+import CounterMetrics as metrics
+
+_local = threading.local()
+
+class CounterBatch(object):
+
+  def __init__(self):
+    self._deltas = {} # counter_type -> {name: delta}
+    self._reads = {} # counter_type -> set of names
+    self._values = {} # (counter_type, name) -> value read by this batch
+    self._previous = None
+
+  @classmethod
+  def current(cls):
+    '''
+      Returns the batch of the current request (thread), None if there is none
+    '''
+    return getattr(_local, 'batch', None)
+
+  @classmethod
+  def add(cls, name, delta=1, counter_type=CounterBackends.SHARDED):
+    '''
+      Increments a counter through the current batch, or right away if no
+      batch is active
+    '''
+    batch = cls.current()
+    if batch is None:
+      return CounterBackends.get_backend(counter_type).increment(name, delta)
+    batch.increment(name, delta, counter_type)
+
+  def begin(self):
+    '''
+      Makes this batch the current one
+    '''
+    self._previous = self.current()
+    _local.batch = self
+    return self
+
+  def end(self, flush=True):
+    '''
+      Restores the previous batch, flushing this one unless flush is False
+      Returns: See flush
+    '''
+    _local.batch = self._previous
+    self._previous = None
+    if not flush:
+      metrics.incr('batch.discarded', self.pending)
+      self._deltas = {}
+      return {}
+    return self.flush()
+
+  def __enter__(self):
+    return self.begin()
+
+  def __exit__(self, exc_type, exc_value, traceback):
+    self.end(flush=exc_type is None)
+
+  @property
+  def pending(self):
+    '''
+      Number of counters with pending increments
+    '''
+    return sum(len(deltas) for deltas in self._deltas.itervalues())
+
+  def increment(self, name, delta=1, counter_type=CounterBackends.SHARDED):
+    CounterBackends.get_backend(counter_type) # Fail early on unknown types
+    deltas = self._deltas.setdefault(counter_type, {})
+    deltas[name] = deltas.get(name, 0) + delta
+    self._values.pop((counter_type, name), None)
+
+  def prefetch(self, names, counter_type=CounterBackends.SHARDED):
+    '''
+      Queues reads, resolved by the next get
+    '''
+    self._reads.setdefault(counter_type, set()).update(
+        name for name in names if (counter_type, name) not in self._values)
+
+  def flush(self):
+    '''
+      Applies the pending increments, all counter types concurrently
+      Returns: A dictionary mapping every counter type whose increments
+               failed to the names of its counters
+    '''
+    deltas, self._deltas = self._deltas, {}
+    if not deltas:
+      return {}
+    futures = []
+    failed = {}
+    for counter_type, type_deltas in deltas.iteritems():
+      backend = CounterBackends.get_backend(counter_type)
+      try:
+        futures += [(counter_type, type_deltas, future) for future
+                    in backend.increment_multi_async(type_deltas)]
+      except datastore_errors.Error:
+        failed[counter_type] = type_deltas.keys()
+    for counter_type, type_deltas, future in futures:
+      try:
+        future.get_result()
+      except datastore_errors.Error:
+        failed[counter_type] = type_deltas.keys()
+    metrics.incr('batch.flush')
+    metrics.incr('batch.increments', sum(len(d) for d in deltas.itervalues()))
+    if failed:
+      metrics.incr('batch.flush.failed')
+      logging.warning('Batched counter increments failed: %r', failed)
+    return failed
+
+  def get(self, name, counter_type=CounterBackends.SHARDED):
+    '''
+      Returns the value of a counter. Pending increments are flushed first and
+      every queued read is resolved along with this one.
+    '''
+    if (counter_type, name) not in self._values:
+      self.prefetch([name], counter_type)
+      self.flush()
+      reads, self._reads = self._reads, {}
+      for read_type, names in reads.iteritems():
+        names = list(names)
+        values = CounterBackends.get_backend(read_type).get_multi(names)
+        for read_name in names:
+          self._values[(read_type, read_name)] = values.get(read_name)
+    return self._values[(counter_type, name)]
+
+  def get_multi(self, names, counter_type=CounterBackends.SHARDED):
+    self.prefetch(names, counter_type)
+    return dict((name, self.get(name, counter_type)) for name in names)
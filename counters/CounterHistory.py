@@ -0,0 +1,168 @@
+'''
+  Counter history. Snapshots of counter values are stored per counter and per
+  day in a single CounterHistoryDay entity. Its blob holds one
+  (slot delta, value delta) pair of varints per snapshot, value deltas being
+  zigzag encoded as counters may go down. A slot is a resolution seconds long
+  part of the day, so a day at the default 5 minute resolution takes at most
+  288 points and usually a few hundred bytes.
+
+  Snapshots are appended without decoding the blob (the entity remembers the
+  last slot and value); range queries only fetch and decode the days they
+  cover.
+'''
+import datetime
+from google.appengine.ext import ndb
+import CounterBackends
+import CounterMetrics as metrics
+
+DAY_KEY_TEMPLATE = '{0}-{1:%Y%m%d}-history'
+RESOLUTION = 300 # seconds
+BATCH_SIZE = 200
+
+def zigzag(value):
+  return value << 1 if value >= 0 else ((-value) << 1) - 1
+
+def unzigzag(value):
+  return value >> 1 if not value & 1 else -((value + 1) >> 1)
+
+def encode_varint(value, out):
+  '''
+    Appends the unsigned varint encoding of value to the bytearray out
+  '''
+  while value > 0x7f:
+    out.append((value & 0x7f) | 0x80)
+    value >>= 7
+  out.append(value)
+
+def decode_varints(data):
+  '''
+    Yields the varints encoded in a byte string
+  '''
+  value = shift = 0
+  for byte in bytearray(data):
+    value |= (byte & 0x7f) << shift
+    if byte & 0x80:
+      shift += 7
+    else:
+      yield value
+      value = shift = 0
+
+class CounterHistoryDay(ndb.Model):
+  resolution = ndb.IntegerProperty(default=RESOLUTION, indexed=False)
+  data = ndb.BlobProperty(default='')
+  points = ndb.IntegerProperty(default=0, indexed=False)
+  # Slot and value of the last point, to append without decoding data
+  last_slot = ndb.IntegerProperty(default=0, indexed=False)
+  last_value = ndb.IntegerProperty(default=0, indexed=False)
+
+  def __str__(self):
+    return "(Points = %d, Bytes = %d)" % (self.points, len(self.data))
+
+  def __repr__(self):
+    return self.__str__()
+
+  def append(self, slot, value):
+    '''
+      Adds a point. Points must be appended in slot order; a point for a slot
+      that already has one is ignored.
+      Returns: True if the point was added
+    '''
+    if self.points and slot <= self.last_slot:
+      return False
+    out = bytearray(self.data)
+    encode_varint(slot - self.last_slot, out)
+    encode_varint(zigzag(value - self.last_value), out)
+    self.data = str(out)
+    self.points += 1
+    self.last_slot = slot
+    self.last_value = value
+    return True
+
+  def decode(self):
+    '''
+      Returns the list of (slot, value) points of the day
+    '''
+    points = []
+    slot = value = 0
+    varints = decode_varints(self.data)
+    for slot_delta in varints:
+      slot += slot_delta
+      value += unzigzag(next(varints))
+      points.append((slot, value))
+    return points
+
+class CounterHistory(object):
+  '''
+    Usage:
+      history = CounterHistory(resolution=300)
+      history.snapshot({'page-views': 10, 'signups': 2})   # e.g. from cron
+      history.query('page-views', start, end)
+  '''
+
+  def __init__(self, resolution=RESOLUTION):
+    self.resolution = resolution
+
+  @classmethod
+  def _day_key(cls, name, day):
+    return ndb.Key(CounterHistoryDay, DAY_KEY_TEMPLATE.format(name, day))
+
+  @metrics.timed('history.snapshot')
+  def snapshot(self, values, timestamp=None):
+    '''
+      Records the values of many counters at timestamp (defaults to now, UTC),
+      with one batch get and one batch put per BATCH_SIZE counters. Recording
+      a slot twice keeps the first value, so a retried snapshot is harmless.
+      Args:
+        values : Dictionary mapping counter names to their current values
+      Returns: The number of points written
+    '''
+    timestamp = timestamp or datetime.datetime.utcnow()
+    day = timestamp.date()
+    seconds = int((timestamp - datetime.datetime.combine(
+        day, datetime.time())).total_seconds())
+    names = values.keys()
+    written = 0
+    for start in range(0, len(names), BATCH_SIZE):
+      batch = names[start:start + BATCH_SIZE]
+      keys = [self._day_key(name, day) for name in batch]
+      days = ndb.get_multi(keys)
+      changed = []
+      for name, key, history in zip(batch, keys, days):
+        if history is None:
+          history = CounterHistoryDay(key=key, resolution=self.resolution)
+        # Days keep the resolution they were started with
+        if history.append(seconds // history.resolution, values[name]):
+          changed.append(history)
+      ndb.put_multi(changed)
+      written += len(changed)
+    return written
+
+  def snapshot_counters(self, names, counter_type=CounterBackends.SHARDED,
+                        timestamp=None):
+    '''
+      Reads counters of the given type with batch reads and records them
+    '''
+    values = CounterBackends.get_backend(counter_type).get_multi(names)
+    return self.snapshot(values, timestamp)
+
+  @classmethod
+  def query(cls, name, start, end):
+    '''
+      Returns the recorded (timestamp, value) points of a counter within
+      [start, end), oldest first. Only the days overlapping the range are
+      fetched and decoded.
+    '''
+    days = [start.date() + datetime.timedelta(days=offset)
+            for offset in range((end.date() - start.date()).days + 1)]
+    points = []
+    for day, history in zip(days, ndb.get_multi(
+        [cls._day_key(name, day) for day in days])):
+      if history is None:
+        continue
+      midnight = datetime.datetime.combine(day, datetime.time())
+      for slot, value in history.decode():
+        timestamp = midnight + datetime.timedelta(
+            seconds=slot * history.resolution)
+        if start <= timestamp < end:
+          points.append((timestamp, value))
+    return points
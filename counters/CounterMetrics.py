@@ -0,0 +1,209 @@
+'''
+  Instrumentation hooks for the counters in this package. Counter operations
+  report latency, RPC counts, cache hits / misses, retries and shard expansion
+  events here. Nothing is recorded until a sink is registered with add_sink, so
+  the hooks cost a single list check when metrics are disabled.
+'''
+import bisect
+import logging
+import socket
+import threading
+import time
+from functools import wraps
+
+STATSD_HOST = '127.0.0.1'
+STATSD_PORT = 8125
+RPC_HOOK_NAME = 'counter_metrics_rpc'
+
+# Upper bounds (in ms) of the latency histogram buckets
+LATENCY_BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000)
+
+_SINKS = []
+
+class InMemorySink(object):
+  '''
+    Keeps counts and latency histograms in process memory. Useful for tests and
+    for the local benchmark harness.
+  '''
+
+  def __init__(self, buckets=LATENCY_BUCKETS):
+    self.buckets = tuple(buckets)
+    self.counts = {}
+    self.histograms = {}
+    self._lock = threading.Lock()
+
+  def incr(self, name, value=1):
+    with self._lock:
+      self.counts[name] = self.counts.get(name, 0) + value
+
+  def timing(self, name, millis):
+    index = bisect.bisect_left(self.buckets, millis)
+    with self._lock:
+      histogram = self.histograms.get(name)
+      if histogram is None:
+        # Last cell holds everything above the largest bucket
+        histogram = self.histograms[name] = [0] * (len(self.buckets) + 1)
+      histogram[index] += 1
+
+  def count(self, name):
+    '''
+      Returns the accumulated value of a counter metric (0 if never recorded)
+    '''
+    return self.counts.get(name, 0)
+
+  def num_timings(self, name):
+    '''
+      Returns the number of latency samples recorded for a metric
+    '''
+    return sum(self.histograms.get(name, ()))
+
+  def percentile(self, name, pct):
+    '''
+      Returns the upper bound of the histogram bucket containing the given
+      percentile of a latency metric. None if no samples exist.
+      Args:
+        name : Name of the latency metric
+        pct : Percentile in the range [0, 100]
+    '''
+    histogram = self.histograms.get(name)
+    if not histogram:
+      return None
+    rank = pct * sum(histogram) / 100.0
+    seen = 0
+    for index, hits in enumerate(histogram):
+      seen += hits
+      if hits and seen >= rank:
+        if index < len(self.buckets):
+          return self.buckets[index]
+        return float('inf')
+    return None
+
+  def snapshot(self):
+    '''
+      Returns a copy of all recorded metrics as plain dictionaries
+    '''
+    with self._lock:
+      return {
+          'counts': dict(self.counts),
+          'histograms': dict((name, list(hist))
+                             for name, hist in self.histograms.iteritems()),
+      }
+
+  def clear(self):
+    with self._lock:
+      self.counts.clear()
+      self.histograms.clear()
+
+class LogSink(object):
+  '''
+    Writes every metric to the python logger. Meant for debugging only.
+  '''
+
+  def __init__(self, logger=None, level=logging.DEBUG):
+    self.logger = logger or logging.getLogger('counters.metrics')
+    self.level = level
+
+  def incr(self, name, value=1):
+    self.logger.log(self.level, '%s += %d', name, value)
+
+  def timing(self, name, millis):
+    self.logger.log(self.level, '%s took %.2f ms', name, millis)
+
+class StatsdSink(object):
+  '''
+    Sends metrics as StatsD UDP datagrams to a local listener. Send errors are
+    ignored, metrics must never break a counter operation.
+  '''
+
+  def __init__(self, host=STATSD_HOST, port=STATSD_PORT, prefix='counters'):
+    self.address = (host, port)
+    self.prefix = prefix
+    self._socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+
+  def _send(self, payload):
+    try:
+      self._socket.sendto(payload, self.address)
+    except socket.error:
+      pass
+
+  def incr(self, name, value=1):
+    self._send('%s.%s:%d|c' % (self.prefix, name, value))
+
+  def timing(self, name, millis):
+    self._send('%s.%s:%.3f|ms' % (self.prefix, name, millis))
+
+def add_sink(sink, rpc_hooks=True):
+  '''
+    Registers a sink. From now on every counter operation reports to it.
+    Args:
+      sink : Object with incr(name, value) and timing(name, millis) methods
+      rpc_hooks : Also count API calls made through the current apiproxy
+  '''
+  if sink not in _SINKS:
+    _SINKS.append(sink)
+  if rpc_hooks:
+    install_rpc_hooks()
+  return sink
+
+def remove_sink(sink):
+  if sink in _SINKS:
+    _SINKS.remove(sink)
+
+def clear_sinks():
+  del _SINKS[:]
+
+def enabled():
+  return bool(_SINKS)
+
+def incr(name, value=1):
+  '''
+    Adds value to the counter metric with the given name
+  '''
+  if not _SINKS:
+    return
+  for sink in _SINKS:
+    sink.incr(name, value)
+
+def timing(name, millis):
+  '''
+    Records a single latency sample (in milliseconds)
+  '''
+  if not _SINKS:
+    return
+  for sink in _SINKS:
+    sink.timing(name, millis)
+
+def timed(name):
+  '''
+    Decorator recording the latency of every call to the decorated function.
+    Calls raising an exception are additionally counted as '<name>.error'.
+  '''
+  def decorator(func):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+      if not _SINKS:
+        return func(*args, **kwargs)
+      start = time.time()
+      try:
+        return func(*args, **kwargs)
+      except Exception:
+        incr(name + '.error')
+        raise
+      finally:
+        timing(name, (time.time() - start) * 1000.0)
+    return wrapper
+  return decorator
+
+def _rpc_hook(service, call, request, response):
+  #pylint: disable=unused-argument
+  if _SINKS:
+    incr('rpc.%s.%s' % (service, call))
+
+def install_rpc_hooks():
+  '''
+    Counts every API call (datastore, memcache, taskqueue ...) as
+    rpc.<service>.<method>. The hook lives on the current apiproxy, so it has to
+    be installed again after a testbed is activated.
+  '''
+  from google.appengine.api import apiproxy_stub_map
+  apiproxy_stub_map.apiproxy.GetPreCallHooks().Append(RPC_HOOK_NAME, _rpc_hook)
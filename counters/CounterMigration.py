@@ -0,0 +1,264 @@
+'''
+  Online migration of counters between counter types. Every migrated counter
+  owns a CounterRoute record telling writers and readers which counter type(s)
+  to use. A migration moves a route through these phases:
+
+    STABLE      writes and reads go to the source type
+    DUAL_WRITE  writes go to source and target, reads to source
+    BACKFILLED  the offset between source and target values is recorded
+    CUTOVER     reads switch to target (+ offset), writes still go to both
+    STABLE      the target becomes the new source, writes stop dual-writing
+
+  Routes are cached in memcache for ROUTE_CACHE_SECONDS. A phase is only left
+  once that long has passed, so every writer has seen it.
+
+  Note: The offset is computed from two reads that are not atomic. Increments
+  in flight during the backfill reads may be counted twice or not at all.
+'''
+import datetime
+from google.appengine.ext import ndb
+from google.appengine.api import memcache
+import CounterBackends
+
+ROUTE_CACHE_TEMPLATE = '{0}-counter-route'
+ROUTE_CACHE_SECONDS = 60
+BATCH_SIZE = 200
+
+class CounterRoute(ndb.Model):
+
+  STABLE = 0
+  DUAL_WRITE = 1
+  BACKFILLED = 2
+  CUTOVER = 3
+
+  source = ndb.StringProperty(indexed=False)
+  target = ndb.StringProperty(indexed=False)
+  phase = ndb.IntegerProperty(default=STABLE)
+  # Added to the raw value of the source / target counter
+  source_offset = ndb.IntegerProperty(default=0, indexed=False)
+  target_offset = ndb.IntegerProperty(default=0, indexed=False)
+  updated = ndb.DateTimeProperty(auto_now=True, indexed=False)
+
+  def __str__(self):
+    return "(Source = %s, Target = %s, Phase = %d)" % (
+        self.source, self.target, self.phase)
+
+  def __repr__(self):
+    return self.__str__()
+
+  def read_type(self):
+    return self.target if self.phase == self.CUTOVER else self.source
+
+  def read_offset(self):
+    if self.phase == self.CUTOVER:
+      return self.target_offset
+    return self.source_offset
+
+  def write_types(self):
+    if self.phase == self.STABLE:
+      return [self.source]
+    return [self.source, self.target]
+
+  def settled(self, settle_seconds):
+    '''
+      Returns True if the route didn't change for settle_seconds, i.e. no
+      instance can still hold an older cached copy
+    '''
+    if self.updated is None:
+      return True
+    age = datetime.datetime.utcnow() - self.updated
+    return age >= datetime.timedelta(seconds=settle_seconds)
+
+  def to_cache(self):
+    return (self.source, self.target, self.phase, self.source_offset,
+            self.target_offset)
+
+  @classmethod
+  def from_cache(cls, name, cached):
+    source, target, phase, source_offset, target_offset = cached
+    return cls(id=name, source=source, target=target, phase=phase,
+               source_offset=source_offset, target_offset=target_offset)
+
+class CounterRouter(object):
+  '''
+    Sends increments and reads of named counters to the counter type(s) given
+    by their routes. Counters without a route use default_type.
+  '''
+
+  def __init__(self, default_type=CounterBackends.SHARDED):
+    self.default_type = default_type
+
+  def get_routes(self, names):
+    '''
+      Fetches the routes of many counters: one memcache call, then one batch
+      get for the uncached ones.
+      Returns: A dictionary mapping names to CounterRoute instances. Counters
+               without a stored route get an unsaved STABLE route
+    '''
+    cache_ids = dict((name, ROUTE_CACHE_TEMPLATE.format(name))
+                     for name in names)
+    cached = memcache.get_multi(cache_ids.values())
+    routes = {}
+    misses = []
+    for name in names:
+      if cache_ids[name] in cached:
+        routes[name] = CounterRoute.from_cache(name, cached[cache_ids[name]])
+      else:
+        misses.append(name)
+    if misses:
+      stored = ndb.get_multi([ndb.Key(CounterRoute, name) for name in misses])
+      for name, route in zip(misses, stored):
+        if route is None:
+          route = CounterRoute(id=name, source=self.default_type)
+        routes[name] = route
+      memcache.add_multi(dict((cache_ids[name], routes[name].to_cache())
+                              for name in misses), time=ROUTE_CACHE_SECONDS)
+    return routes
+
+  def invalidate(self, names):
+    memcache.delete_multi([ROUTE_CACHE_TEMPLATE.format(name) for name in names])
+
+  def increment(self, name, delta=1, idempotency_key=None):
+    route = self.get_routes([name])[name]
+    for counter_type in route.write_types():
+      CounterBackends.get_backend(counter_type).increment(
+          name, delta, idempotency_key=idempotency_key)
+
+  def increment_multi(self, deltas):
+    '''
+      Increments many counters, with one batched call per counter type
+    '''
+    routes = self.get_routes(deltas.keys())
+    by_type = {}
+    for name, delta in deltas.iteritems():
+      for counter_type in routes[name].write_types():
+        by_type.setdefault(counter_type, {})[name] = delta
+    for counter_type, type_deltas in by_type.iteritems():
+      CounterBackends.get_backend(counter_type).increment_multi(type_deltas)
+
+  def get_multi(self, names, routes=None):
+    '''
+      Returns a dictionary mapping every name to the value of its counter
+    '''
+    routes = routes or self.get_routes(names)
+    by_type = {}
+    for name in names:
+      by_type.setdefault(routes[name].read_type(), []).append(name)
+    values = {}
+    for counter_type, type_names in by_type.iteritems():
+      backend = CounterBackends.get_backend(counter_type)
+      for name, value in backend.get_multi(type_names).iteritems():
+        values[name] = value + routes[name].read_offset()
+    return values
+
+  def get(self, name):
+    return self.get_multi([name])[name]
+
+class CounterMigrator(object):
+  '''
+    Moves routes through the migration phases, batch_size counters at a time
+  '''
+
+  def __init__(self, router=None, batch_size=BATCH_SIZE,
+               settle_seconds=ROUTE_CACHE_SECONDS):
+    self.router = router or CounterRouter()
+    self.batch_size = batch_size
+    self.settle_seconds = settle_seconds
+
+  def _batches(self, names):
+    names = list(names)
+    for start in range(0, len(names), self.batch_size):
+      yield names[start:start + self.batch_size]
+
+  def _save(self, routes):
+    if routes:
+      ndb.put_multi(routes)
+      self.router.invalidate([route.key.id() for route in routes])
+
+  def start(self, names, target_type, **create_kwargs):
+    '''
+      Starts migrating the given counters to target_type. Counters which are
+      already being migrated or already use target_type are skipped. Keyword
+      arguments are passed on to the creation of the target counters.
+      Returns: The list of counters whose migration started
+    '''
+    backend = CounterBackends.get_backend(target_type)
+    started = []
+    for batch in self._batches(names):
+      stored = ndb.get_multi([ndb.Key(CounterRoute, name) for name in batch])
+      changed = []
+      for name, route in zip(batch, stored):
+        if route is None:
+          route = CounterRoute(id=name, source=self.router.default_type)
+        if route.phase != CounterRoute.STABLE or route.source == target_type:
+          continue
+        route.target = target_type
+        route.target_offset = 0
+        route.phase = CounterRoute.DUAL_WRITE
+        changed.append(route)
+      backend.create_multi([route.key.id() for route in changed],
+                           **create_kwargs)
+      self._save(changed)
+      started += [route.key.id() for route in changed]
+    return started
+
+  def _advance_batch(self, routes):
+    '''
+      Moves every settled route of a batch one phase forward
+    '''
+    routes = [route for route in routes if route is not None and
+              route.phase != CounterRoute.STABLE and
+              route.settled(self.settle_seconds)]
+    backfill = [route for route in routes
+                if route.phase == CounterRoute.DUAL_WRITE]
+    by_type = {}
+    for route in backfill:
+      by_type.setdefault((route.source, route.target), []).append(route)
+    for (source, target), type_routes in by_type.iteritems():
+      names = [route.key.id() for route in type_routes]
+      target_values = CounterBackends.get_backend(target).get_multi(names)
+      source_values = CounterBackends.get_backend(source).get_multi(
+          names, exact=True)
+      for route in type_routes:
+        name = route.key.id()
+        route.target_offset = (source_values[name] + route.source_offset -
+                               target_values[name])
+        route.phase = CounterRoute.BACKFILLED
+
+    for route in routes:
+      if route in backfill:
+        continue
+      elif route.phase == CounterRoute.BACKFILLED:
+        route.phase = CounterRoute.CUTOVER
+      elif route.phase == CounterRoute.CUTOVER:
+        route.source = route.target
+        route.source_offset = route.target_offset
+        route.target = None
+        route.target_offset = 0
+        route.phase = CounterRoute.STABLE
+    self._save(routes)
+    return len(routes)
+
+  def advance(self, names=None):
+    '''
+      Moves every settled route one phase forward. Meant to be called
+      periodically (e.g. from cron) until pending() is empty.
+      Args:
+        names : Counters to advance. Defaults to all pending migrations
+      Returns: The number of routes that changed phase
+    '''
+    if names is None:
+      names = self.pending()
+    advanced = 0
+    for batch in self._batches(names):
+      advanced += self._advance_batch(
+          ndb.get_multi([ndb.Key(CounterRoute, name) for name in batch]))
+    return advanced
+
+  def pending(self):
+    '''
+      Returns the names of all counters with an unfinished migration
+    '''
+    keys = CounterRoute.query(CounterRoute.phase > CounterRoute.STABLE).fetch(
+        keys_only=True)
+    return [key.id() for key in keys]
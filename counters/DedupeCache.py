@@ -0,0 +1,183 @@
+'''
+  Shared dedupe of idempotent increments. Keys are hashed to 64 bit
+  fingerprints spread over NUM_SHARDS shards. A shard is a single memcache
+  item holding the time it was created and the fingerprints seen within the
+  ttl, updated with compare-and-set. Memcache evicts an item as a whole, so a
+  fingerprint missing from a shard created longer than ttl ago was certainly
+  not seen within the ttl (NEW). A younger shard (evicted, flushed or never
+  written before) can't vouch for missing keys (UNKNOWN).
+
+  claim() resolves UNKNOWN keys with a compact DedupeRecord entity (key only
+  plus its creation time) written in a transaction. NEW keys only get a blind
+  put of their record, so the common path does no datastore read.
+  IncrementOnlyCounter keeps using its own transaction logs instead of
+  DedupeRecord, see IncrementOnlyCounter.increment.
+'''
+import datetime
+import hashlib
+import struct
+import time
+from google.appengine.ext import ndb
+from google.appengine.api import memcache
+import CounterMetrics as metrics
+
+NEW = 'new'
+DUPLICATE = 'duplicate'
+UNKNOWN = 'unknown'
+
+NAMESPACE = 'dedupe'
+SHARD_KEY_TEMPLATE = 'shard-{0}'
+SCOPED_KEY_TEMPLATE = '{0}:{1}:{2}'
+# Shards are read and written whole by every check, so keep them small: at
+# 100 new keys per second a shard holds about 250 fingerprints
+NUM_SHARDS = 256
+TTL = 600 # seconds, longer than clients keep retrying a request
+CAS_ATTEMPTS = 3
+PURGE_BATCH = 500
+
+def scoped_key(kind, name, idempotency_key):
+  '''
+    Idempotency keys are scoped by counter type and name, so the same key
+    may be used for different counters (or for the dual writes of a migration)
+  '''
+  return SCOPED_KEY_TEMPLATE.format(kind, name, idempotency_key)
+
+def fingerprint(key):
+  if isinstance(key, unicode):
+    key = key.encode('utf-8')
+  return struct.unpack('<Q', hashlib.md5(key).digest()[:8])[0]
+
+class DedupeRecord(ndb.Model):
+  created = ndb.DateTimeProperty(auto_now_add=True)
+
+class DedupeCache(object):
+
+  def __init__(self, ttl=TTL, num_shards=NUM_SHARDS, namespace=NAMESPACE):
+    self.ttl = ttl
+    self.num_shards = num_shards
+    self.namespace = namespace
+
+  def _update(self, keys, visit):
+    '''
+      Calls visit(since, seen, fingerprint, now) for every key, where seen
+      maps the fingerprints of its shard to the time they were seen (negated
+      for released keys), and writes the shards back with compare-and-set.
+      Shards that could not be written are deleted: the keys they failed to
+      record then read as UNKNOWN rather than NEW.
+      Returns: A dictionary mapping every key to the result of visit, UNKNOWN
+               for the keys of shards that could not be written
+    '''
+    now = time.time()
+    pending = {}
+    for key in keys:
+      value = fingerprint(key)
+      shard = SHARD_KEY_TEMPLATE.format(value % self.num_shards)
+      pending.setdefault(shard, []).append((key, value))
+    client = memcache.Client()
+    results = {}
+    for dummy in range(CAS_ATTEMPTS):
+      cached = client.get_multi(pending.keys(), for_cas=True,
+                                namespace=self.namespace)
+      updated = {}
+      created = {}
+      for shard, entries in pending.iteritems():
+        since, seen = cached.get(shard, (now, {}))
+        seen = dict((value, stamp) for value, stamp in seen.iteritems()
+                    if abs(stamp) > now - self.ttl)
+        for key, value in entries:
+          results[key] = visit(since, seen, value, now)
+        (updated if shard in cached else created)[shard] = (since, seen)
+      failed = []
+      if updated:
+        failed += client.cas_multi(updated, namespace=self.namespace)
+      if created:
+        failed += client.add_multi(created, namespace=self.namespace)
+      pending = dict((shard, pending[shard]) for shard in failed)
+      if not pending:
+        return results
+      metrics.incr('dedupe.cas_conflict', len(pending))
+    memcache.delete_multi(pending.keys(), namespace=self.namespace)
+    for entries in pending.itervalues():
+      for key, _ in entries:
+        results[key] = UNKNOWN
+    return results
+
+  def _visit_check(self, since, seen, value, now):
+    stamp = seen.get(value)
+    if stamp is not None:
+      # Released keys stay unresolved until they expire
+      return DUPLICATE if stamp > 0 else UNKNOWN
+    seen[value] = now
+    return NEW if since <= now - self.ttl else UNKNOWN
+
+  def check_multi(self, keys):
+    '''
+      Marks every key as seen
+      Returns: A dictionary mapping every key to NEW (certainly not seen
+               within ttl), DUPLICATE (seen within ttl) or UNKNOWN
+    '''
+    status = self._update(keys, self._visit_check)
+    for result in (NEW, DUPLICATE, UNKNOWN):
+      metrics.incr('dedupe.' + result,
+                   sum(1 for value in status.itervalues() if value == result))
+    return status
+
+  def check(self, key):
+    return self.check_multi([key])[key]
+
+  @ndb.transactional
+  def _claim_record(self, key):
+    record_key = ndb.Key(DedupeRecord, key)
+    if record_key.get() is not None:
+      return False
+    DedupeRecord(key=record_key).put()
+    return True
+
+  def claim(self, key):
+    '''
+      Returns: True if the key was not seen within ttl, False for duplicates
+      Raises: TransactionFailedError if an UNKNOWN key could not be resolved
+    '''
+    status = self.check(key)
+    if status == DUPLICATE:
+      return False
+    if status == NEW:
+      # The record is the only trace of the key that survives an eviction of
+      # its shard, after which retries are UNKNOWN and resolved with it. A
+      # blind write, no read
+      DedupeRecord(id=key).put()
+      return True
+    return self._claim_record(key)
+
+  @staticmethod
+  def _visit_release(since, seen, value, now):
+    #pylint: disable=unused-argument
+    seen[value] = -now
+
+  def release(self, key):
+    '''
+      Called when the increment guarded by a key failed, so that a retry is
+      not rejected. The failure may come after the increment was applied, so
+      later checks of the key return UNKNOWN and callers consult their durable
+      record (e.g. IncrementOnlyCounter logs). The DedupeRecord is dropped.
+    '''
+    self._update([key], self._visit_release)
+    ndb.Key(DedupeRecord, key).delete()
+
+  @classmethod
+  def purge(cls, ttl=TTL):
+    '''
+      Deletes the records older than ttl. Meant to run from cron.
+      Returns: The number of deleted records
+    '''
+    before = datetime.datetime.utcnow() - datetime.timedelta(seconds=ttl)
+    deleted = 0
+    while True:
+      keys = DedupeRecord.query(DedupeRecord.created < before).fetch(
+          PURGE_BATCH, keys_only=True)
+      if not keys:
+        return deleted
+      ndb.delete_multi(keys)
+      deleted += len(keys)
+
+DEFAULT_CACHE = DedupeCache()
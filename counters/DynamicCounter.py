@@ -1,10 +1,180 @@
+import logging
+import os
+import threading
+import time
+import uuid
 from google.appengine.ext import ndb
+import CounterMetrics as metrics
+import DedupeCache
 
 COUNTER_KEY_TEMPLATE = '{0}-DynamicCounter'
+BUFFERED_SHARD_KEY_TEMPLATE = '{0}-{1}-{2}'
+FLUSH_INTERVAL = 1.0 # seconds
+MAX_BUFFERED_COUNTERS = 1000
 
 class DynamicShard(ndb.Model):
   value = ndb.IntegerProperty(default=0, indexed=False)
   counter_key = ndb.KeyProperty(kind='DynamicCounter')
+  # Only set for shards written by a DynamicShardBuffer
+  instance_id = ndb.StringProperty(indexed=False)
+  sequence = ndb.IntegerProperty(indexed=False)
+
+class DynamicShardBuffer(object):
+  '''
+    Per-instance buffer of DynamicCounter increments. Deltas are summed per
+    counter and written as one DynamicShard per counter every flush_interval
+    seconds, or as soon as max_counters counters are buffered. So the number
+    of shards grows with instances x time rather than with the event rate.
+
+    Every flush gets a new sequence number. Shards are keyed
+    {counter}-{instance}-{sequence}, thus a flush retried after a failed put
+    overwrites the shards it may already have written instead of adding to
+    them. (A retry after the shards were minified is still counted twice.)
+    Increments with an idempotency key leave a failed flush: their deltas are
+    taken out of the shards to be retried and their keys are released, so
+    the client may send them again.
+
+    Nothing flushes a buffer on a timer: CounterBatchMiddleware reports every
+    request, and the buffer is flushed at the end of a request when it is due
+    or when no other request of the instance is running, so an idle instance
+    keeps nothing buffered.
+  '''
+
+  def __init__(self, flush_interval=FLUSH_INTERVAL,
+               max_counters=MAX_BUFFERED_COUNTERS, instance_id=None):
+    self.flush_interval = flush_interval
+    self.max_counters = max_counters
+    self.instance_id = (instance_id or os.environ.get('INSTANCE_ID') or
+                        uuid.uuid4().hex)
+    self.sequence = 0
+    self.deltas = {}
+    self.keyed = [] # (counter name, value, request id) of idempotent deltas
+    self.pending = [] # Shards of failed flushes, retried on the next flush
+    self.last_flush = time.time()
+    self.active_requests = 0
+    self.lock = threading.Lock()
+
+  def _due(self):
+    return (len(self.deltas) >= self.max_counters or
+            time.time() - self.last_flush >= self.flush_interval)
+
+  def _flush_logged(self):
+    '''
+      Flushes the buffer. A failed flush is logged and its shards stay
+      pending: the caller's own increment is already buffered, so raising
+      would make it retry and count twice.
+    '''
+    try:
+      self.flush()
+    except Exception: #pylint: disable=broad-except
+      logging.exception('Flushing buffered dynamic counter increments failed')
+
+  def add(self, counter_name, value=1, request_id=None):
+    '''
+      Buffers an increment. Flushes the buffer if it is due.
+      Args:
+        request_id : Claimed DedupeCache key of the increment, released if
+                     the flush fails
+    '''
+    with self.lock:
+      self.deltas[counter_name] = self.deltas.get(counter_name, 0) + value
+      if request_id is not None:
+        self.keyed.append((counter_name, value, request_id))
+      due = self._due()
+    if due:
+      self._flush_logged()
+
+  def request_started(self):
+    with self.lock:
+      self.active_requests += 1
+
+  def request_finished(self):
+    '''
+      Flushes the buffer if it is due or this was the last running request
+    '''
+    with self.lock:
+      self.active_requests = max(self.active_requests - 1, 0)
+      due = ((self.deltas or self.pending) and
+             (self.active_requests == 0 or self._due()))
+    if due:
+      self._flush_logged()
+
+  def _take_shards(self):
+    '''
+      Empties the buffer into a list of shards to be written
+      Returns: The shards and a list of (shard, value, request id) tuples,
+               one per idempotent increment of the new shards
+    '''
+    with self.lock:
+      deltas, self.deltas = self.deltas, {}
+      keyed, self.keyed = self.keyed, []
+      self.last_flush = time.time()
+      shards, self.pending = self.pending, []
+      if deltas:
+        self.sequence += 1
+      sequence = self.sequence
+    keyed_names = set(name for name, _, _ in keyed)
+    created = {}
+    for name, value in deltas.iteritems():
+      # Empty shards are only written to be rewritten after a failed flush
+      if value == 0 and name not in keyed_names:
+        continue
+      counter_key = ndb.Key(DynamicCounter, DynamicCounter._format_key(name))
+      created[name] = DynamicShard(
+          id=BUFFERED_SHARD_KEY_TEMPLATE.format(counter_key.id(),
+                                                self.instance_id, sequence),
+          value=value, counter_key=counter_key, instance_id=self.instance_id,
+          sequence=sequence)
+    shards += created.values()
+    return shards, [(created[name], value, request_id)
+                    for name, value, request_id in keyed]
+
+  @staticmethod
+  def _release(keyed):
+    '''
+      Takes the idempotent increments of a failed flush out of its shards and
+      releases their keys. The shards are rewritten under the same ids, so
+      the increments are dropped even if the failed put wrote them.
+    '''
+    for shard, value, _ in keyed:
+      shard.value -= value
+    for _, _, request_id in keyed:
+      try:
+        DedupeCache.DEFAULT_CACHE.release(request_id)
+      except Exception: #pylint: disable=broad-except
+        logging.exception('Releasing idempotency key %s failed', request_id)
+
+  def flush(self):
+    '''
+      Writes the buffered deltas with a single batch put.
+      Returns: The number of shards written
+    '''
+    shards, keyed = self._take_shards()
+    if not shards:
+      return 0
+    try:
+      ndb.put_multi(shards)
+    except Exception:
+      self._release(keyed)
+      with self.lock:
+        self.pending += shards
+      metrics.incr('dc.flush.failed')
+      raise
+    metrics.incr('dc.flush.shards', len(shards))
+    return len(shards)
+
+_BUFFER = None
+_BUFFER_LOCK = threading.Lock()
+
+def get_buffer():
+  '''
+    Returns the DynamicShardBuffer of this instance
+  '''
+  global _BUFFER
+  with _BUFFER_LOCK:
+    if _BUFFER is None:
+      _BUFFER = DynamicShardBuffer()
+    return _BUFFER
 
 class DynamicCounter(ndb.Model):
   count = ndb.IntegerProperty(default=0, indexed=False)
@@ -38,6 +208,19 @@ class DynamicCounter(ndb.Model):
     '''
     return cls._get_counter(counter_name, default=default).count
 
+  @classmethod
+  def get_multi(cls, counter_names, default=0):
+    '''
+      Function to read the minified value of many counters with a single batch
+      get. Missing counters are not created.
+      Returns : A dictionary mapping every name to its value (default if the
+        counter doesn't exist)
+    '''
+    counters = ndb.get_multi([ndb.Key(cls, cls._format_key(name))
+                              for name in counter_names])
+    return dict((name, default if counter is None else counter.count)
+                for name, counter in zip(counter_names, counters))
+
   @classmethod
   @ndb.transactional
   def _add_to_count(cls, counter_name, value=0):
@@ -63,16 +246,73 @@ class DynamicCounter(ndb.Model):
     counter.put()
 
   @classmethod
-  def increment(cls, counter_name, value=1):
+  @metrics.timed('dc.increment')
+  def increment(cls, counter_name, value=1, buffered=False,
+                idempotency_key=None):
     '''
       This function creates a new shard with the increment value. This will be
       counted in the next minify operation
+      Args:
+        buffered : Add the value to the buffer of this instance instead. It is
+                   written with the other buffered increments of the instance
+                   on the next flush, which drops it and releases its
+                   idempotency key if it fails
+        idempotency_key : Client supplied key of the increment. Increments
+                          repeating the key of an earlier one are ignored
+                          (see DedupeCache)
+      Returns: False for ignored duplicates
     '''
+    request_id = None
+    if idempotency_key is not None:
+      request_id = DedupeCache.scoped_key(cls._get_kind(), counter_name,
+                                          idempotency_key)
+      if not DedupeCache.DEFAULT_CACHE.claim(request_id):
+        metrics.incr('dc.increment.duplicate')
+        return False
+    if buffered:
+      get_buffer().add(counter_name, value, request_id)
+      return
     counter_key = ndb.Key(cls, cls._format_key(counter_name))
     shard = DynamicShard(value=value, counter_key=counter_key)
-    shard.put()
+    try:
+      shard.put()
+    except Exception:
+      if request_id is not None:
+        DedupeCache.DEFAULT_CACHE.release(request_id)
+      raise
+
+  @classmethod
+  def increment_multi_async(cls, deltas):
+    '''
+      This function adds one shard per counter, carrying the total delta of
+      that counter. All shards are written with a single batch put.
+      Args:
+        deltas : dictionary mapping counter names to the amount to be added
+      Returns: A list of futures, one per shard
+    '''
+    shards = [DynamicShard(value=value,
+                           counter_key=ndb.Key(cls, cls._format_key(name)))
+              for name, value in deltas.iteritems()]
+    return ndb.put_multi_async(shards)
+
+  @classmethod
+  @metrics.timed('dc.increment_multi')
+  def increment_multi(cls, deltas):
+    '''
+      Synchronous version of increment_multi_async
+    '''
+    for future in cls.increment_multi_async(deltas):
+      future.get_result()
+
+  @classmethod
+  def flush(cls):
+    '''
+      Writes the buffered increments of this instance
+    '''
+    return get_buffer().flush()
 
   @classmethod
+  @metrics.timed('dc.minify')
   def minify(cls, counter_name):
     '''
       This function deletes all the existing shards and adds the value to the
@@ -82,6 +322,7 @@ class DynamicCounter(ndb.Model):
     counter_key = ndb.Key(cls, cls._format_key(counter_name))
     shards = DynamicShard.query(DynamicShard.counter_key == counter_key).fetch()
     print len(shards), "shards found"
+    metrics.incr('dc.minify.shards', len(shards))
     total = 0
     for shard in shards:
       total += shard.value
@@ -126,8 +367,8 @@ class DynamicCounter(ndb.Model):
       return True
 
   @classmethod
-  def decrement(cls, counter_name, value=1):
+  def decrement(cls, counter_name, value=1, buffered=False):
     '''
       Function to decrese the counter by a given value
     '''
-    return cls.increment(counter_name, -value)
+    return cls.increment(counter_name, -value, buffered)
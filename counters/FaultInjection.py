@@ -0,0 +1,169 @@
+'''
+  Fault injection for the datastore and memcache API stubs, to test and
+  benchmark the counters in degraded conditions. Usage:
+
+    injector = FaultInjector(conflict_probability=0.1,
+                             eviction_probability=0.01,
+                             latency=exponential(0.005))
+    with injector.install():
+      ...                      # code under test
+    print injector.stats
+
+  Faults:
+    * conflict_probability : Datastore commits fail with a concurrent
+      transaction error (TransactionFailedError) before they are applied.
+    * lost_commit_probability : Datastore commits are applied, then fail with
+      a concurrent transaction error, like a commit whose response got lost.
+      Callers can't tell these from conflicts and have to retry idempotently.
+    * eviction_probability : Memcache reads and increments first evict the
+      keys they touch.
+    * error_probability : Datastore calls fail with a timeout
+      (datastore_errors.Timeout), memcache calls with a service error (the
+      memcache API turns those into misses / failed writes).
+    * latency : Function of a random.Random returning the seconds to sleep
+      before every call, or a dictionary mapping service names to such
+      functions.
+    * consistency : Probability that a datastore query sees the latest
+      writes (PseudoRandomHRConsistencyPolicy).
+
+  The stubs must be registered (e.g. by a testbed) before install is called.
+'''
+import random
+import threading
+import time
+from google.appengine.api import apiproxy_stub_map
+from google.appengine.api.memcache import memcache_service_pb
+from google.appengine.datastore import datastore_pb
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.runtime import apiproxy_errors
+
+DATASTORE = 'datastore_v3'
+MEMCACHE = 'memcache'
+# Memcache calls that may evict their keys
+EVICTING_CALLS = ('Get', 'Increment', 'BatchIncrement')
+# Calls that never fail, so that failed transactions can be cleaned up
+SAFE_CALLS = ('Rollback',)
+
+def constant(seconds):
+  return lambda rng: seconds
+
+def uniform(low, high):
+  return lambda rng: rng.uniform(low, high)
+
+def exponential(mean):
+  return lambda rng: rng.expovariate(1.0 / mean) if mean else 0.0
+
+class FaultInjector(object):
+
+  def __init__(self, conflict_probability=0.0, eviction_probability=0.0,
+               error_probability=0.0, latency=None, consistency=None,
+               seed=None, lost_commit_probability=0.0):
+    self.conflict_probability = conflict_probability
+    self.lost_commit_probability = lost_commit_probability
+    self.eviction_probability = eviction_probability
+    self.error_probability = error_probability
+    self.latency = latency
+    self.consistency = consistency
+    self.rng = random.Random(seed)
+    self.lock = threading.Lock()
+    self.stats = dict.fromkeys(('calls', 'conflicts', 'lost_commits',
+                                'evictions', 'errors', 'delay'), 0)
+    self._originals = {}
+
+  def _random(self):
+    with self.lock:
+      return self.rng.random()
+
+  def _count(self, stat, value=1):
+    with self.lock:
+      self.stats[stat] += value
+
+  def _delay(self, service):
+    latency = self.latency
+    if isinstance(latency, dict):
+      latency = latency.get(service)
+    if latency is None:
+      return
+    with self.lock:
+      seconds = latency(self.rng)
+    if seconds > 0:
+      self._count('delay', seconds)
+      time.sleep(seconds)
+
+  def _evict(self, original, request):
+    if hasattr(request, 'key_list'):
+      keys = request.key_list()
+    elif hasattr(request, 'item_list'):
+      keys = [item.key() for item in request.item_list()]
+    else:
+      keys = [request.key()]
+    delete = memcache_service_pb.MemcacheDeleteRequest()
+    if request.has_name_space():
+      delete.set_name_space(request.name_space())
+    for key in keys:
+      delete.add_item().set_key(key)
+    original(MEMCACHE, 'Delete', delete,
+             memcache_service_pb.MemcacheDeleteResponse())
+    self._count('evictions', len(keys))
+
+  def _call(self, original, service, call, request, response, *args):
+    self._count('calls')
+    self._delay(service)
+    if call not in SAFE_CALLS and self._random() < self.error_probability:
+      self._count('errors')
+      if service == DATASTORE:
+        raise apiproxy_errors.ApplicationError(datastore_pb.Error.TIMEOUT,
+                                               'Injected timeout')
+      raise apiproxy_errors.ApplicationError(
+          memcache_service_pb.MemcacheServiceError.UNSPECIFIED_ERROR,
+          'Injected error')
+    if (service == DATASTORE and call == 'Commit' and
+        self._random() < self.conflict_probability):
+      self._count('conflicts')
+      # Roll the transaction back, as the datastore would
+      original(service, 'Rollback', request, datastore_pb.VoidProto())
+      raise apiproxy_errors.ApplicationError(
+          datastore_pb.Error.CONCURRENT_TRANSACTION, 'Injected conflict')
+    if (service == DATASTORE and call == 'Commit' and
+        self._random() < self.lost_commit_probability):
+      self._count('lost_commits')
+      original(service, call, request, response, *args)
+      raise apiproxy_errors.ApplicationError(
+          datastore_pb.Error.CONCURRENT_TRANSACTION, 'Injected lost commit')
+    if (service == MEMCACHE and call in EVICTING_CALLS and
+        self._random() < self.eviction_probability):
+      self._evict(original, request)
+    return original(service, call, request, response, *args)
+
+  def _wrap(self, original):
+    return lambda service, call, request, response, *args: self._call(
+        original, service, call, request, response, *args)
+
+  def install(self, services=(DATASTORE, MEMCACHE)):
+    '''
+      Wraps the stubs of the given services
+      Returns: self, which uninstalls the wrappers when used as a context
+               manager
+    '''
+    for service in services:
+      stub = apiproxy_stub_map.apiproxy.GetStub(service)
+      if stub is None or service in self._originals:
+        continue
+      self._originals[service] = (stub, stub.MakeSyncCall)
+      stub.MakeSyncCall = self._wrap(stub.MakeSyncCall)
+      if service == DATASTORE and self.consistency is not None:
+        stub.SetConsistencyPolicy(
+            datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+                probability=self.consistency))
+    return self
+
+  def uninstall(self):
+    for stub, original in self._originals.itervalues():
+      stub.MakeSyncCall = original
+    self._originals = {}
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *exc_info):
+    self.uninstall()
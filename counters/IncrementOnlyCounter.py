@@ -1,11 +1,28 @@
+import functools
 import random
+import time
 import uuid
 from google.appengine.ext import ndb
 from google.appengine.api import memcache
 from google.appengine.api import datastore_errors
+import CounterMetrics as metrics
+import DedupeCache
+import RetryPolicy
 
 SHARD_KEY_TEMPLATE = '{1}-{0}-increment_only_shard'
 MAX_ENTITIES_PER_TRANSACTION = 25
+# Batched increments touch the counter, one shard and one log per request
+BATCH_CHUNK_SIZE = MAX_ENTITIES_PER_TRANSACTION - 2
+# Increment logs fetched (keys only) per query page when deleting them
+LOG_PAGE_SIZE = 500
+# Logs deleted per counter by one resume_all run, which has to fit a request
+RESUME_MAX_LOGS = 20 * LOG_PAGE_SIZE
+
+# Status of a single entry of a batched increment
+APPLIED = 'applied'
+DUPLICATE = 'duplicate'
+FAILED = 'failed'
+NOT_FOUND = 'not_found'
 
 class IncrementOnlyShard(ndb.Model):
   count = ndb.IntegerProperty(default=0, indexed=False)
@@ -13,16 +30,81 @@ class IncrementOnlyShard(ndb.Model):
 class ShardIncrementTransaction(ndb.Model):
   shard_key = ndb.KeyProperty(kind=IncrementOnlyShard)
 
+class UnrecordedShard(Exception):
+  '''
+    Raised by an increment transaction that picked a shard which was neither
+    created nor recorded in the bitmap yet. Every increment reads the counter,
+    so the shard is recorded in a transaction of its own before the increment
+    is retried on it, see IncrementOnlyCounter._with_recorded_shard
+  '''
+
+  def __init__(self, index):
+    super(UnrecordedShard, self).__init__(index)
+    self.index = index
+
 def validate_counter(prop, value):
   if value < 1:
     raise datastore_errors.BadValueError(
         prop.__class__.__name__ + ' should be >= 1')
 
+def delete_chunks_async(keys):
+  '''
+    Deletes keys in batches of MAX_ENTITIES_PER_TRANSACTION, all batches
+    concurrently
+    Returns: A list of futures
+  '''
+  futures = []
+  for start in range(0, len(keys), MAX_ENTITIES_PER_TRANSACTION):
+    futures.extend(ndb.delete_multi_async(
+        keys[start:start + MAX_ENTITIES_PER_TRANSACTION]))
+  return futures
+
+@ndb.tasklet
+def delete_logs_async(shard_key, limit=None):
+  '''
+    Deletes the increment logs of a shard, one page of keys at a time
+    Args:
+      limit : Stop after deleting this many logs
+    Returns: A future resolving to (number of deleted logs, True if no logs
+             are left)
+  '''
+  query = ShardIncrementTransaction.query(
+      ShardIncrementTransaction.shard_key == shard_key)
+  deleted = 0
+  cursor = None
+  more = True
+  while more:
+    page_size = LOG_PAGE_SIZE
+    if limit is not None:
+      page_size = min(page_size, limit - deleted)
+      if page_size <= 0:
+        raise ndb.Return((deleted, False))
+    keys, cursor, more = yield query.fetch_page_async(
+        page_size, start_cursor=cursor, keys_only=True)
+    yield delete_chunks_async(keys)
+    deleted += len(keys)
+  raise ndb.Return((deleted, True))
+
 class IncrementOnlyCounter(ndb.Model):
+  '''
+    States:
+      READ_WRITE : Increments go to any of the num_shards shards
+      MINIFYING : The shards from writable_shards on are being merged into
+                  shard writable_shards, increments only go to the shards
+                  below it
+      RESET : The shards from writable_shards on are being zeroed, they are
+              neither read nor written until they are
+      DELETING : The counter is being deleted and reads as missing. The logs
+                 of the shards below writable_shards are already deleted
+    Every increment transaction reads the counter, so a state change makes
+    the increments racing with it retry with the new state, and the merge /
+    reset steps never touch a shard an increment may be writing to.
+  '''
 
   READ_WRITE = 0
   MINIFYING = 1
   RESET = 2
+  DELETING = 3
 
   num_shards = ndb.IntegerProperty(
       default=10,
@@ -36,6 +118,14 @@ class IncrementOnlyCounter(ndb.Model):
       verbose_name='Maximum Number of Shards')
   dynamic_growth = ndb.BooleanProperty(default=True, indexed=False)
   state = ndb.IntegerProperty(default=READ_WRITE)
+  # Number of shards accepting increments while MINIFYING or RESET
+  writable_shards = ndb.IntegerProperty(default=0, indexed=False)
+  # Bit i is set before the shard at index i is first written. Only trusted by
+  # the read path when shards_tracked is set, i.e. the counter was created with
+  # the bitmap or all its older shards were recorded by track_shards. Code
+  # creating a counter that does not exist yet passes shards_tracked=True
+  shard_bitmap = ndb.BlobProperty(default='')
+  shards_tracked = ndb.BooleanProperty(default=False, indexed=False)
 
   def __str__(self):
     return "(Num = %d, Max = %d, Dynamic = %r)" % (
@@ -76,6 +166,68 @@ class IncrementOnlyCounter(ndb.Model):
       end = self.num_shards
     return [self._get_shard_key(index) for index in range(start, end)]
 
+  def _get_writable_shards(self):
+    '''
+      Returns the number of shards (starting at index 0) increments may go to
+    '''
+    if self.state == self.READ_WRITE:
+      return self.num_shards
+    # A 2 shard counter is merged into shard 0, which has to stay writable
+    return max(self.writable_shards, 1)
+
+  def _get_readable_shards(self):
+    '''
+      Returns the number of shards (starting at index 0) holding the value
+    '''
+    if self.state == self.RESET:
+      return self.writable_shards
+    return self.num_shards
+
+  def _has_shard(self, index):
+    '''
+      Returns True if the bitmap records the shard at the given index
+    '''
+    byte = index // 8
+    bitmap = self.shard_bitmap or ''
+    return byte < len(bitmap) and bool(ord(bitmap[byte]) & (1 << (index % 8)))
+
+  def _mark_shard(self, index):
+    '''
+      Records the shard at the given index in the bitmap. The caller has to put
+      the counter.
+      Returns: True if the bitmap changed
+    '''
+    if self._has_shard(index):
+      return False
+    bitmap = bytearray(self.shard_bitmap or '')
+    byte = index // 8
+    if byte >= len(bitmap):
+      bitmap.extend([0] * (byte + 1 - len(bitmap)))
+    bitmap[byte] |= 1 << (index % 8)
+    self.shard_bitmap = str(bitmap)
+    return True
+
+  def _get_existing_shard_keys(self):
+    '''
+      Returns the keys of the shards that have to be read to compute the count.
+      That is every created shard if the counter tracks its shards, all
+      num_shards keys otherwise.
+    '''
+    readable = self._get_readable_shards()
+    if not self.shards_tracked:
+      return self._get_shard_keys(0, readable)
+    return [self._get_shard_key(index) for index in range(readable)
+            if self._has_shard(index)]
+
+  def _get_all_shard_keys(self):
+    '''
+      Returns the keys of every shard the counter may have created, including
+      the ones left behind by minify
+    '''
+    end = max(self.num_shards, self.max_shards,
+              len(self.shard_bitmap or '') * 8)
+    return [self._get_shard_key(index) for index in range(end)]
+
   def _get_shards(self, start=0, end=-1):
     '''
       This function returns all the shards associated with this counter within a
@@ -98,12 +250,10 @@ class IncrementOnlyCounter(ndb.Model):
         end : End  index (last index + 1) of the shard range (default to
               num_shards)
     '''
-    shard_keys = self._get_shard_keys(start, end)
-    for shard_key in shard_keys:
-      log_list = ShardIncrementTransaction.query(
-          ShardIncrementTransaction.shard_key == shard_key).fetch()
-      for log in log_list:
-        log.key.delete()
+    futures = [delete_logs_async(shard_key)
+               for shard_key in self._get_shard_keys(start, end)]
+    for future in futures:
+      future.get_result()
 
   def get_all_tx_logs(self, start=0, end=-1):
     '''
@@ -122,29 +272,136 @@ class IncrementOnlyCounter(ndb.Model):
           ShardIncrementTransaction.shard_key == shard_key).fetch()
     return log_list
 
+  @ndb.tasklet
+  def count_async(self, eventual=False):
+    '''
+      Sums up the values of all created shards. Shards that were never created
+      are not read at all (see shard_bitmap). The reads are issued as a single
+      parallel batch.
+      Args:
+        eventual : Use eventually consistent reads, which never wait for
+                   pending writes on the shards
+      Returns: A future resolving to the counter value
+    '''
+    options = {}
+    if eventual:
+      options['read_policy'] = ndb.EVENTUAL_CONSISTENCY
+    shard_list = yield ndb.get_multi_async(self._get_existing_shard_keys(),
+                                           **options)
+    raise ndb.Return(sum(shard.count for shard in shard_list
+                         if shard is not None))
+
   @property
   def count(self):
     '''
       Retrieve the current counter value. Sums up values of all shards.
     '''
-    shard_list = self._get_shards()
-    count = 0
-    for shard in shard_list:
-      if shard is not None:
-        count += shard.count
-    return count
+    return self.count_async().get_result()
+
+  @classmethod
+  @ndb.transactional_async
+  def _record_shards_async(cls, name, indexes, track=False):
+    '''
+      Records shards in the bitmap
+      Args:
+        track : Also trust the bitmap from now on, see shards_tracked
+      Returns: A future resolving to None if no counter is found, True
+               otherwise
+    '''
+    counter = ndb.Key(cls, name).get()
+    if counter is None:
+      return None
+    changed = False
+    for index in indexes:
+      changed = counter._mark_shard(index) or changed
+    if track and not counter.shards_tracked:
+      counter.shards_tracked = True
+      changed = True
+    if changed:
+      counter.put()
+    return True
+
+  @classmethod
+  def _with_recorded_shard(cls, name, increment):
+    '''
+      Runs increment(index=None), an increment transaction. If it picked a
+      shard that was not recorded yet, the shard is recorded and increment
+      is run again on it. Only the first increment of a shard writes the
+      counter, outside of the increment transactions.
+    '''
+    index = None
+    while True:
+      try:
+        return increment(index=index)
+      except UnrecordedShard as error:
+        metrics.incr('ioc.record_shard')
+        cls._record_shards_async(name, [error.index]).get_result()
+        index = error.index
+
+  @classmethod
+  def track_shards(cls, name):
+    '''
+      Enables the sparse read path for a counter created before shards were
+      tracked. New shards are always recorded before their first increment,
+      so it is enough to record the shards that exist right now.
+      Returns: None if no counter is found, True otherwise
+    '''
+    counter = ndb.Key(cls, name).get()
+    if counter is None:
+      return None
+    if counter.shards_tracked:
+      return True
+    indexes = range(max(counter.num_shards, counter.max_shards))
+    shards = ndb.get_multi([counter._get_shard_key(i) for i in indexes])
+    return cls._record_shards_async(
+        name, [i for i, shard in zip(indexes, shards) if shard is not None],
+        track=True).get_result()
 
   @classmethod
-  def get(cls, name, force_fetch=False, cache_duration=30):
+  def get(cls, name, force_fetch=False, cache_duration=30, eventual=False):
+    '''
+      Returns the counter value, cached in memcache for cache_duration seconds.
+      None if no counter is found.
+      Args:
+        eventual : Read counter and shards with eventual consistency
+    '''
     count = None if force_fetch else memcache.get(name)
     if count is None:
-      counter = ndb.Key(cls, name).get()
-      if counter is None:
+      if not force_fetch:
+        metrics.incr('ioc.get.miss')
+      if eventual:
+        counter = ndb.Key(cls, name).get(read_policy=ndb.EVENTUAL_CONSISTENCY)
+      else:
+        counter = ndb.Key(cls, name).get()
+      if counter is None or counter.state == cls.DELETING:
         return None
-      count = counter.count
+      count = counter.count_async(eventual).get_result()
       memcache.add(name, count, cache_duration)
+    else:
+      metrics.incr('ioc.get.hit')
     return count
 
+  @classmethod
+  def get_multi(cls, names, eventual=False):
+    '''
+      Reads many counters at once, bypassing memcache. The counters are fetched
+      with one batch get, their shards with concurrent batch gets.
+      Args:
+        names : List of counter names
+        eventual : Use eventually consistent reads
+      Returns: A dictionary mapping every name to its value (None if no such
+               counter exists)
+    '''
+    options = {}
+    if eventual:
+      options['read_policy'] = ndb.EVENTUAL_CONSISTENCY
+    counters = ndb.get_multi([ndb.Key(cls, name) for name in names], **options)
+    futures = [counter.count_async(eventual)
+               if counter is not None and counter.state != cls.DELETING
+               else None for counter in counters]
+    return dict((name, future.get_result() if future is not None else None)
+                for name, future in zip(names, futures))
+
   @property
   def value(self):
     '''
@@ -158,14 +415,21 @@ class IncrementOnlyCounter(ndb.Model):
     '''
       This function doubles the number of current shards associated with this
       counter - provided it doesn't grow more than the max_shards limit.
+      Counters that are being minified or reset are not expanded. The new
+      shards are recorded in the bitmap right away, as the counter is written
+      anyway, so the increments spreading to them don't have to.
       Returns:
         It returns if the was expansion. None if no counter is found
     '''
     counter = ndb.Key(cls, name).get()
     if counter is None:
       return None
+    if counter.state != cls.READ_WRITE:
+      return False
     new_shards = min(counter.max_shards, counter.num_shards * 2)
     if new_shards > counter.num_shards and counter.dynamic_growth:
+      for index in range(counter.num_shards, new_shards):
+        counter._mark_shard(index)
       counter.num_shards = new_shards
       counter.put()
       return True
@@ -173,73 +437,344 @@ class IncrementOnlyCounter(ndb.Model):
       return False
 
   @classmethod
-  @ndb.transactional(xg=True)
-  def minify_shards(cls, name):
+  @ndb.transactional
+  def _begin_minify(cls, name):
     '''
-      Function to minify shards. Since NDB allows 25 entity groups per
-      transaction we can only minify 25 shards in a single Tx. Thus we either
-      reduce the num shards by half or decrease it by 25. This is sensible
-      because we do not expect the number of shards to be more than ~100
-
-      Note: Although this function is not totally idempotent, there is not much
-      problem even if the function is executed multiple times
+      Moves a READ_WRITE counter to MINIFYING. Since NDB allows 25 entity
+      groups per transaction we can only merge 25 shards in a single Tx. Thus
+      we either reduce the num shards by half or decrease it by 24. This is
+      sensible because we do not expect the number of shards to be more than
+      ~100.
+      Returns: The counter, None if no counter is found, False if there are
+               no shards to merge or the counter is being reset or deleted
     '''
     counter = ndb.Key(cls, name).get()
     if counter is None:
       return None
-
+    if counter.state == cls.MINIFYING:
+      return counter
+    if counter.state in (cls.RESET, cls.DELETING):
+      return False
     value = min(counter.num_shards / 2, MAX_ENTITIES_PER_TRANSACTION - 1)
-    if value is 0:
+    if value == 0:
       return False
-    elif value is 1:
+    elif value == 1:
       value = 2
-    shard_list = counter._get_shards(
-        counter.num_shards - value, counter.num_shards)
+    # Shards [writable_shards, num_shards) are merged into the first of them
+    counter.state = cls.MINIFYING
+    counter.writable_shards = counter.num_shards - value
+    counter.put()
+    return counter
+
+  @classmethod
+  @ndb.transactional(xg=True)
+  def _merge_shards(cls, name):
+    '''
+      Merges the shards of a MINIFYING counter and moves it back to READ_WRITE
+    '''
+    counter = ndb.Key(cls, name).get()
+    if counter is None or counter.state != cls.MINIFYING:
+      return False
+    target = counter.writable_shards
+    shard_list = counter._get_shards(target, counter.num_shards)
     total_count = sum(shard.count for shard in shard_list if shard is not None)
     if shard_list[0] is None:
-      key_string = counter._format_shard_key(counter.num_shards - value)
-      shard_list[0] = IncrementOnlyShard.get_or_insert(key_string,
-                                                       count=total_count)
-    else:
-      shard_list[0].count = total_count
-      shard_list[0].put()
-
+      shard_list[0] = IncrementOnlyShard(id=counter._format_shard_key(target))
+      counter._mark_shard(target)
+    shard_list[0].count = total_count
+    changed = [shard_list[0]]
     for shard in shard_list[1:]:
-      if shard is not None:
+      if shard is not None and shard.count:
         shard.count = 0
-        shard.put()
+        changed.append(shard)
+    counter.num_shards = target + 1
+    counter.state = cls.READ_WRITE
+    counter.writable_shards = 0
+    changed.append(counter)
+    ndb.put_multi(changed)
+    return True
+
+  @classmethod
+  def minify_shards(cls, name):
+    '''
+      Function to minify shards, in two transactions. The first one moves the
+      counter to MINIFYING, so that increments stop writing to the shards to
+      be merged; the second one merges them and moves the counter back to
+      READ_WRITE. Neither transaction waits for or loses concurrent increments:
+      increments racing with a state change only retry. A counter left in
+      MINIFYING (e.g. the merge failed) is merged by the next call.
+      Returns: True if shards were merged, None if no counter is found
+      Raises: TransactionFailedError if the merge kept failing
+    '''
+    counter = cls._begin_minify(name)
+    if not counter:
+      return counter
+    return cls._merge_shards(name)
 
-    counter.num_shards = counter.num_shards - value + 1
+  @classmethod
+  @ndb.transactional_async(xg=True)
+  def _drain_shards_async(cls, name, start):
+    '''
+      Zeroes the shards of a RESET counter from index start on (at most
+      MAX_ENTITIES_PER_TRANSACTION - 1 of them) and opens them for reads and
+      writes. The counter is back to READ_WRITE once all shards are drained.
+      Returns: The new number of writable shards, False if the counter is not
+               being reset
+    '''
+    counter = ndb.Key(cls, name).get()
+    if counter is None or counter.state != cls.RESET:
+      return False
+    if counter.writable_shards != start:
+      # Another drain got here first
+      return counter.writable_shards
+    end = min(counter.num_shards, start + MAX_ENTITIES_PER_TRANSACTION - 1)
+    shards = [shard for shard in counter._get_shards(start, end)
+              if shard is not None and shard.count]
+    for shard in shards:
+      shard.count = 0
+    counter.writable_shards = end
+    if end >= counter.num_shards:
+      counter.state = cls.READ_WRITE
+      counter.writable_shards = 0
+    ndb.put_multi(shards + [counter])
+    return end
+
+  @classmethod
+  @ndb.transactional_async(xg=True)
+  def _begin_reset_async(cls, name, value=0):
+    '''
+      Moves a counter to RESET: sets shard 0 to value and only keeps it open
+      for reads and writes
+    '''
+    counter = ndb.Key(cls, name).get()
+    if counter is None:
+      return None
+    if counter.state in (cls.MINIFYING, cls.DELETING):
+      return False
+    shard = counter._get_shard_key(0).get()
+    if shard is None and value:
+      shard = IncrementOnlyShard(id=counter._format_shard_key(0))
+      counter._mark_shard(0)
+    if shard is not None and shard.count != value:
+      shard.count = value
+      shard.put()
+    counter.state = cls.RESET
+    counter.writable_shards = 1
     counter.put()
     return True
 
+  @classmethod
+  @ndb.tasklet
+  def _drain_async(cls, name):
+    counter = yield ndb.Key(cls, name).get_async()
+    if counter is None:
+      raise ndb.Return(None)
+    start = counter.writable_shards
+    while counter.state == cls.RESET:
+      start = yield cls._drain_shards_async(name, start)
+      if start is False:
+        break
+      counter = yield ndb.Key(cls, name).get_async()
+    raise ndb.Return(True)
+
+  @classmethod
+  def drain(cls, name):
+    '''
+      Drains the shards of a RESET counter, one transaction per
+      MAX_ENTITIES_PER_TRANSACTION - 1 shards
+      Returns: True once the counter is READ_WRITE again, None if no counter
+               is found
+    '''
+    return cls._drain_async(name).get_result()
+
+  @classmethod
+  @metrics.timed('ioc.set_multi')
+  def set_multi(cls, values, wait=True):
+    '''
+      Sets many counters. Every counter is moved to RESET in its own
+      transaction and drained in its own chain of transactions, the counters
+      concurrently.
+      Args:
+        values : Dictionary mapping counter names to their new value
+        wait : Drain all shards before returning, see reset
+      Returns: A dictionary mapping every name to the result of set
+    '''
+    names = list(values)
+    futures = [cls._begin_reset_async(name, values[name]) for name in names]
+    started = dict((name, future.get_result())
+                   for name, future in zip(names, futures))
+    memcache.delete_multi(names)
+    if wait:
+      drains = [cls._drain_async(name) for name in names if started[name]]
+      for future in drains:
+        future.get_result()
+    return started
+
+  @classmethod
+  def set(cls, name, value, wait=True):
+    '''
+      Sets the counter to value, like reset does for 0
+      Returns: True if the counter was set, None if no counter is found,
+               False if it is being minified or deleted
+    '''
+    return cls.set_multi({name: value}, wait)[name]
+
+  @classmethod
+  @metrics.timed('ioc.reset')
+  def reset(cls, name, wait=True):
+    '''
+      Sets the counter to 0. The counter reads as 0 (plus the increments made
+      since) as soon as it is RESET; its shards are zeroed in small steps,
+      while increments keep going to the shards that are already drained.
+      Args:
+        wait : Drain all shards before returning. Otherwise drain (e.g. from
+               cron or a task) has to be called.
+      Returns: True if the counter was reset, None if no counter is found,
+               False if it is being minified or deleted
+    '''
+    return cls.set(name, 0, wait)
+
+  @classmethod
+  def reset_multi(cls, names, wait=True):
+    '''
+      Resets many counters, see set_multi
+    '''
+    return cls.set_multi(dict.fromkeys(names, 0), wait)
+
+  @classmethod
+  @ndb.transactional_async
+  def _begin_delete_async(cls, name):
+    '''
+      Moves a counter to DELETING. Increments racing with it retry and find
+      no counter.
+      Returns: The counter, None if no counter is found
+    '''
+    counter = ndb.Key(cls, name).get()
+    if counter is not None and counter.state != cls.DELETING:
+      counter.state = cls.DELETING
+      counter.writable_shards = 0
+      counter.put()
+    return counter
+
+  @classmethod
+  @ndb.tasklet
+  def _delete_async(cls, name, max_logs=None):
+    counter = yield cls._begin_delete_async(name)
+    if counter is None:
+      raise ndb.Return(None)
+    shard_keys = counter._get_all_shard_keys()
+    deleted = 0
+    for index in range(counter.writable_shards, len(shard_keys)):
+      limit = None if max_logs is None else max_logs - deleted
+      count, done = yield delete_logs_async(shard_keys[index], limit)
+      deleted += count
+      if not done:
+        # Only record whole shards, their remaining logs are found again
+        metrics.incr('ioc.delete.paused')
+        raise ndb.Return(False)
+      counter.writable_shards = index + 1
+      yield counter.put_async()
+    yield delete_chunks_async(shard_keys)
+    yield counter.key.delete_async()
+    raise ndb.Return(True)
+
+  @classmethod
+  @metrics.timed('ioc.delete_multi')
+  def delete_multi(cls, names, max_logs=None):
+    '''
+      Deletes many counters with their shards and increment logs, the
+      counters concurrently. A counter is moved to DELETING first, then its
+      logs are deleted shard by shard, then its shards and the counter itself.
+      Deleted keys are batched in chunks of MAX_ENTITIES_PER_TRANSACTION,
+      which are deleted concurrently.
+      Args:
+        max_logs : Stop deleting the logs of a counter after about this many,
+                   to bound the time taken by a request. The counter stays
+                   DELETING and the next call (or resume_all) goes on from
+                   its first shard with logs left.
+      Returns: A dictionary mapping every name to True if the counter is
+               gone, False if it has logs left, None if no counter is found
+    '''
+    futures = [cls._delete_async(name, max_logs) for name in names]
+    memcache.delete_multi(names)
+    return dict((name, future.get_result())
+                for name, future in zip(names, futures))
+
+  @classmethod
+  def delete(cls, name, max_logs=None):
+    '''
+      Deletes a counter, see delete_multi
+    '''
+    return cls.delete_multi([name], max_logs)[name]
+
+  @classmethod
+  def resume_all(cls):
+    '''
+      Completes the minify, reset or delete of every counter left in
+      MINIFYING, RESET or DELETING. Meant to run from cron.
+      Returns: The number of resumed counters
+    '''
+    resumed = 0
+    resumers = ((cls.MINIFYING, cls._merge_shards),
+                (cls.RESET, cls.drain),
+                (cls.DELETING,
+                 lambda name: cls.delete(name, max_logs=RESUME_MAX_LOGS)))
+    for state, resume in resumers:
+      for key in cls.query(cls.state == state).fetch(keys_only=True):
+        try:
+          resume(key.id())
+          resumed += 1
+        except datastore_errors.TransactionFailedError:
+          metrics.incr('ioc.resume.conflict')
+    return resumed
+
   @classmethod
   @ndb.transactional(xg=True)
-  def _increment_normal(cls, name, delta):
+  def _increment_normal(cls, name, delta, attempted=None, index=None):
     '''
       This function increases a random shard by a given quantity. We randomly
-      pick any shard counter and add the quantity to it.
+      pick any shard counter and add the quantity to it. The counter is only
+      read, writing it would abort every concurrent increment.
       Note: This is not an idempotent function ! It may be incremented multiple
             times for the same request.
       Args:
         name : name of the counter
         delta : Quantity to be incremented
+        attempted : Optional list of shard indexes that already failed. They
+                    are avoided if possible and the picked index is appended
+        index : Shard to increment if it is still writable, see
+                _with_recorded_shard
       Returns: the shard_key string that was incremented
+      Raises: UnrecordedShard if the picked shard has to be created but is
+              not recorded in the bitmap
     '''
     # Re-fetching counter because it might be stale
-    counter = ndb.Key(IncrementOnlyCounter, name).get()
-    if counter is None:
+    counter = ndb.Key(cls, name).get()
+    if counter is None or counter.state == cls.DELETING:
       return None
-    index = random.randint(0, counter.num_shards - 1)
+    # Only shards that are not being merged or reset take increments
+    writable = counter._get_writable_shards()
+    if index is None or index >= writable:
+      index = random.randint(0, writable - 1)
+      if attempted is not None:
+        if len(set(i for i in attempted if i < writable)) < writable:
+          while index in attempted:
+            index = random.randint(0, writable - 1)
+        attempted.append(index)
     shard_key = counter._format_shard_key(index)
-    shard = IncrementOnlyShard.get_or_insert(shard_key)
+    shard = ndb.Key(IncrementOnlyShard, shard_key).get()
+    if shard is None:
+      if not counter._has_shard(index):
+        raise UnrecordedShard(index)
+      shard = IncrementOnlyShard(id=shard_key)
     shard.count += delta
     shard.put()
     return shard_key
 
   @classmethod
   @ndb.transactional(xg=True)
-  def _increment_idempotent(cls, name, delta, request_id):
+  def _increment_idempotent(cls, name, delta, request_id, attempted=None,
+                            check_log=True, index=None):
     '''
       This function increases a random shard by a given quantity. We randomly
       pick any shard counter and add the quantity to it. This function is an
@@ -250,11 +785,15 @@ class IncrementOnlyCounter(ndb.Model):
         name : Name of the counter
         delta : Quantity to be incremented
         request_id : unique request id generated for this operation
+        attempted : Shard indexes to avoid, see _increment_normal
+        check_log : Read the log of request_id first. Can be skipped if the
+                    request id is known to be new
+        index : See _increment_normal
     '''
     log_key = ndb.Key(ShardIncrementTransaction, request_id)
-    if log_key.get() is not None:
+    if check_log and log_key.get() is not None:
       return
-    shard_key_str = cls._increment_normal(name, delta)
+    shard_key_str = cls._increment_normal(name, delta, attempted, index)
     if shard_key_str is None:
       return None
 
@@ -266,26 +805,201 @@ class IncrementOnlyCounter(ndb.Model):
     return shard_key_str
 
   @classmethod
-  def increment(cls, name, delta=1, idempotency=False):
+  @metrics.timed('ioc.increment')
+  def increment(cls, name, delta=1, idempotency=False, queue=None,
+                retry_policy=None, idempotency_key=None, request_id=None):
     '''
       Function that increments a random shard. It generates a unique request id
-      for each call using the uuid model
+      for each call using the uuid model. Failed transactions are retried on a
+      different shard as described by the retry policy. Increments without
+      idempotency are only retried if the policy has retry_non_idempotent set,
+      as their failed attempt may have been committed.
       Args:
         name : Name of the counter
         delta : Quantity by which a shard has to be incremented (positive)
+        queue : Optional IncrementQueue. If given the increment is only
+                enqueued (always idempotent) and applied later by a worker.
+                The request id of the increment is returned in this case
+        retry_policy : RetryPolicy to use. Defaults to
+                       RetryPolicy.DEFAULT_POLICY
+        idempotency_key : Client supplied key of the increment (implies
+                          idempotency). Increments repeating the key of an
+                          applied one are ignored and return None
+        request_id : Unique id of the increment (implies idempotency),
+                     generated if not given. Lets a caller hand an increment
+                     that failed ambiguously over to an IncrementQueue, whose
+                     worker skips it if it was committed after all
+      Raises: TransactionFailedError if every attempt failed
+    '''
+    # A fresh request id has no log to check, unless a failed attempt may
+    # have been committed after all
+    check_log = False
+    if idempotency_key is not None:
+      idempotency = True
+      request_id = DedupeCache.scoped_key(cls._get_kind(), name,
+                                          idempotency_key)
+      status = DedupeCache.DEFAULT_CACHE.check(request_id)
+      if status == DedupeCache.DUPLICATE:
+        metrics.incr('ioc.increment.duplicate')
+        return None
+      check_log = status == DedupeCache.UNKNOWN
+    elif request_id is not None:
+      # The caller may already have used the id
+      idempotency = True
+      check_log = True
+    applied = False
+    try:
+      if queue is not None:
+        result = queue.enqueue(name, delta, request_id)
+        applied = True
+        return result
+      policy = retry_policy or RetryPolicy.DEFAULT_POLICY
+      breaker = policy.breaker
+      if breaker is not None and not breaker.allow(name):
+        # Sustained conflicts on this counter. Buffer the increment instead
+        metrics.incr('ioc.increment.diverted')
+        result = breaker.divert(name, delta, request_id)
+        applied = True
+        return result
+      if request_id is None:
+        request_id = str(uuid.uuid4())
+
+      attempted = []
+      for sleep in policy.attempts():
+        if sleep:
+          metrics.incr('ioc.increment.retry')
+          time.sleep(sleep)
+        try:
+          if idempotency is False:
+            # Call Normal Version
+            result = cls._with_recorded_shard(name, functools.partial(
+                cls._increment_normal, name, delta, attempted))
+          else:
+            result = cls._with_recorded_shard(name, functools.partial(
+                cls._increment_idempotent, name, delta, request_id,
+                attempted, check_log))
+        except datastore_errors.TransactionFailedError:
+          metrics.incr('ioc.increment.conflict')
+          check_log = True
+          if breaker is not None:
+            breaker.record_failure(name)
+          if policy.expand_shards and cls.expand_shards(name):
+            metrics.incr('ioc.expand')
+          if not idempotency and not policy.retry_non_idempotent:
+            break
+        else:
+          if breaker is not None:
+            breaker.record_success(name)
+          # None: no such counter (or a duplicate found by the log check)
+          applied = result is not None
+          return result
+      raise datastore_errors.TransactionFailedError('Failed')
+    finally:
+      if idempotency_key is not None and not applied:
+        # Let the client retry, see DedupeCache.release
+        DedupeCache.DEFAULT_CACHE.release(request_id)
+
+  @classmethod
+  def _increment_batch(cls, name, entries, index=None):
+    '''
+      Transaction body of a batched increment. Skips requests that were already
+      applied, adds the sum of the remaining deltas to a single random shard and
+      logs every applied request id.
+      Args:
+        name : Name of the counter
+        entries : list of (request_id, delta) tuples
+        index : See _increment_normal
+      Returns: A dictionary mapping every request id to its status
+    '''
+    logs = ndb.get_multi([ndb.Key(ShardIncrementTransaction, request_id)
+                          for request_id, _ in entries])
+    status = {}
+    pending = []
+    for (request_id, delta), log in zip(entries, logs):
+      if log is None:
+        pending.append((request_id, delta))
+      else:
+        status[request_id] = DUPLICATE
+    if not pending:
+      return status
+
+    shard_key_str = cls._increment_normal(name, sum(d for _, d in pending),
+                                          index=index)
+    if shard_key_str is None:
+      return dict((request_id, NOT_FOUND) for request_id, _ in entries)
+    shard_key = ndb.Key(IncrementOnlyShard, shard_key_str)
+    ndb.put_multi([ShardIncrementTransaction(id=request_id, shard_key=shard_key)
+                   for request_id, _ in pending])
+    for request_id, _ in pending:
+      status[request_id] = APPLIED
+    return status
+
+  @classmethod
+  @ndb.tasklet
+  def _increment_chunk_async(cls, name, chunk, previous):
+    '''
+      Commits a chunk of a batched increment once the previous chunk of the
+      same counter is done, whether or not that one failed
+    '''
+    if previous is not None:
+      try:
+        yield previous
+      except datastore_errors.TransactionFailedError:
+        pass
+    index = None
+    while True:
+      try:
+        status = yield ndb.transaction_async(functools.partial(
+            cls._increment_batch, name, chunk, index), xg=True)
+      except UnrecordedShard as error:
+        # See _with_recorded_shard
+        metrics.incr('ioc.record_shard')
+        yield cls._record_shards_async(name, [error.index])
+        index = error.index
+      else:
+        raise ndb.Return(status)
+
+  @classmethod
+  def increment_batch_async(cls, name, entries):
     '''
-    if idempotency is False:
-      # Call Normal Version
-      return cls._increment_normal(name, delta)
+      Applies many idempotent increments to one counter. The entries are split
+      into chunks that fit into a single transaction (counter + shard + logs).
+      All chunks read the counter, so they are committed one after another;
+      batches of different counters run concurrently.
+      Args:
+        name : Name of the counter
+        entries : list of (request_id, delta) tuples. Request ids must be
+                  unique within the list
+      Returns: A list of futures, each resolving to a dictionary that maps the
+               request ids of its chunk to APPLIED, DUPLICATE or NOT_FOUND
+    '''
+    futures = []
+    previous = None
+    for start in range(0, len(entries), BATCH_CHUNK_SIZE):
+      chunk = entries[start:start + BATCH_CHUNK_SIZE]
+      previous = cls._increment_chunk_async(name, chunk, previous)
+      futures.append(previous)
+    return futures
 
-    request_id = str(uuid.uuid4())
-    retry = True
-    while retry:
+  @classmethod
+  @metrics.timed('ioc.increment_batch')
+  def increment_batch(cls, name, entries):
+    '''
+      Synchronous version of increment_batch_async
+      Returns: A dictionary mapping every request id to APPLIED, DUPLICATE,
+               NOT_FOUND or FAILED (transaction failed, safe to retry)
+    '''
+    futures = cls.increment_batch_async(name, entries)
+    status = {}
+    for index, future in enumerate(futures):
       try:
-        return cls._increment_idempotent(name, delta, request_id)
+        status.update(future.get_result())
       except datastore_errors.TransactionFailedError:
-        retry = cls.expand_shards(name)
-    raise datastore_errors.TransactionFailedError('Failed')
+        metrics.incr('ioc.increment.conflict')
+        start = index * BATCH_CHUNK_SIZE
+        chunk = entries[start:start + BATCH_CHUNK_SIZE]
+        status.update((request_id, FAILED) for request_id, _ in chunk)
+    return status
 
   # Creating useful aliases for popular function
   incr = increment
@@ -0,0 +1,152 @@
+'''
+  Enqueue-and-ack increments for IncrementOnlyCounter. Increments are written to
+  a pull queue and acknowledged immediately. Workers lease the pending tasks of
+  one counter at a time, sum their deltas and apply them with a few batched
+  shard transactions (IncrementOnlyCounter.increment_batch). Every task carries
+  its request id, so a task applied twice (expired lease, worker crash) is still
+  counted only once.
+'''
+import json
+import threading
+import time
+import uuid
+from google.appengine.api import taskqueue
+import CounterMetrics as metrics
+import IncrementOnlyCounter as IOC
+
+QUEUE_NAME = 'counter-increments'
+LEASE_SECONDS = 60
+MAX_TASKS_PER_LEASE = 1000 # Upper limit imposed by the task queue API
+
+class LocalTask(object):
+  '''
+    Minimal stand-in for taskqueue.Task used by LocalQueue
+  '''
+
+  def __init__(self, payload, tag=None, name=None):
+    self.payload = payload
+    self.tag = tag
+    self.name = name or str(uuid.uuid4())
+    self.eta = 0
+
+class LocalQueue(object):
+  '''
+    In-process pull queue with the subset of the taskqueue.Queue interface used
+    by IncrementQueue. Useful for tests and deployments without App Engine.
+  '''
+
+  def __init__(self):
+    self._tasks = []
+    self._names = set()
+    self._lock = threading.Lock()
+
+  def add(self, task):
+    with self._lock:
+      if task.name in self._names:
+        raise taskqueue.TaskAlreadyExistsError(task.name)
+      self._names.add(task.name)
+      self._tasks.append(task)
+    return task
+
+  def lease_tasks_by_tag(self, lease_seconds, max_tasks, tag=None):
+    '''
+      Leases up to max_tasks tasks with the given tag. Without a tag the tag of
+      the oldest available task is used, like the App Engine implementation.
+    '''
+    now = time.time()
+    with self._lock:
+      available = [task for task in self._tasks if task.eta <= now]
+      if tag is None and available:
+        tag = available[0].tag
+      leased = [task for task in available if task.tag == tag][:max_tasks]
+      for task in leased:
+        task.eta = now + lease_seconds
+    return leased
+
+  def delete_tasks(self, tasks):
+    with self._lock:
+      deleted = set(id(task) for task in tasks)
+      self._tasks = [task for task in self._tasks if id(task) not in deleted]
+
+  def size(self):
+    return len(self._tasks)
+
+class IncrementQueue(object):
+  '''
+    Producer and worker side of the queued increment mode
+  '''
+
+  def __init__(self, queue=None):
+    self.queue = queue if queue is not None else taskqueue.Queue(QUEUE_NAME)
+
+  def _make_task(self, payload, tag, name):
+    if isinstance(self.queue, LocalQueue):
+      return LocalTask(payload, tag=tag, name=name)
+    return taskqueue.Task(payload=payload, method='PULL', tag=tag, name=name)
+
+  def enqueue(self, name, delta=1, request_id=None):
+    '''
+      Stores an increment in the queue. The task is named after the request id
+      so enqueueing the same request twice is a no-op.
+      Args:
+        name : Name of the counter
+        delta : Quantity to be added
+        request_id : Unique id of the increment. Generated if not given
+      Returns: The request id of the increment
+    '''
+    request_id = request_id or str(uuid.uuid4())
+    payload = json.dumps({'delta': delta, 'request_id': request_id})
+    try:
+      self.queue.add(self._make_task(payload, name, request_id))
+    except (taskqueue.TaskAlreadyExistsError, taskqueue.TombstonedTaskError):
+      metrics.incr('queue.enqueue.duplicate')
+    else:
+      metrics.incr('queue.enqueue')
+    return request_id
+
+  def process(self, lease_seconds=LEASE_SECONDS,
+              max_tasks=MAX_TASKS_PER_LEASE):
+    '''
+      Leases the pending increments of one counter and applies them. Tasks whose
+      transaction failed keep their lease and are retried once it expires.
+      Returns: A tuple (counter name, number of applied tasks, number of
+               failed tasks). The name is None if the queue was empty
+    '''
+    tasks = self.queue.lease_tasks_by_tag(lease_seconds, max_tasks)
+    if not tasks:
+      return None, 0, 0
+    name = tasks[0].tag
+    deltas = {}
+    tasks_by_request = {}
+    for task in tasks:
+      payload = json.loads(task.payload)
+      deltas[payload['request_id']] = payload['delta']
+      tasks_by_request.setdefault(payload['request_id'], []).append(task)
+    status = IOC.IncrementOnlyCounter.increment_batch(name, deltas.items())
+
+    done = []
+    failed = 0
+    for request_id, request_tasks in tasks_by_request.iteritems():
+      if status[request_id] == IOC.FAILED:
+        failed += len(request_tasks)
+      else:
+        done.extend(request_tasks)
+    if done:
+      self.queue.delete_tasks(done)
+    metrics.incr('queue.applied', len(done))
+    metrics.incr('queue.failed', failed)
+    return name, len(done), failed
+
+  def process_all(self, deadline=None, **kwargs):
+    '''
+      Calls process until the queue is drained or the deadline (a time.time()
+      value) has passed.
+      Returns: The total number of applied tasks
+    '''
+    applied = 0
+    while deadline is None or time.time() < deadline:
+      name, done, failed = self.process(**kwargs)
+      applied += done
+      if name is None or (failed and not done):
+        break
+    return applied
@@ -1,6 +1,9 @@
+import functools
 from google.appengine.ext import ndb
 from google.appengine.api import memcache
 from google.appengine.api import datastore_errors
+import CounterMetrics as metrics
+import DedupeCache
 
 MEMCACHE_NAME_TEMPLATE = '{0}-memcache-counter'
 MIDDLE_VALUE = 2 ** 63
@@ -94,13 +97,21 @@ class MemcacheCounter(ndb.Model):
         return persist_value
 
   @classmethod
-  def increment(cls, name, delta=1, persist_delay=10):
+  @metrics.timed('mc.increment')
+  def increment(cls, name, delta=1, persist_delay=10, idempotency_key=None):
     '''
       This function increments the counter in memcache.
       Args:
         delta : Amount to be incremented
         interval : seconds to wait before updating Datastore
+        idempotency_key : Client supplied key of the increment. Increments
+                          repeating the key of an earlier one are ignored and
+                          return None (see DedupeCache)
     '''
+    if idempotency_key is not None and not DedupeCache.DEFAULT_CACHE.claim(
+        DedupeCache.scoped_key(cls._get_kind(), name, idempotency_key)):
+      metrics.incr('mc.increment.duplicate')
+      return None
     counter_id = cls._get_memcache_id(name)
 
     if delta >= 0:
@@ -113,13 +124,59 @@ class MemcacheCounter(ndb.Model):
     persist_value = val - MIDDLE_VALUE
     if cls._lock_counter(name, persist_delay):
       # It's time to persist the value in datastore
+      metrics.incr('mc.persist')
       try:
         cls._update_datastore(counter_id, persist_value)
       except datastore_errors.TransactionFailedError:
         # Just avoid this transaction failure and try again in next iteration
-        pass
+        metrics.incr('mc.persist.failed')
     return persist_value
 
+  @classmethod
+  @metrics.timed('mc.increment_multi')
+  def increment_multi(cls, deltas, persist_delay=10):
+    '''
+      This function increments many counters with a single memcache call.
+      Counters whose persist lock expired are written to datastore afterwards,
+      all in parallel.
+      Args:
+        deltas : dictionary mapping counter names to the amount to be added
+        persist_delay : seconds to wait before updating Datastore
+      Returns: A dictionary with the new value of every counter. Counters that
+               could not be incremented in memcache map to None
+    '''
+    if not deltas:
+      return {}
+    names = deltas.keys()
+    counter_ids = cls._get_multi_memcache_ids(names)
+    new_values = memcache.offset_multi(
+        dict((counter_id, deltas[name])
+             for name, counter_id in zip(names, counter_ids)),
+        initial_value=MIDDLE_VALUE)
+
+    values = {}
+    for name, counter_id in zip(names, counter_ids):
+      val = new_values.get(counter_id)
+      values[name] = None if val is None else val - MIDDLE_VALUE
+
+    # memcache.add_multi returns the keys which were already locked
+    lock_ids = dict((LOCK_VAR_TEMPLATE.format(name), name)
+                    for name in names if values[name] is not None)
+    locked = set(memcache.add_multi(dict.fromkeys(lock_ids, None),
+                                    time=persist_delay))
+    futures = []
+    for lock_id, name in lock_ids.iteritems():
+      if lock_id not in locked:
+        metrics.incr('mc.persist')
+        futures.append(ndb.transaction_async(functools.partial(
+            cls._update_datastore, cls._get_memcache_id(name), values[name])))
+    for future in futures:
+      try:
+        future.get_result()
+      except datastore_errors.TransactionFailedError:
+        metrics.incr('mc.persist.failed')
+    return values
+
   @classmethod
   def decrement(cls, name, delta=1, persist_delay=10):
     '''
@@ -141,12 +198,14 @@ class MemcacheCounter(ndb.Model):
     counter_id = cls._get_memcache_id(name)
     val = memcache.get(counter_id)
     if val is None:
+      metrics.incr('mc.get.miss')
       # Fetch from Datastore
       counter = cls.get_or_insert(counter_id, data=initial_value)
       # Put the value to Memcache
       memcache.add(counter_id, counter.data + MIDDLE_VALUE)
       return counter.data
     else:
+      metrics.incr('mc.get.hit')
       return val - MIDDLE_VALUE
 
   @classmethod
@@ -162,6 +221,8 @@ class MemcacheCounter(ndb.Model):
     '''
     counter_id_list = cls._get_multi_memcache_ids(names)
     values = memcache.get_multi(counter_id_list)
+    metrics.incr('mc.get.hit', len(values))
+    metrics.incr('mc.get.miss', len(counter_id_list) - len(values))
     ret_values = {}
     for i, counter_id in enumerate(counter_id_list):
       if counter_id not in values:
@@ -0,0 +1,255 @@
+'''
+  Counter store for single-host deployments without App Engine. Counters live
+  in a memory-mapped file shared by all processes of the host:
+
+    header | name index (capacity entries) | cells (capacity * shards)
+
+  The index is an open addressing hash table of NAME_WIDTH byte entries, the
+  position of a name in it is the slot of its counter. Every slot has shards
+  int64 cells. An increment adds to one random cell of the slot while holding
+  a lock on just that cell (fcntl byte range lock between processes, a
+  striped thread lock within one), so increments of one counter only contend
+  when they pick the same cell. Reads take no lock and sum the cells of a
+  slot straight from the mapping; opening a store maps the file without
+  loading anything.
+
+  fcntl locks belong to the process and closing any descriptor of a file drops
+  all of them, so the instances of one process opening the same path share a
+  single descriptor, mapping and set of thread locks. The file is closed with
+  the last of them.
+
+    store = MmapCounter('/var/lib/counters.bin')
+    store.increment('page-views')
+    store.get_multi(['page-views', 'signups'])
+'''
+import fcntl
+import mmap
+import os
+import random
+import struct
+import threading
+import zlib
+
+MAGIC = 'MMCNTR01'
+HEADER = struct.Struct('<8sQQ') # magic, capacity, shards
+HEADER_SIZE = 64
+NAME_WIDTH = 64
+CELL = struct.Struct('<q')
+CAPACITY = 4096
+SHARDS = 8
+LOCK_STRIPES = 64
+
+_files = {}
+_files_lock = threading.Lock()
+
+class _StoreFile(object):
+  '''
+    Descriptor, mapping and thread locks of a store, shared by the
+    MmapCounter instances of a process
+  '''
+
+  def __init__(self, path, capacity, shards):
+    '''
+      Raises: ValueError if path is not a counter store
+    '''
+    self.fd = os.open(path, os.O_RDWR | os.O_CREAT, 0644)
+    fcntl.lockf(self.fd, fcntl.LOCK_EX, HEADER_SIZE, 0, os.SEEK_SET)
+    try:
+      if os.fstat(self.fd).st_size == 0:
+        os.ftruncate(self.fd, HEADER_SIZE + capacity * NAME_WIDTH +
+                     capacity * shards * CELL.size)
+        os.write(self.fd, HEADER.pack(MAGIC, capacity, shards))
+      self.map = mmap.mmap(self.fd, 0)
+    finally:
+      fcntl.lockf(self.fd, fcntl.LOCK_UN, HEADER_SIZE, 0, os.SEEK_SET)
+    magic, self.capacity, self.shards = HEADER.unpack_from(self.map, 0)
+    if magic != MAGIC:
+      self.close()
+      raise ValueError('%s is not a counter store' % path)
+    self.index_lock = threading.Lock()
+    self.locks = [threading.Lock() for _ in range(LOCK_STRIPES)]
+    self.users = 0
+
+  def close(self):
+    self.map.close()
+    os.close(self.fd)
+
+def _open(path, capacity, shards):
+  '''
+    Returns the store file of path, opening it unless this process has it
+    open already. Children forked with a file open get their own.
+  '''
+  key = (os.getpid(), os.path.realpath(path))
+  with _files_lock:
+    store_file = _files.get(key)
+    if store_file is None:
+      store_file = _files[key] = _StoreFile(path, capacity, shards)
+    store_file.users += 1
+  return key, store_file
+
+def _release(key):
+  with _files_lock:
+    store_file = _files[key]
+    store_file.users -= 1
+    if store_file.users == 0:
+      del _files[key]
+      store_file.close()
+
+class MmapCounter(object):
+
+  def __init__(self, path, capacity=CAPACITY, shards=SHARDS):
+    '''
+      Opens the store at path, creating it if needed. capacity and shards
+      only apply to new stores, existing ones keep their own.
+      Raises: ValueError if path is not a counter store
+    '''
+    self.path = path
+    self._key, store_file = _open(path, capacity, shards)
+    self._fd = store_file.fd
+    self._map = store_file.map
+    self.capacity = store_file.capacity
+    self.shards = store_file.shards
+    self._cells = HEADER_SIZE + self.capacity * NAME_WIDTH
+    self._sum = struct.Struct('<%dq' % self.shards)
+    # Names never move, so slots can be cached for good
+    self._slots = {}
+    self._index_lock = store_file.index_lock
+    self._locks = store_file.locks
+
+  def close(self):
+    '''
+      Closes the store, the file once no other instance of this process uses
+      it. Closing twice does nothing.
+    '''
+    if self._map is not None:
+      self._map = None
+      _release(self._key)
+
+  def flush(self):
+    '''
+      Writes the mapping back to the file. Only needed to survive a crash of
+      the host, not of the processes.
+    '''
+    self._map.flush()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
+
+  @staticmethod
+  def _encode(name):
+    '''
+      Raises: ValueError if the name does not fit an index entry
+    '''
+    if isinstance(name, unicode):
+      name = name.encode('utf-8')
+    if not name or len(name) > NAME_WIDTH or '\0' in name:
+      raise ValueError('Invalid counter name %r' % name)
+    return name.ljust(NAME_WIDTH, '\0')
+
+  def _probe(self, entry):
+    '''
+      Returns: (slot, True) if the entry is in the index, (first empty slot,
+               False) if it is not, (None, False) if the index is full
+    '''
+    start = zlib.crc32(entry) % self.capacity
+    for step in range(self.capacity):
+      slot = (start + step) % self.capacity
+      offset = HEADER_SIZE + slot * NAME_WIDTH
+      if self._map[offset] == '\0':
+        return slot, False
+      if self._map[offset:offset + NAME_WIDTH] == entry:
+        return slot, True
+    return None, False
+
+  def _find(self, name, create=False):
+    '''
+      Returns the slot of a counter, None if it does not exist
+      Args:
+        create : Add the counter to the index if it does not exist
+      Raises: ValueError if the store is full
+    '''
+    slot = self._slots.get(name)
+    if slot is not None:
+      return slot
+    entry = self._encode(name)
+    slot, found = self._probe(entry)
+    if not found and create:
+      with self._index_lock:
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, HEADER_SIZE, 0, os.SEEK_SET)
+        try:
+          # Another process may have added it meanwhile
+          slot, found = self._probe(entry)
+          if slot is None:
+            raise ValueError('Counter store %s is full' % self.path)
+          if not found:
+            offset = HEADER_SIZE + slot * NAME_WIDTH
+            self._map[offset:offset + NAME_WIDTH] = entry
+            found = True
+        finally:
+          fcntl.lockf(self._fd, fcntl.LOCK_UN, HEADER_SIZE, 0, os.SEEK_SET)
+    if not found:
+      return None
+    self._slots[name] = slot
+    return slot
+
+  def _offset(self, slot, shard=0):
+    return self._cells + (slot * self.shards + shard) * CELL.size
+
+  def _add(self, offset, delta):
+    '''
+      Adds delta to the cell at offset, holding its locks
+      Returns: The new cell value
+    '''
+    with self._locks[(offset // CELL.size) % LOCK_STRIPES]:
+      fcntl.lockf(self._fd, fcntl.LOCK_EX, CELL.size, offset, os.SEEK_SET)
+      try:
+        value = CELL.unpack_from(self._map, offset)[0] + delta
+        CELL.pack_into(self._map, offset, value)
+      finally:
+        fcntl.lockf(self._fd, fcntl.LOCK_UN, CELL.size, offset, os.SEEK_SET)
+    return value
+
+  def increment(self, name, delta=1):
+    '''
+      Adds delta to a random cell of the counter, creating it if needed
+      Raises: ValueError if the store is full or the name is invalid
+    '''
+    slot = self._find(name, create=True)
+    self._add(self._offset(slot, random.randrange(self.shards)), delta)
+
+  def _value(self, slot):
+    return sum(self._sum.unpack_from(self._map, self._offset(slot)))
+
+  def get(self, name, default=0):
+    '''
+      Returns the counter value, default if the counter does not exist
+    '''
+    slot = self._find(name)
+    return default if slot is None else self._value(slot)
+
+  def get_multi(self, names, default=0):
+    '''
+      Returns: A dictionary mapping every name to its value (default if the
+               counter does not exist)
+    '''
+    return dict((name, self.get(name, default)) for name in names)
+
+  def reset(self, name):
+    '''
+      Sets the counter to 0. Every cell is zeroed by subtracting the value it
+      had, so increments racing with the reset are kept.
+      Returns: True if the counter was reset, False if it does not exist
+    '''
+    slot = self._find(name)
+    if slot is None:
+      return False
+    for shard in range(self.shards):
+      offset = self._offset(slot, shard)
+      self._add(offset, -CELL.unpack_from(self._map, offset)[0])
+    return True
+
+  # Useful Aliases
+  incr = increment
@@ -0,0 +1,219 @@
+'''
+  Rate limiters working on memcache only (no datastore access at all):
+
+    FixedWindowLimiter    at most `limit` requests per `period` long window
+    SlidingWindowLimiter  same, but weighs in the previous window to smooth
+                          the burst allowed at window boundaries
+    TokenBucketLimiter    `rate` tokens per second, bursts up to `capacity`
+
+  check_multi checks many keys (e.g. per user and per IP) with one batched
+  memcache call per step. Rejected keys are remembered in process until they
+  may pass again, so repeated requests of a throttled client don't reach
+  memcache at all.
+
+  If memcache fails, requests are let through unless fail_open is False.
+'''
+import collections
+import time
+from google.appengine.api import memcache
+import CounterMetrics as metrics
+
+KEY_TEMPLATE = '{0}-{1}-{2}'
+BUCKET_KEY_TEMPLATE = '{0}-{1}-bucket'
+CAS_RETRIES = 3
+MAX_BLOCKED_KEYS = 10000
+
+# allowed : True if the request may pass
+# remaining : Requests (tokens) left in the current window (bucket)
+# retry_after : Seconds until a rejected request may pass
+Decision = collections.namedtuple('Decision', 'allowed remaining retry_after')
+
+class RateLimiter(object):
+  '''
+    Base class of the limiters. Subclasses implement _check_multi.
+  '''
+
+  def __init__(self, prefix='ratelimit', fail_open=True, fast_reject=True):
+    self.prefix = prefix
+    self.fail_open = fail_open
+    self.fast_reject = fast_reject
+    self._blocked = {} # key -> time until which it is rejected
+
+  def _failed(self):
+    metrics.incr('ratelimit.unavailable')
+    return Decision(self.fail_open, 0, 0)
+
+  def _check_multi(self, keys, cost, now):
+    raise NotImplementedError
+
+  def check_multi(self, keys, cost=1):
+    '''
+      Checks and counts a request against every key
+      Returns: A dictionary mapping every key to its Decision
+    '''
+    now = time.time()
+    decisions = {}
+    pending = []
+    for key in keys:
+      until = self._blocked.get(key) if self.fast_reject else None
+      if until is not None and until > now:
+        decisions[key] = Decision(False, 0, until - now)
+      else:
+        pending.append(key)
+    metrics.incr('ratelimit.fast_reject', len(decisions))
+    if pending:
+      decisions.update(self._check_multi(pending, cost, now))
+    for key in pending:
+      decision = decisions[key]
+      if decision.allowed:
+        self._blocked.pop(key, None)
+      elif self.fast_reject and decision.retry_after > 0:
+        if len(self._blocked) >= MAX_BLOCKED_KEYS:
+          self._blocked.clear()
+        self._blocked[key] = now + decision.retry_after
+    metrics.incr('ratelimit.rejected',
+                 sum(1 for d in decisions.itervalues() if not d.allowed))
+    return decisions
+
+  def check(self, key, cost=1):
+    return self.check_multi([key], cost)[key]
+
+  def allow(self, key, cost=1):
+    return self.check(key, cost).allowed
+
+  def allow_all(self, keys, cost=1):
+    '''
+      Returns True if the request may pass for all keys
+    '''
+    return all(decision.allowed
+               for decision in self.check_multi(keys, cost).itervalues())
+
+class FixedWindowLimiter(RateLimiter):
+
+  def __init__(self, limit, period, **kwargs):
+    super(FixedWindowLimiter, self).__init__(**kwargs)
+    self.limit = limit
+    self.period = period
+
+  def _window_key(self, key, window):
+    return KEY_TEMPLATE.format(self.prefix, key, window)
+
+  def _count_windows(self, cache_ids, cost):
+    '''
+      Adds cost to the window counts. offset_multi creates missing keys
+      without an expiry, so the windows are seeded with one first; they only
+      have to outlive the window after them.
+    '''
+    memcache.add_multi(dict.fromkeys(cache_ids, 0), time=2 * self.period)
+    return memcache.offset_multi(dict.fromkeys(cache_ids, cost),
+                                 initial_value=0)
+
+  def _check_multi(self, keys, cost, now):
+    window = int(now // self.period)
+    retry_after = (window + 1) * self.period - now
+    cache_ids = dict((key, self._window_key(key, window)) for key in keys)
+    counts = self._count_windows(cache_ids.values(), cost)
+    decisions = {}
+    for key in keys:
+      count = counts.get(cache_ids[key])
+      if count is None:
+        decisions[key] = self._failed()
+      elif count > self.limit:
+        decisions[key] = Decision(False, 0, retry_after)
+      else:
+        decisions[key] = Decision(True, self.limit - count, 0)
+    return decisions
+
+class SlidingWindowLimiter(FixedWindowLimiter):
+  '''
+    Approximates a sliding window log: the count of the previous window is
+    weighed by the part of it that still overlaps the sliding window.
+  '''
+
+  def _check_multi(self, keys, cost, now):
+    window = int(now // self.period)
+    overlap = 1.0 - (now - window * self.period) / self.period
+    current_ids = dict((key, self._window_key(key, window)) for key in keys)
+    previous_ids = dict((key, self._window_key(key, window - 1))
+                        for key in keys)
+    counts = self._count_windows(current_ids.values(), cost)
+    previous = memcache.get_multi(previous_ids.values())
+    decisions = {}
+    refunds = {}
+    for key in keys:
+      count = counts.get(current_ids[key])
+      if count is None:
+        decisions[key] = self._failed()
+        continue
+      estimate = previous.get(previous_ids[key], 0) * overlap + count
+      if estimate > self.limit:
+        # Rejected requests must not count against the next window
+        refunds[current_ids[key]] = -cost
+        # The estimate falls as the previous window slides out
+        retry_after = (window + 1) * self.period - now
+        weight = previous.get(previous_ids[key], 0)
+        if weight:
+          retry_after = min(retry_after,
+                            (estimate - self.limit) / weight * self.period)
+        decisions[key] = Decision(False, 0, retry_after)
+      else:
+        decisions[key] = Decision(True, int(self.limit - estimate), 0)
+    if refunds:
+      memcache.offset_multi(refunds)
+    return decisions
+
+class TokenBucketLimiter(RateLimiter):
+  '''
+    Buckets are stored as (tokens, timestamp) pairs and updated with
+    compare-and-set. Keys whose update keeps failing are decided by fail_open.
+  '''
+
+  def __init__(self, rate, capacity, **kwargs):
+    super(TokenBucketLimiter, self).__init__(**kwargs)
+    self.rate = float(rate)
+    self.capacity = capacity
+    # Time after which an idle bucket is full again, no need to keep it
+    self.expiry = int(capacity / self.rate) + 1
+
+  def _take(self, bucket, cost, now):
+    '''
+      Refills a bucket and takes cost tokens out of it
+      Returns: (Decision, new bucket)
+    '''
+    tokens, updated = bucket if bucket is not None else (self.capacity, now)
+    tokens = min(self.capacity, tokens + (now - updated) * self.rate)
+    if tokens >= cost:
+      return Decision(True, int(tokens - cost), 0), (tokens - cost, now)
+    retry_after = (cost - tokens) / self.rate
+    return Decision(False, int(tokens), retry_after), (tokens, now)
+
+  def _check_multi(self, keys, cost, now):
+    client = memcache.Client()
+    cache_ids = dict((BUCKET_KEY_TEMPLATE.format(self.prefix, key), key)
+                     for key in keys)
+    decisions = {}
+    pending = cache_ids.keys()
+    for dummy in range(CAS_RETRIES):
+      buckets = client.get_multi(pending, for_cas=True)
+      updates = {}
+      missing = {}
+      for cache_id in pending:
+        decision, bucket = self._take(buckets.get(cache_id), cost, now)
+        decisions[cache_ids[cache_id]] = decision
+        if cache_id in buckets:
+          updates[cache_id] = bucket
+        else:
+          missing[cache_id] = bucket
+      failed = []
+      if updates:
+        failed += client.cas_multi(updates, time=self.expiry)
+      if missing:
+        failed += client.add_multi(missing, time=self.expiry)
+      if not failed:
+        return decisions
+      metrics.incr('ratelimit.cas.retry')
+      pending = failed
+      now = time.time()
+    for cache_id in pending:
+      decisions[cache_ids[cache_id]] = self._failed()
+    return decisions
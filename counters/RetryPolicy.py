@@ -0,0 +1,111 @@
+'''
+  Retry policy and circuit breaker used by IncrementOnlyCounter.increment.
+  A policy bounds the total time spent on one increment, spaces retries with
+  decorrelated jitter and decides whether the counter may grow its shards. An
+  optional circuit breaker diverts increments of a counter that keeps failing
+  to a buffered path (e.g. an IncrementQueue) until the contention is over.
+'''
+import random
+import threading
+import time
+
+class CircuitBreaker(object):
+  '''
+    Per-counter circuit breaker. After `threshold` failed transactions within
+    `window` seconds the circuit of that counter opens and increments are sent
+    to the fallback for `cooldown` seconds. The first increment after the
+    cooldown is tried normally again and closes the circuit on success.
+  '''
+
+  def __init__(self, fallback, threshold=10, window=5.0, cooldown=10.0):
+    '''
+      Args:
+        fallback : Object with an enqueue(name, delta, request_id) method
+    '''
+    self.fallback = fallback
+    self.threshold = threshold
+    self.window = window
+    self.cooldown = cooldown
+    self._failures = {}
+    self._open_until = {}
+    self._lock = threading.Lock()
+
+  def allow(self, name):
+    '''
+      Returns False while the circuit of the counter is open
+    '''
+    return time.time() >= self._open_until.get(name, 0)
+
+  def record_failure(self, name):
+    now = time.time()
+    with self._lock:
+      failures = [stamp for stamp in self._failures.get(name, ())
+                  if stamp > now - self.window]
+      failures.append(now)
+      if len(failures) >= self.threshold:
+        self._open_until[name] = now + self.cooldown
+        failures = []
+      self._failures[name] = failures
+
+  def record_success(self, name):
+    with self._lock:
+      self._failures.pop(name, None)
+      self._open_until.pop(name, None)
+
+  def divert(self, name, delta, request_id=None):
+    '''
+      Hands an increment over to the fallback. Idempotent increments keep
+      their request id, so the fallback can skip them if they were applied
+    '''
+    return self.fallback.enqueue(name, delta, request_id)
+
+class RetryPolicy(object):
+  '''
+    Describes how IncrementOnlyCounter.increment retries failed transactions
+  '''
+
+  def __init__(self, deadline=1.0, base_delay=0.01, max_delay=0.25,
+               max_attempts=None, expand_shards=True, breaker=None,
+               retry_non_idempotent=False):
+    '''
+      Args:
+        deadline : Seconds after which no new attempt is started
+        base_delay : Minimum sleep between two attempts (seconds)
+        max_delay : Maximum sleep between two attempts (seconds)
+        max_attempts : Optional upper limit on the number of attempts
+        expand_shards : Double the shards of the counter after a failure
+        breaker : Optional CircuitBreaker
+        retry_non_idempotent : Also retry increments without idempotency.
+                               A failed commit may have been applied after
+                               all, so their retries may count twice
+    '''
+    self.deadline = deadline
+    self.base_delay = base_delay
+    self.max_delay = max_delay
+    self.max_attempts = max_attempts
+    self.expand_shards = expand_shards
+    self.breaker = breaker
+    self.retry_non_idempotent = retry_non_idempotent
+
+  def attempts(self):
+    '''
+      Generates the sleep (seconds) before every attempt, 0 for the first one.
+      Sleeps follow the decorrelated jitter scheme:
+        sleep = min(max_delay, uniform(base_delay, previous sleep * 3))
+      The generator stops once the next attempt would start after the deadline
+      or max_attempts is reached.
+    '''
+    start = time.time()
+    yield 0
+    attempt = 1
+    sleep = self.base_delay
+    while self.max_attempts is None or attempt < self.max_attempts:
+      sleep = min(self.max_delay, random.uniform(self.base_delay, sleep * 3))
+      if time.time() + sleep - start > self.deadline:
+        return
+      yield sleep
+      attempt += 1
+
+# Single attempt, without backoff or shard expansion
+NO_RETRY = RetryPolicy(deadline=0, max_attempts=1, expand_shards=False)
+DEFAULT_POLICY = RetryPolicy()
@@ -0,0 +1,275 @@
+'''
+  Sharded counter whose shards form a consistent hashing ring. Every live
+  shard owns VIRTUAL_NODES points of the ring and an increment goes to the
+  owner of a random token, so shards can be added or removed one at a time
+  instead of doubling (expand_shards) or merging the top half (minify_shards).
+
+  Removing a shard only takes it out of the ring: it stops receiving writes
+  but is still read (draining). merge_shards then moves its value into the
+  shard that took over its arc, one small transaction (counter, drained shard,
+  successor) per drained shard, which can run in the background (cron) while
+  the counter is under load. The MINIFYING / RESET states of
+  IncrementOnlyCounter are not used: ring counters refuse set and reset and
+  can only be deleted.
+'''
+import bisect
+import hashlib
+import itertools
+import random
+from google.appengine.ext import ndb
+from google.appengine.api import datastore_errors
+from IncrementOnlyCounter import IncrementOnlyCounter
+from IncrementOnlyCounter import IncrementOnlyShard
+from IncrementOnlyCounter import UnrecordedShard
+import CounterMetrics as metrics
+
+RING_SHARD_KEY_TEMPLATE = '{1}-{0}-ring_shard'
+VNODE_TEMPLATE = '{0}-{1}'
+VIRTUAL_NODES = 64
+MAX_CACHED_RINGS = 1000
+
+def ring_hash(value):
+  return int(hashlib.md5(value).hexdigest()[:16], 16)
+
+class ShardRing(object):
+  '''
+    Consistent hashing ring of shard indexes. Tokens are 64 bit integers.
+  '''
+
+  def __init__(self, members, vnodes=VIRTUAL_NODES):
+    self.members = frozenset(members)
+    points = sorted((ring_hash(VNODE_TEMPLATE.format(member, replica)), member)
+                    for member in self.members for replica in range(vnodes))
+    self._hashes = [point for point, _ in points]
+    self._owners = [member for _, member in points]
+
+  def lookup(self, token):
+    '''
+      Returns the member owning token, None if the ring is empty
+    '''
+    if not self._hashes:
+      return None
+    index = bisect.bisect(self._hashes, token) % len(self._hashes)
+    return self._owners[index]
+
+  def successor(self, member):
+    '''
+      Returns the member taking over the first point of a (removed) member
+    '''
+    return self.lookup(ring_hash(VNODE_TEMPLATE.format(member, 0)))
+
+  def random_member(self):
+    return self.lookup(random.getrandbits(64))
+
+_rings = {}
+
+def get_ring(members):
+  '''
+    Returns the (cached) ring of the given members
+  '''
+  members = frozenset(members)
+  ring = _rings.get(members)
+  if ring is None:
+    if len(_rings) >= MAX_CACHED_RINGS:
+      _rings.clear()
+    ring = _rings[members] = ShardRing(members)
+  return ring
+
+class RingShardedCounter(IncrementOnlyCounter):
+  # Shards in the ring. Empty means range(num_shards), so counters are created
+  # like any IncrementOnlyCounter
+  members = ndb.IntegerProperty(repeated=True, indexed=False)
+  # Shards taken out of the ring whose value was not merged yet
+  draining = ndb.IntegerProperty(repeated=True)
+
+  def _format_shard_key(self, index):
+    return RING_SHARD_KEY_TEMPLATE.format(self.key.id(), index)
+
+  @property
+  def ring_members(self):
+    return list(self.members) or range(self.num_shards)
+
+  @property
+  def ring(self):
+    return get_ring(self.ring_members)
+
+  def _get_shard_keys(self, start=0, end=-1):
+    '''
+      Returns the keys of the ring members and draining shards, sorted by
+      index, sliced to [start, end)
+    '''
+    indexes = sorted(set(self.ring_members) | set(self.draining))
+    if end == -1:
+      end = len(indexes)
+    return [self._get_shard_key(index) for index in indexes[start:end]]
+
+  def _get_all_shard_keys(self):
+    return self._get_shard_keys()
+
+  def _get_existing_shard_keys(self):
+    indexes = sorted(set(self.ring_members) | set(self.draining))
+    if self.shards_tracked:
+      indexes = [index for index in indexes if self._has_shard(index)]
+    return [self._get_shard_key(index) for index in indexes]
+
+  @classmethod
+  @ndb.transactional(xg=True)
+  def _increment_normal(cls, name, delta, attempted=None, index=None):
+    '''
+      Increments the shard owning a random token, see
+      IncrementOnlyCounter._increment_normal
+    '''
+    counter = ndb.Key(cls, name).get()
+    if counter is None or counter.state == cls.DELETING:
+      return None
+    ring = counter.ring
+    if index not in ring.members:
+      index = ring.random_member()
+      if attempted is not None:
+        if len(set(attempted) & ring.members) < len(ring.members):
+          while index in attempted:
+            index = ring.random_member()
+        attempted.append(index)
+    shard_key = counter._format_shard_key(index)
+    shard = ndb.Key(IncrementOnlyShard, shard_key).get()
+    if shard is None:
+      if not counter._has_shard(index):
+        raise UnrecordedShard(index)
+      shard = IncrementOnlyShard(id=shard_key)
+    shard.count += delta
+    shard.put()
+    return shard_key
+
+  @classmethod
+  @ndb.transactional
+  def expand_shards(cls, name):
+    '''
+      Adds a single shard to the ring, unless max_shards is reached
+      Returns: True if a shard was added, False if max_shards is reached or
+      the counter is not READ_WRITE, None if no counter is found
+    '''
+    counter = ndb.Key(cls, name).get()
+    if counter is None:
+      return None
+    if counter.state != cls.READ_WRITE:
+      return False
+    members = counter.ring_members
+    if not counter.dynamic_growth or len(members) >= counter.max_shards:
+      return False
+    used = set(members) | set(counter.draining)
+    index = next(i for i in itertools.count() if i not in used)
+    counter.members = sorted(members + [index])
+    counter.num_shards = len(counter.members)
+    # Recorded along, see IncrementOnlyCounter.expand_shards
+    counter._mark_shard(index)
+    counter.put()
+    return True
+
+  @classmethod
+  @ndb.transactional
+  def shrink_shards(cls, name):
+    '''
+      Takes the highest shard out of the ring. It keeps being read until
+      merge_shards moves its value to its successor.
+      Returns: True if a shard was removed, False if only one is left or the
+      counter is not READ_WRITE, None if no counter is found
+    '''
+    counter = ndb.Key(cls, name).get()
+    if counter is None:
+      return None
+    if counter.state != cls.READ_WRITE:
+      return False
+    members = counter.ring_members
+    if len(members) <= 1:
+      return False
+    index = max(members)
+    members.remove(index)
+    counter.members = members
+    counter.num_shards = len(members)
+    counter.draining.append(index)
+    counter.put()
+    return True
+
+  @classmethod
+  @ndb.transactional(xg=True)
+  def _merge_shard(cls, name, index):
+    '''
+      Moves the value of a draining shard to its successor in the ring
+      Returns: True if the shard was merged
+    '''
+    counter = ndb.Key(cls, name).get()
+    if counter is None or index not in counter.draining:
+      return False
+    target_index = counter.ring.successor(index)
+    shard, target = ndb.get_multi([counter._get_shard_key(index),
+                                   counter._get_shard_key(target_index)])
+    changed = [counter]
+    if shard is not None:
+      if target is None:
+        target = IncrementOnlyShard(
+            id=counter._format_shard_key(target_index))
+        counter._mark_shard(target_index)
+      target.count += shard.count
+      changed.append(target)
+      shard.key.delete()
+    counter.draining.remove(index)
+    ndb.put_multi(changed)
+    return True
+
+  @classmethod
+  @metrics.timed('ring.merge')
+  def merge_shards(cls, name):
+    '''
+      Merges every draining shard of a counter, one transaction per shard.
+      Shards whose merge conflicts are left for the next run.
+      Returns: The number of merged shards, None if no counter is found
+    '''
+    counter = ndb.Key(cls, name).get()
+    if counter is None:
+      return None
+    merged = 0
+    for index in list(counter.draining):
+      try:
+        if cls._merge_shard(name, index):
+          merged += 1
+      except datastore_errors.TransactionFailedError:
+        metrics.incr('ring.merge.conflict')
+    return merged
+
+  @classmethod
+  def merge_all(cls):
+    '''
+      Merges the draining shards of every counter. Meant to run from cron.
+      Returns: The number of merged shards
+    '''
+    keys = set(cls.query(cls.draining >= 0).fetch(keys_only=True))
+    return sum(cls.merge_shards(key.id()) or 0 for key in keys)
+
+  @classmethod
+  def minify_shards(cls, name):
+    '''
+      Removes a single shard from the ring and merges it right away
+      Returns: True if a shard was removed, None if no counter is found
+    '''
+    removed = cls.shrink_shards(name)
+    if removed:
+      cls.merge_shards(name)
+    return removed
+
+  @classmethod
+  def set_multi(cls, values, wait=True):
+    '''
+      Ring sharded counters cannot be set (or reset), like counters being
+      minified or deleted
+      Returns: A dictionary mapping every name to False, None if no counter
+               is found
+    '''
+    #pylint: disable=unused-argument
+    names = list(values)
+    counters = ndb.get_multi([ndb.Key(cls, name) for name in names])
+    return dict((name, None if counter is None else False)
+                for name, counter in zip(names, counters))
+
+  # Useful Aliases
+  minify = minify_shards
+  expand = expand_shards
@@ -0,0 +1,190 @@
+'''
+  Hierarchical counters. A path like 'emea/de/berlin' names a leaf counter;
+  'emea/de' and 'emea' are its parents. An event only increments its leaf (an
+  IncrementOnlyCounter), so every event costs a single transaction however deep
+  the hierarchy is. Parent totals are maintained lazily:
+
+    * rollup (run from cron) sums all leaves page by page with batch reads and
+      stores the total of every parent in its RollupNode.
+    * get returns the stored total of a parent, or sums its leaves on read with
+      exact=True (or if the parent was never rolled up).
+'''
+import datetime
+from google.appengine.ext import ndb
+from google.appengine.api import datastore_errors
+from IncrementOnlyCounter import IncrementOnlyCounter as IOC
+import CounterMetrics as metrics
+
+SEPARATOR = '/'
+LEAF_KEY_TEMPLATE = '{0}-rollup-leaf'
+PAGE_SIZE = 500
+DEFAULT_LEAF_SHARDS = 5
+
+def split_path(path):
+  '''
+    Returns the list of ancestors of a path, root first.
+    e.g. 'emea/de/berlin' -> ['emea', 'emea/de']
+  '''
+  parts = path.split(SEPARATOR)
+  return [SEPARATOR.join(parts[:end]) for end in range(1, len(parts))]
+
+class RollupNode(ndb.Model):
+  ancestors = ndb.StringProperty(repeated=True)
+  leaf = ndb.BooleanProperty(default=False)
+  # Total of the subtree as of the last rollup. Only set for parents
+  total = ndb.IntegerProperty(default=0, indexed=False)
+  rolled_up = ndb.DateTimeProperty(indexed=False)
+
+  def __str__(self):
+    return "(Path = %s, Leaf = %r, Total = %d)" % (
+        self.key.id(), self.leaf, self.total)
+
+  def __repr__(self):
+    return self.__str__()
+
+class RollupCounter(object):
+  '''
+    Usage:
+      RollupCounter.increment('emea/de/berlin')
+      RollupCounter.get('emea')             # Total as of the last rollup
+      RollupCounter.get('emea', exact=True) # Sum of all leaves
+  '''
+
+  @classmethod
+  def _leaf_name(cls, path):
+    return LEAF_KEY_TEMPLATE.format(path)
+
+  @classmethod
+  @ndb.transactional(xg=True)
+  def _create_leaf(cls, path, num_shards):
+    node = ndb.Key(RollupNode, path).get()
+    if node is None:
+      node = RollupNode(id=path, ancestors=split_path(path))
+    if not node.leaf:
+      node.leaf = True
+      node.put()
+    IOC.get_or_insert(cls._leaf_name(path), num_shards=num_shards,
+                      max_shards=num_shards * 4, shards_tracked=True)
+
+  @classmethod
+  @metrics.timed('rollup.increment')
+  def increment(cls, path, delta=1, num_shards=DEFAULT_LEAF_SHARDS, **kwargs):
+    '''
+      Increments the leaf counter of path. Leaves are created on their first
+      increment with num_shards shards. Other keyword arguments are passed on
+      to IncrementOnlyCounter.increment
+      Raises: TransactionFailedError if the leaf could not be incremented
+    '''
+    name = cls._leaf_name(path)
+    result = IOC.increment(name, delta, **kwargs)
+    if result is None and 'queue' not in kwargs:
+      cls._create_leaf(path, num_shards)
+      result = IOC.increment(name, delta, **kwargs)
+      # With an idempotency key None may also mean a duplicate increment
+      if result is None and kwargs.get('idempotency_key') is None:
+        raise datastore_errors.TransactionFailedError(
+            'Could not create leaf %s' % path)
+    return result
+
+  @classmethod
+  def _leaf_paths(cls, path=None):
+    '''
+      Yields the paths of all leaves below path (all leaves if path is None),
+      one page at a time
+    '''
+    query = RollupNode.query(RollupNode.leaf == True)
+    if path is not None:
+      query = query.filter(RollupNode.ancestors == path)
+    cursor = None
+    more = True
+    while more:
+      keys, cursor, more = query.fetch_page(PAGE_SIZE, start_cursor=cursor,
+                                            keys_only=True)
+      yield [key.id() for key in keys]
+
+  @classmethod
+  def _leaf_values(cls, paths):
+    values = IOC.get_multi([cls._leaf_name(path) for path in paths])
+    return [values[cls._leaf_name(path)] or 0 for path in paths]
+
+  @classmethod
+  def _sum(cls, path, node):
+    '''
+      Sums the leaves below path (and path itself if it is a leaf)
+    '''
+    total = cls._leaf_values([path])[0] if node and node.leaf else 0
+    for paths in cls._leaf_paths(path):
+      total += sum(cls._leaf_values(paths))
+    return total
+
+  @classmethod
+  def get(cls, path, exact=False):
+    '''
+      Returns the value of a leaf, or the total of a parent. Parents return the
+      total of the last rollup unless exact is set or they were never rolled
+      up; their leaves are summed up in that case. A leaf is only summed up
+      with its children once it was rolled up, or with exact.
+    '''
+    return cls.get_multi([path], exact)[path]
+
+  @classmethod
+  def get_multi(cls, paths, exact=False):
+    '''
+      Returns a dictionary mapping every path to its value, see get
+    '''
+    nodes = ndb.get_multi([ndb.Key(RollupNode, path) for path in paths])
+    values = {}
+    leaves = []
+    for path, node in zip(paths, nodes):
+      if exact or node is None:
+        values[path] = cls._sum(path, node)
+      elif node.rolled_up is not None:
+        values[path] = node.total
+      elif node.leaf:
+        # Plain leaves are never rolled up, their counter is the value. A leaf
+        # that got children reads its own value until the next rollup
+        leaves.append(path)
+      else:
+        values[path] = cls._sum(path, node)
+    values.update(zip(leaves, cls._leaf_values(leaves)))
+    return values
+
+  @classmethod
+  @metrics.timed('rollup.rollup')
+  def rollup(cls, root=None):
+    '''
+      Recomputes the stored totals of all parents below root (all parents if
+      root is None), reading the leaves PAGE_SIZE at a time.
+      Returns: A dictionary mapping every updated parent to its total
+    '''
+    totals = {}
+    for paths in cls._leaf_paths(root):
+      for path, value in zip(paths, cls._leaf_values(paths)):
+        for ancestor in split_path(path):
+          totals[ancestor] = totals.get(ancestor, 0) + value
+    if root is not None:
+      # Ancestors of root only saw part of their subtree
+      totals = dict((path, total) for path, total in totals.iteritems()
+                    if path == root or path.startswith(root + SEPARATOR))
+      totals.setdefault(root, 0)
+
+    parents = totals.keys()
+    now = datetime.datetime.utcnow()
+    for start in range(0, len(parents), PAGE_SIZE):
+      batch = parents[start:start + PAGE_SIZE]
+      nodes = ndb.get_multi([ndb.Key(RollupNode, path) for path in batch])
+      own = iter(cls._leaf_values([path for path, node in zip(batch, nodes)
+                                   if node is not None and node.leaf]))
+      for i, (path, node) in enumerate(zip(batch, nodes)):
+        if node is None:
+          node = nodes[i] = RollupNode(id=path, ancestors=split_path(path))
+        elif node.leaf:
+          totals[path] += next(own)
+        node.total = totals[path]
+        node.rolled_up = now
+      ndb.put_multi(nodes)
+    return totals
+
+  # Useful Aliases
+  incr = increment
+  value = count = get
@@ -0,0 +1,93 @@
+import unittest
+from google.appengine.ext import testbed
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from BoundedCounter import BoundedCounter as BC
+from IncrementOnlyCounter import IncrementOnlyCounter as IOC
+
+INCREMENT_STEPS = 10
+INCREMENT_VALUE = 7
+
+class TestBoundedCounter(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+        probability=1)
+    self.testbed.init_datastore_v3_stub(consistency_policy=self.policy)
+    self.testbed.init_memcache_stub()
+    ndb.get_context().set_cache_policy(False)
+    ndb.get_context().clear_cache()
+    BC(id='bounded', num_shards=4).put()
+    for dummy in range(INCREMENT_STEPS):
+      BC.increment('bounded', INCREMENT_VALUE)
+    self.total = INCREMENT_STEPS * INCREMENT_VALUE
+
+  def shard_counts(self, name):
+    counter = ndb.Key(BC, name).get()
+    return [shard.count if shard else 0 for shard in counter._get_shards()]
+
+  def test_decrement(self):
+    self.assertTrue(BC.decrement('bounded', INCREMENT_VALUE))
+    self.assertEqual(BC.get('bounded'), self.total - INCREMENT_VALUE)
+    # Needs budget of more than one shard
+    self.assertTrue(BC.decrement('bounded', self.total - 2 * INCREMENT_VALUE))
+    self.assertEqual(BC.get('bounded'), INCREMENT_VALUE)
+    # Never drops below zero
+    self.assertFalse(BC.decrement('bounded', INCREMENT_VALUE + 1))
+    self.assertEqual(BC.get('bounded'), INCREMENT_VALUE)
+    self.assertTrue(BC.decrement('bounded', INCREMENT_VALUE))
+    self.assertFalse(BC.decrement('bounded'))
+    self.assertEqual(BC.get('bounded'), 0)
+    self.assertTrue(all(count >= 0 for count in self.shard_counts('bounded')))
+    self.assertFalse(BC.decrement('missing-counter'))
+    self.assertRaises(ValueError, BC.increment, 'bounded', -1)
+    self.assertRaises(ValueError, BC.increment_batch, 'bounded',
+                      [('negative', -1)])
+    self.assertRaises(ValueError, BC.set, 'bounded', -1)
+    self.assertTrue(BC.set('bounded', INCREMENT_VALUE))
+    self.assertEqual(BC.get('bounded'), INCREMENT_VALUE)
+
+  def test_rebalance(self):
+    self.assertTrue(BC.rebalance('bounded'))
+    counts = self.shard_counts('bounded')
+    self.assertEqual(sum(counts), self.total)
+    self.assertTrue(max(counts) - min(counts) <= 1)
+    self.assertIsNone(BC.rebalance('missing-counter'))
+
+    # Counters with more shards than fit into a transaction are rebalanced in
+    # groups
+    BC(id='wide', num_shards=60).put()
+    BC.increment('wide', 600)
+    BC.rebalance('wide')
+    counts = self.shard_counts('wide')
+    self.assertEqual(sum(counts), 600)
+    self.assertTrue(max(counts) - min(counts) <= 30)
+
+    # Budget of a counter being reset is not spread back onto open shards
+    self.assertTrue(BC.reset('bounded', wait=False))
+    self.assertFalse(BC.rebalance('bounded'))
+    self.assertFalse(BC.decrement('bounded'))
+    self.assertFalse(BC._decrement_shard(
+        'bounded', ndb.Key(BC, 'bounded').get()._get_shard_key(0), 1))
+    self.assertEqual(BC.rebalance_all(), 1)
+    self.assertEqual(BC.get('bounded'), 0)
+
+  def test_deleting(self):
+    # A counter being deleted is neither read nor decremented
+    BC._begin_delete_async('bounded').get_result()
+    self.assertIsNone(BC.get('bounded'))
+    self.assertFalse(BC.decrement('bounded'))
+    self.assertFalse(BC.rebalance('bounded'))
+    self.assertEqual(BC.rebalance_all(), 0)
+
+  def test_separate_shards(self):
+    # Bounded and increment only counters of the same name don't share shards
+    IOC(id='bounded', num_shards=4).put()
+    IOC.increment('bounded', 1)
+    self.assertEqual(BC.get('bounded'), self.total)
+    self.assertEqual(IOC.get('bounded', force_fetch=True), 1)
+
+  def tearDown(self):
+    self.testbed.deactivate()
@@ -0,0 +1,203 @@
+'''
+  Concurrency stress tests of all counter types. Every scenario ramps up
+  NUM_THREADS threads incrementing a few counters picked with a zipf skew,
+  while commits randomly fail with a concurrent transaction error and memcache
+  entries get evicted. Final totals are compared with the number of
+  increments that reported success, and the throughput of every scenario is
+  logged. A last scenario makes commits fail after they were applied.
+'''
+import logging
+import random
+import time
+import unittest
+import uuid
+from threading import Event
+from threading import Thread
+from google.appengine.ext import testbed
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.api import datastore_errors
+from IncrementOnlyCounter import IncrementOnlyCounter as IOC
+from MemcacheCounter import MemcacheCounter as MC
+from DynamicCounter import DynamicCounter as DC
+from FaultInjection import DATASTORE
+from FaultInjection import MEMCACHE
+from FaultInjection import FaultInjector
+
+NUM_THREADS = [1, 4, 8] # Thread counts of the ramp
+SKEWS = [0.0, 1.5] # Zipf exponents of the counter popularity, 0 = uniform
+NUM_COUNTERS = 4
+TIME_AT_PEAK_QPS = 1 # seconds
+DELAY_BETWEEN_THREADS = 0.05 # seconds
+CONFLICT_PROBABILITY = 0.1
+EVICTION_PROBABILITY = 0.05
+LOST_COMMIT_PROBABILITY = 0.1
+
+def zipf_weights(count, skew):
+  weights = [1.0 / (rank ** skew) for rank in range(1, count + 1)]
+  total = sum(weights)
+  return [weight / total for weight in weights]
+
+class TestConcurrency(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.testbed = testbed.Testbed()
+    cls.testbed.activate()
+    cls.policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+        probability=1)
+    cls.testbed.init_datastore_v3_stub(consistency_policy=cls.policy)
+    cls.testbed.init_memcache_stub()
+    ndb.get_context().set_cache_policy(False)
+    ndb.get_context().clear_cache()
+    cls.throughput = []
+
+  def setUp(self):
+    self.datastore = FaultInjector(
+        conflict_probability=CONFLICT_PROBABILITY).install([DATASTORE])
+    self.memcache = FaultInjector(
+        eviction_probability=EVICTION_PROBABILITY).install([MEMCACHE])
+
+  def tearDown(self):
+    self.datastore.uninstall()
+    self.memcache.uninstall()
+
+  def threadproc(self, increment, names, weights, results, errors, idx):
+    '''This function is executed by each thread.'''
+    applied = dict.fromkeys(names, 0)
+    failed = 0
+    while not self.quitevent.is_set():
+      name = names[-1]
+      point = random.random()
+      for candidate, weight in zip(names, weights):
+        point -= weight
+        if point < 0:
+          name = candidate
+          break
+      try:
+        increment(name)
+        applied[name] += 1
+      except datastore_errors.TransactionFailedError:
+        failed += 1
+    results[idx] = applied
+    errors[idx] = failed
+
+  def run_scenario(self, label, increment, names, num_threads, skew):
+    '''
+      Runs num_threads threads incrementing the counters for TIME_AT_PEAK_QPS
+      seconds once all of them are running
+      Returns: A dictionary mapping names to the number of increments that
+               reported success
+    '''
+    self.quitevent = Event()
+    weights = zipf_weights(len(names), skew)
+    results = [None] * num_threads
+    errors = [None] * num_threads
+    threads = []
+    start = time.time()
+    for i in range(num_threads):
+      thread = Thread(target=self.threadproc,
+                      args=(increment, names, weights, results, errors, i))
+      thread.start()
+      threads.append(thread)
+      time.sleep(DELAY_BETWEEN_THREADS)
+    time.sleep(TIME_AT_PEAK_QPS)
+    self.quitevent.set()
+    for thread in threads:
+      thread.join()
+    elapsed = time.time() - start
+
+    applied = dict.fromkeys(names, 0)
+    for result in results:
+      for name, count in result.iteritems():
+        applied[name] += count
+    total = sum(applied.values())
+    self.throughput.append((label, num_threads, skew, total / elapsed,
+                            sum(errors)))
+    return applied
+
+  def scenarios(self):
+    for num_threads in NUM_THREADS:
+      for skew in SKEWS:
+        yield num_threads, skew
+
+  def test_increment_only_counter(self):
+    for num_threads, skew in self.scenarios():
+      names = ['stress-ioc-%d-%s-%d' % (num_threads, skew, i)
+               for i in range(NUM_COUNTERS)]
+      ndb.put_multi([IOC(id=name, num_shards=2, max_shards=16)
+                     for name in names])
+      applied = self.run_scenario(
+          'sharded', lambda name: IOC.increment(name, idempotency=True),
+          names, num_threads, skew)
+      self.datastore.conflict_probability = 0
+      self.assertDictEqual(IOC.get_multi(names), applied)
+      self.datastore.conflict_probability = CONFLICT_PROBABILITY
+    self.assertTrue(self.datastore.stats['conflicts'] > 0)
+
+  def test_lost_commits(self):
+    '''
+      Commits are applied but reported as failed. Clients retry with the same
+      request id until an attempt succeeds, which must be counted once.
+    '''
+    self.datastore.conflict_probability = 0
+    self.datastore.lost_commit_probability = LOST_COMMIT_PROBABILITY
+    def increment(name):
+      request_id = str(uuid.uuid4())
+      while True:
+        try:
+          return IOC.increment(name, request_id=request_id)
+        except datastore_errors.TransactionFailedError:
+          pass
+    for num_threads, skew in self.scenarios():
+      names = ['stress-lost-%d-%s-%d' % (num_threads, skew, i)
+               for i in range(NUM_COUNTERS)]
+      ndb.put_multi([IOC(id=name, num_shards=2, max_shards=16)
+                     for name in names])
+      applied = self.run_scenario('sharded-lost', increment, names,
+                                  num_threads, skew)
+      self.datastore.lost_commit_probability = 0
+      self.assertDictEqual(IOC.get_multi(names), applied)
+      self.datastore.lost_commit_probability = LOST_COMMIT_PROBABILITY
+    self.assertTrue(self.datastore.stats['lost_commits'] > 0)
+
+  def test_dynamic_counter(self):
+    for num_threads, skew in self.scenarios():
+      names = ['stress-dc-%d-%s-%d' % (num_threads, skew, i)
+               for i in range(NUM_COUNTERS)]
+      applied = self.run_scenario('dynamic', DC.increment, names,
+                                  num_threads, skew)
+      self.datastore.conflict_probability = 0
+      for name in names:
+        DC.minify(name)
+      self.assertDictEqual(DC.get_multi(names), applied)
+      self.datastore.conflict_probability = CONFLICT_PROBABILITY
+
+  def test_memcache_counter(self):
+    for num_threads, skew in self.scenarios():
+      names = ['stress-mc-%d-%s-%d' % (num_threads, skew, i)
+               for i in range(NUM_COUNTERS)]
+      # Without evictions no increment is lost, even if persists fail
+      self.memcache.eviction_probability = 0
+      applied = self.run_scenario(
+          'memcache', lambda name: MC.increment(name, persist_delay=0),
+          names, num_threads, skew)
+      self.assertDictEqual(MC.get_multi(names), applied)
+
+      # Evictions lose increments (by design), but never invent any
+      self.memcache.eviction_probability = EVICTION_PROBABILITY
+      before = MC.get_multi(names)
+      applied = self.run_scenario(
+          'memcache-evicted', lambda name: MC.increment(name, persist_delay=0),
+          names, num_threads, skew)
+      values = MC.get_multi(names)
+      for name in names:
+        self.assertTrue(values[name] <= before[name] + applied[name])
+    self.assertTrue(self.memcache.stats['evictions'] > 0)
+
+  @classmethod
+  def tearDownClass(cls):
+    for label, num_threads, skew, qps, failed in cls.throughput:
+      logging.info('%s: %d threads, skew %.1f, %.1f ops/s, %d failed',
+                   label, num_threads, skew, qps, failed)
+    cls.testbed.deactivate()
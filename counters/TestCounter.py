@@ -0,0 +1,118 @@
+import unittest
+from google.appengine.ext import testbed
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.api import memcache
+import Counter as COUNTER_MODULE
+from Counter import Counter
+from Counter import CounterPolicy
+import CounterBackends
+from CounterMigration import CounterMigrator
+from IncrementOnlyCounter import IncrementOnlyCounter as IOC
+
+INCREMENT_STEPS = 5
+INCREMENT_VALUE = 3
+
+class TestCounter(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.testbed = testbed.Testbed()
+    cls.testbed.activate()
+    cls.policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+        probability=1)
+    cls.testbed.init_datastore_v3_stub(consistency_policy=cls.policy)
+    cls.testbed.init_memcache_stub()
+    ndb.get_context().set_cache_policy(False)
+    ndb.get_context().clear_cache()
+    memcache.flush_all()
+
+  def setUp(self):
+    self.factors = (COUNTER_MODULE.HOT_FACTOR, COUNTER_MODULE.COOL_FACTOR)
+
+  def tearDown(self):
+    COUNTER_MODULE.HOT_FACTOR, COUNTER_MODULE.COOL_FACTOR = self.factors
+
+  def cool_down(self):
+    COUNTER_MODULE.HOT_FACTOR = COUNTER_MODULE.COOL_FACTOR = 1000
+
+  def increment(self, counter, expected):
+    for _ in range(INCREMENT_STEPS):
+      counter.increment(INCREMENT_VALUE)
+    expected += INCREMENT_STEPS * INCREMENT_VALUE
+    self.assertEqual(Counter(counter.name).get(), expected)
+    return expected
+
+  def test_policies(self):
+    Counter.configure('lossy-counter', durability=COUNTER_MODULE.LOSSY)
+    counter = Counter('lossy-counter')
+    self.increment(counter, 0)
+    route = counter.router.get_routes(['lossy-counter'])['lossy-counter']
+    self.assertEqual(route.read_type(), CounterBackends.MEMCACHE)
+
+    Counter.configure('durable-counter', expected_qps=8)
+    self.assertEqual(ndb.Key(IOC, 'durable-counter').get().num_shards, 8)
+    self.increment(Counter('durable-counter'), 0)
+
+    # Unconfigured counters use the default policy
+    self.assertEqual(Counter('default-counter').get(), 0)
+    self.increment(Counter('default-counter'), 0)
+    self.assertEqual(ndb.Key(IOC, 'default-counter').get().num_shards, 1)
+
+  def test_grow_shards(self):
+    Counter.configure('growing-counter', expected_qps=2)
+    self.assertTrue(COUNTER_MODULE._grow_shards('growing-counter', 8))
+    self.assertEqual(ndb.Key(IOC, 'growing-counter').get().num_shards, 4)
+    # Counters being reset, minified or deleted don't grow
+    self.assertTrue(IOC.reset('growing-counter', wait=False))
+    self.assertFalse(COUNTER_MODULE._grow_shards('growing-counter', 16))
+    self.assertEqual(ndb.Key(IOC, 'growing-counter').get().num_shards, 4)
+    self.assertIsNone(COUNTER_MODULE._grow_shards('missing-counter', 8))
+
+  def test_freshness(self):
+    Counter.configure('fresh-counter', freshness=60)
+    counter = Counter('fresh-counter')
+    counter.increment(INCREMENT_VALUE)
+    self.assertEqual(counter.get(), INCREMENT_VALUE)
+    counter.increment(INCREMENT_VALUE)
+    # Served from cache until the freshness interval is over
+    self.assertEqual(counter.get(), INCREMENT_VALUE)
+
+  def test_durable_promotion(self):
+    COUNTER_MODULE.HOT_FACTOR = 0.1
+    Counter.configure('hot-durable', expected_qps=2)
+    counter = Counter('hot-durable')
+    expected = self.increment(counter, 0)
+    self.assertTrue(counter.policy.promoted)
+    self.assertEqual(ndb.Key(IOC, 'hot-durable').get().num_shards, 4)
+    expected = self.increment(counter, expected)
+
+    self.cool_down()
+    self.assertIn('hot-durable', Counter.rebalance())
+    self.assertFalse(Counter('hot-durable').policy.promoted)
+    self.assertEqual(ndb.Key(IOC, 'hot-durable').get().num_shards, 2)
+    self.increment(counter, expected)
+
+  def test_buffered_promotion(self):
+    COUNTER_MODULE.HOT_FACTOR = 0.1
+    Counter.configure('hot-buffered', durability=COUNTER_MODULE.BUFFERED)
+    counter = Counter('hot-buffered')
+    migrator = CounterMigrator(counter.router, settle_seconds=0)
+    expected = self.increment(counter, 0)
+    self.assertTrue(CounterPolicy.get_by_id('hot-buffered').promoted)
+    while migrator.advance(['hot-buffered']):
+      expected = self.increment(counter, expected)
+    route = counter.router.get_routes(['hot-buffered'])['hot-buffered']
+    self.assertEqual(route.read_type(), CounterBackends.MEMCACHE)
+
+    self.cool_down()
+    self.assertEqual(Counter.rebalance(), ['hot-buffered'])
+    while migrator.advance(['hot-buffered']):
+      expected = self.increment(counter, expected)
+    route = counter.router.get_routes(['hot-buffered'])['hot-buffered']
+    self.assertEqual(route.read_type(), CounterBackends.SHARDED)
+    self.increment(counter, expected)
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.testbed.deactivate()
@@ -0,0 +1,86 @@
+import unittest
+from google.appengine.ext import testbed
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.api import memcache
+from CounterAudit import CounterAudit
+from MemcacheCounter import MemcacheCounter as MC
+from IncrementOnlyCounter import IncrementOnlyCounter as IOC
+
+NUM_COUNTERS = 7
+INCREMENT_VALUE = 5
+
+class TestCounterAudit(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+        probability=1)
+    self.testbed.init_datastore_v3_stub(consistency_policy=self.policy)
+    self.testbed.init_memcache_stub()
+    ndb.get_context().set_cache_policy(False)
+    ndb.get_context().clear_cache()
+    self.audit = CounterAudit(page_size=3)
+
+  def test_memcache_drift(self):
+    names = ['audit-mc-%d' % i for i in range(NUM_COUNTERS)]
+    for name in names:
+      MC.increment(name, INCREMENT_VALUE)
+    # The persist lock is held, so these only reach memcache
+    MC.increment(names[0], INCREMENT_VALUE)
+    MC.increment(names[1], 100 * INCREMENT_VALUE)
+    memcache.delete(MC._get_memcache_id(names[2]))
+
+    summary = self.audit.audit_memcache().summary()
+    self.assertEqual(summary['scanned'], NUM_COUNTERS)
+    self.assertEqual(summary['uncached'], 1)
+    self.assertEqual(summary['drifted'], 2)
+    self.assertEqual(summary['max_drift'], 100 * INCREMENT_VALUE)
+    self.assertEqual(summary['worst'][0], [MC._get_memcache_id(names[1]),
+                                           100 * INCREMENT_VALUE])
+    self.assertEqual(sum(summary['histogram']), NUM_COUNTERS - 1)
+    self.assertTrue(summary['done'])
+
+    repaired = CounterAudit(repair=True).audit_memcache().summary()
+    self.assertEqual(repaired['repaired'], 3)
+    summary = self.audit.audit_memcache().summary()
+    self.assertEqual((summary['drifted'], summary['uncached']), (0, 0))
+    counter = ndb.Key(MC, MC._get_memcache_id(names[1])).get()
+    self.assertEqual(counter.data, 101 * INCREMENT_VALUE)
+
+  def test_sharded_drift(self):
+    names = ['audit-ioc-%d' % i for i in range(NUM_COUNTERS)]
+    ndb.put_multi([IOC(id=name, num_shards=2) for name in names])
+    for name in names:
+      IOC.increment(name, INCREMENT_VALUE)
+      IOC.get(name)
+    # The cached totals of these are stale now
+    IOC.increment(names[0], INCREMENT_VALUE)
+    IOC.increment(names[1], INCREMENT_VALUE)
+
+    report = self.audit.audit_sharded()
+    self.assertEqual(report.drifted, 2)
+    self.assertEqual(report.histogram[1], 2)
+    CounterAudit(repair=True).audit_sharded()
+    self.assertEqual(self.audit.audit_sharded().drifted, 0)
+    self.assertEqual(IOC.get(names[0]), 2 * INCREMENT_VALUE)
+
+  def test_resume(self):
+    names = ['audit-resume-%d' % i for i in range(NUM_COUNTERS)]
+    for name in names:
+      MC.increment(name, INCREMENT_VALUE)
+    report = self.audit.audit_memcache(deadline=0)
+    self.assertFalse(report.done)
+    scanned = 0
+    cursor = None
+    while True:
+      report = self.audit.audit_memcache(cursor, deadline=0)
+      scanned += report.scanned
+      if report.done:
+        break
+      cursor = report.cursor
+    self.assertEqual(scanned, NUM_COUNTERS)
+
+  def tearDown(self):
+    self.testbed.deactivate()
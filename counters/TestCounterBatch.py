@@ -0,0 +1,78 @@
+import unittest
+from google.appengine.ext import testbed
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from CounterBackends import DYNAMIC
+from CounterBackends import MEMCACHE
+from CounterBackends import SHARDED
+from CounterBatch import CounterBatch
+from FaultInjection import FaultInjector
+from IncrementOnlyCounter import IncrementOnlyCounter as IOC
+from MemcacheCounter import MemcacheCounter as MC
+
+NUM_COUNTERS = 10
+
+class TestCounterBatch(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+        probability=1)
+    self.testbed.init_datastore_v3_stub(consistency_policy=self.policy)
+    self.testbed.init_memcache_stub()
+    ndb.get_context().set_cache_policy(False)
+    ndb.get_context().clear_cache()
+    self.names = ['batch-%d' % i for i in range(NUM_COUNTERS)]
+    ndb.put_multi([IOC(id=name, num_shards=2) for name in self.names])
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def test_increments_are_deferred(self):
+    with CounterBatch() as batch:
+      self.assertIs(CounterBatch.current(), batch)
+      for name in self.names:
+        CounterBatch.add(name, 2)
+        CounterBatch.add(name, 3)
+        CounterBatch.add(name, 1, counter_type=MEMCACHE)
+      self.assertEqual(batch.pending, 2 * NUM_COUNTERS)
+      self.assertEqual(IOC.get(self.names[0], force_fetch=True), 0)
+      self.assertRaises(ValueError, batch.increment, 'x', 1, 'unknown')
+    self.assertIsNone(CounterBatch.current())
+    self.assertEqual(IOC.get_multi(self.names),
+                     dict.fromkeys(self.names, 5))
+    self.assertEqual(MC.get_multi(self.names), dict.fromkeys(self.names, 1))
+
+    # Without a batch increments are applied right away
+    CounterBatch.add(self.names[0])
+    self.assertEqual(IOC.get(self.names[0], force_fetch=True), 6)
+
+  def test_reads_flush_and_combine(self):
+    with CounterBatch() as batch:
+      for name in self.names:
+        batch.increment(name)
+      batch.prefetch(self.names)
+      with FaultInjector().install() as injector:
+        self.assertEqual(batch.get(self.names[0]), 1)
+        calls = injector.stats['calls']
+        # Every other read is answered by the first one
+        self.assertEqual(batch.get_multi(self.names),
+                         dict.fromkeys(self.names, 1))
+        self.assertEqual(injector.stats['calls'], calls)
+      batch.increment(self.names[0], 1)
+      self.assertEqual(batch.get(self.names[0]), 2)
+      self.assertEqual(batch.get('missing', DYNAMIC), 0)
+
+  def test_discarded_on_error(self):
+    try:
+      with CounterBatch():
+        CounterBatch.add(self.names[0], counter_type=SHARDED)
+        raise RuntimeError()
+    except RuntimeError:
+      pass
+    self.assertIsNone(CounterBatch.current())
+    self.assertEqual(IOC.get(self.names[0], force_fetch=True), 0)
+
+if __name__ == '__main__':
+  unittest.main()
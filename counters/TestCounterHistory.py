@@ -0,0 +1,61 @@
+import datetime
+import unittest
+from google.appengine.ext import testbed
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from CounterHistory import CounterHistory
+from CounterHistory import CounterHistoryDay
+from CounterHistory import decode_varints
+from CounterHistory import encode_varint
+from CounterHistory import unzigzag
+from CounterHistory import zigzag
+
+START = datetime.datetime(2016, 3, 1, 22, 0)
+RESOLUTION = 600
+
+class TestCounterHistory(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+        probability=1)
+    self.testbed.init_datastore_v3_stub(consistency_policy=self.policy)
+    self.testbed.init_memcache_stub()
+    ndb.get_context().set_cache_policy(False)
+    ndb.get_context().clear_cache()
+    self.history = CounterHistory(resolution=RESOLUTION)
+
+  def test_encoding(self):
+    values = [0, 1, -1, 127, 128, -300, 2 ** 40, -(2 ** 40)]
+    out = bytearray()
+    for value in values:
+      encode_varint(zigzag(value), out)
+    self.assertEqual([unzigzag(v) for v in decode_varints(str(out))], values)
+
+  def test_snapshot_and_query(self):
+    # 4 hours of snapshots crossing midnight, taken twice per slot
+    expected = []
+    for step in range(48):
+      timestamp = START + datetime.timedelta(seconds=step * RESOLUTION / 2)
+      values = {'history-a': step * 10, 'history-b': 1000 - step}
+      written = self.history.snapshot(values, timestamp)
+      self.assertEqual(written, 0 if step % 2 else 2)
+      if step % 2 == 0:
+        expected.append((timestamp, step * 10))
+
+    points = CounterHistory.query('history-a', START,
+                                  START + datetime.timedelta(hours=4))
+    self.assertEqual(points, expected)
+    points = CounterHistory.query(
+        'history-b', START + datetime.timedelta(hours=1, minutes=55),
+        START + datetime.timedelta(hours=2, minutes=20))
+    self.assertEqual([value for _, value in points], [1000 - 24, 1000 - 26])
+
+    days = CounterHistoryDay.query().fetch()
+    self.assertEqual(len(days), 4)
+    # Small steps take 2 bytes per point, plus the absolute first point
+    self.assertTrue(all(len(day.data) <= 2 * day.points + 2 for day in days))
+
+  def tearDown(self):
+    self.testbed.deactivate()
@@ -0,0 +1,86 @@
+import unittest
+from google.appengine.ext import testbed
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.api import memcache
+import CounterMetrics as metrics
+from IncrementOnlyCounter import IncrementOnlyCounter as IOC
+from MemcacheCounter import MemcacheCounter as MC
+from DynamicCounter import DynamicCounter as DC
+
+INCREMENT_STEPS = 5
+
+class TestCounterMetrics(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.testbed = testbed.Testbed()
+    cls.testbed.activate()
+    cls.policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+        probability=1)
+    cls.testbed.init_datastore_v3_stub(consistency_policy=cls.policy)
+    cls.testbed.init_memcache_stub()
+    ndb.get_context().set_cache_policy(False)
+    ndb.get_context().clear_cache()
+
+    cls.counter_key = 'metrics_counter'
+    IOC(id=cls.counter_key).put()
+
+  def setUp(self):
+    memcache.flush_all()
+    self.sink = metrics.add_sink(metrics.InMemorySink())
+
+  def tearDown(self):
+    metrics.clear_sinks()
+
+  def test_disabled(self):
+    metrics.clear_sinks()
+    self.assertFalse(metrics.enabled())
+    IOC.increment(self.counter_key)
+    self.assertEqual(self.sink.num_timings('ioc.increment'), 0)
+    self.assertEqual(self.sink.count('rpc.datastore_v3.Commit'), 0)
+
+  def test_increment_only_counter(self):
+    for _ in range(INCREMENT_STEPS):
+      IOC.increment(self.counter_key, idempotency=True)
+    self.assertEqual(self.sink.num_timings('ioc.increment'), INCREMENT_STEPS)
+    self.assertGreaterEqual(self.sink.count('rpc.datastore_v3.Commit'),
+                            INCREMENT_STEPS)
+    self.assertIsNotNone(self.sink.percentile('ioc.increment', 99))
+
+    IOC.get(self.counter_key)
+    IOC.get(self.counter_key)
+    self.assertEqual(self.sink.count('ioc.get.miss'), 1)
+    self.assertEqual(self.sink.count('ioc.get.hit'), 1)
+
+  def test_memcache_counter(self):
+    MC.increment('metrics-mc', persist_delay=1000)
+    MC.increment('metrics-mc', persist_delay=1000)
+    self.assertEqual(self.sink.num_timings('mc.increment'), 2)
+    self.assertEqual(self.sink.count('mc.persist'), 1)
+
+    MC.get('metrics-mc')
+    MC.get_multi(['metrics-mc', 'metrics-mc-missing'])
+    self.assertEqual(self.sink.count('mc.get.hit'), 2)
+    self.assertEqual(self.sink.count('mc.get.miss'), 1)
+
+  def test_dynamic_counter(self):
+    for _ in range(INCREMENT_STEPS):
+      DC.increment('metrics-dc')
+    DC.minify('metrics-dc')
+    self.assertEqual(self.sink.num_timings('dc.increment'), INCREMENT_STEPS)
+    self.assertEqual(self.sink.count('dc.minify.shards'), INCREMENT_STEPS)
+
+  def test_histogram(self):
+    sink = metrics.InMemorySink(buckets=(10, 100))
+    for millis in (1, 5, 50, 500):
+      sink.timing('op', millis)
+    self.assertEqual(sink.snapshot()['histograms']['op'], [2, 1, 1])
+    self.assertEqual(sink.percentile('op', 50), 10)
+    self.assertEqual(sink.percentile('op', 75), 100)
+    self.assertEqual(sink.percentile('op', 100), float('inf'))
+    self.assertIsNone(sink.percentile('missing', 50))
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.testbed.deactivate()
@@ -0,0 +1,81 @@
+import unittest
+from google.appengine.ext import testbed
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.api import memcache
+import CounterBackends
+from CounterMigration import CounterMigrator
+from CounterMigration import CounterRoute
+from CounterMigration import CounterRouter
+
+INCREMENT_STEPS = 5
+INCREMENT_VALUE = 7
+
+class TestCounterMigration(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.testbed = testbed.Testbed()
+    cls.testbed.activate()
+    cls.policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+        probability=1)
+    cls.testbed.init_datastore_v3_stub(consistency_policy=cls.policy)
+    cls.testbed.init_memcache_stub()
+    ndb.get_context().set_cache_policy(False)
+    ndb.get_context().clear_cache()
+    memcache.flush_all()
+
+  def setUp(self):
+    self.router = CounterRouter(default_type=CounterBackends.MEMCACHE)
+    self.migrator = CounterMigrator(self.router, batch_size=2,
+                                    settle_seconds=0)
+
+  def increment_all(self, names, expected):
+    for _ in range(INCREMENT_STEPS):
+      self.router.increment_multi(dict.fromkeys(names, INCREMENT_VALUE))
+    for name in names:
+      expected[name] += INCREMENT_STEPS * INCREMENT_VALUE
+    self.assertDictEqual(self.router.get_multi(names), expected)
+
+  def test_migration(self):
+    names = ['migrate-%d' % i for i in range(5)]
+    expected = dict.fromkeys(names, 0)
+    self.increment_all(names, expected)
+
+    started = self.migrator.start(names, CounterBackends.SHARDED,
+                                  num_shards=2)
+    self.assertEqual(sorted(started), names)
+    self.assertEqual(sorted(self.migrator.pending()), names)
+    # Starting twice is a no-op
+    self.assertEqual(self.migrator.start(names, CounterBackends.DYNAMIC), [])
+
+    phases = [CounterRoute.BACKFILLED, CounterRoute.CUTOVER,
+              CounterRoute.STABLE]
+    for phase in phases:
+      self.increment_all(names, expected)
+      self.assertEqual(self.migrator.advance(), len(names))
+      routes = self.router.get_routes(names)
+      self.assertEqual(set(route.phase for route in routes.values()),
+                       set([phase]))
+      self.increment_all(names, expected)
+
+    self.assertEqual(self.migrator.pending(), [])
+    for route in self.router.get_routes(names).values():
+      self.assertEqual(route.write_types(), [CounterBackends.SHARDED])
+
+    # Migrating back to memcache keeps the values as well
+    self.migrator.start(names, CounterBackends.MEMCACHE)
+    while self.migrator.advance():
+      self.increment_all(names, expected)
+    self.increment_all(names, expected)
+
+  def test_settle_time(self):
+    migrator = CounterMigrator(self.router, settle_seconds=3600)
+    migrator.start(['settle-counter'], CounterBackends.DYNAMIC)
+    self.assertEqual(migrator.advance(), 0)
+    route = self.router.get_routes(['settle-counter'])['settle-counter']
+    self.assertEqual(route.phase, CounterRoute.DUAL_WRITE)
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.testbed.deactivate()
@@ -0,0 +1,118 @@
+import unittest
+import time
+from google.appengine.ext import testbed
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.api import memcache
+import DedupeCache as DEDUPE_MODULE
+from DedupeCache import DedupeCache
+from DedupeCache import DedupeRecord
+from DynamicCounter import DynamicCounter as DC
+from IncrementOnlyCounter import IncrementOnlyCounter as IOC
+from MemcacheCounter import MemcacheCounter as MC
+
+class TestDedupeCache(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+        probability=1)
+    self.testbed.init_datastore_v3_stub(consistency_policy=self.policy)
+    self.testbed.init_memcache_stub()
+    ndb.get_context().set_cache_policy(False)
+    ndb.get_context().clear_cache()
+    self.cache = DedupeCache()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def age_shards(self, cache):
+    '''
+      Pretends every shard has been in memcache for longer than the ttl
+    '''
+    keys = [DEDUPE_MODULE.SHARD_KEY_TEMPLATE.format(shard)
+            for shard in range(cache.num_shards)]
+    shards = memcache.get_multi(keys, namespace=cache.namespace)
+    since = time.time() - cache.ttl - 1
+    memcache.set_multi(
+        dict((key, (since, shards.get(key, (0, {}))[1])) for key in keys),
+        namespace=cache.namespace)
+
+  def shard_key(self, cache, key):
+    return DEDUPE_MODULE.SHARD_KEY_TEMPLATE.format(
+        DEDUPE_MODULE.fingerprint(key) % cache.num_shards)
+
+  def test_check(self):
+    # Shards that were just (re)created can't vouch for missing keys
+    self.assertEqual(self.cache.check('a'), DEDUPE_MODULE.UNKNOWN)
+    self.assertEqual(self.cache.check('a'), DEDUPE_MODULE.DUPLICATE)
+    self.age_shards(self.cache)
+    self.assertEqual(self.cache.check_multi(['b', 'c', 'a']),
+                     {'b': DEDUPE_MODULE.NEW, 'c': DEDUPE_MODULE.NEW,
+                      'a': DEDUPE_MODULE.DUPLICATE})
+
+    # An evicted shard takes its keys and its age with it
+    memcache.delete(self.shard_key(self.cache, 'b'),
+                    namespace=self.cache.namespace)
+    self.assertEqual(self.cache.check('b'), DEDUPE_MODULE.UNKNOWN)
+    others = [key for key in ('d', 'e', 'f', 'g')
+              if self.shard_key(self.cache, key) !=
+              self.shard_key(self.cache, 'b')]
+    self.assertEqual(self.cache.check(others[0]), DEDUPE_MODULE.NEW)
+
+    # Released keys stay unresolved
+    self.cache.release('c')
+    self.assertEqual(self.cache.check('c'), DEDUPE_MODULE.UNKNOWN)
+
+    memcache.flush_all()
+    self.assertEqual(self.cache.check('c'), DEDUPE_MODULE.UNKNOWN)
+
+  def test_claim(self):
+    self.age_shards(self.cache)
+    self.assertTrue(self.cache.claim('a'))
+    self.assertFalse(self.cache.claim('a'))
+    self.assertIsNotNone(ndb.Key(DedupeRecord, 'a').get())
+
+    # Lost shards are resolved with the records
+    memcache.flush_all()
+    self.assertFalse(self.cache.claim('a'))
+    self.assertTrue(self.cache.claim('b'))
+
+    # Released keys may be claimed again
+    self.cache.release('a')
+    self.assertIsNone(ndb.Key(DedupeRecord, 'a').get())
+    self.assertTrue(self.cache.claim('a'))
+
+  def test_purge(self):
+    self.cache.claim('a')
+    self.assertEqual(DedupeCache.purge(), 0)
+    self.assertEqual(DedupeCache.purge(ttl=-1), 1)
+    self.assertIsNone(ndb.Key(DedupeRecord, 'a').get())
+
+  def test_counters(self):
+    self.age_shards(DEDUPE_MODULE.DEFAULT_CACHE)
+    IOC(id='ioc', num_shards=2).put()
+    for dummy in range(2):
+      IOC.increment('ioc', 2, idempotency_key='request-1')
+      MC.increment('mc', 2, idempotency_key='request-1')
+      DC.increment('dc', 2, idempotency_key='request-1')
+    IOC.increment('ioc', 3, idempotency_key='request-2')
+    # Keys are scoped by counter type and name
+    MC.increment('other', 1, idempotency_key='request-1')
+    DC.minify('dc')
+    self.assertEqual(IOC.get('ioc', force_fetch=True), 5)
+    self.assertEqual(MC.get('mc'), 2)
+    self.assertEqual(MC.get('other'), 1)
+    self.assertEqual(DC.get_value('dc'), 2)
+
+    # After a memcache flush the sharded counter logs catch the duplicate
+    memcache.flush_all()
+    IOC.increment('ioc', 2, idempotency_key='request-1')
+    DC.increment('dc', 2, idempotency_key='request-1')
+    DC.minify('dc')
+    self.assertEqual(IOC.get('ioc', force_fetch=True), 5)
+    self.assertEqual(DC.get_value('dc'), 2)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -3,7 +3,12 @@ import random
 from google.appengine.ext import testbed
 from google.appengine.datastore import datastore_stub_util
 from google.appengine.ext import ndb
+import DedupeCache
 from DynamicCounter import DynamicCounter as DC
+from DynamicCounter import DynamicShard
+from DynamicCounter import DynamicShardBuffer
+from FaultInjection import DATASTORE
+from FaultInjection import FaultInjector
 
 INCREMENT_STEPS = 5
 INCREMENT_VALUE = 40
@@ -65,3 +70,82 @@ class TestDynamicCounter(unittest.TestCase):
     DC.set('set-count', val + 10)
     val += 10
     self.assertEquals(DC.get_value('set-count'), val)
+
+  def test_increment_multi(self):
+    names = ['multi-1', 'multi-2']
+    expected_val = dict((name, DC.get_value(name)) for name in names)
+    deltas = {'multi-1': INCREMENT_VALUE, 'multi-2': -INCREMENT_VALUE}
+    DC.increment_multi(deltas)
+    DC.increment_multi(deltas)
+    for name in names:
+      DC.minify(name)
+      self.assertEquals(DC.get_value(name),
+                        expected_val[name] + 2 * deltas[name])
+
+  def test_buffered_increment(self):
+    names = ['buffered-1', 'buffered-2']
+    buf = DynamicShardBuffer(flush_interval=3600, max_counters=len(names),
+                             instance_id='test-instance')
+    for dummy in range(INCREMENT_STEPS):
+      buf.add(names[0], INCREMENT_VALUE)
+    query = DynamicShard.query(DynamicShard.counter_key.IN(
+        [ndb.Key(DC, DC._format_key(name)) for name in names]))
+    self.assertEquals(query.count(), 0)
+    # Buffering a second counter reaches max_counters and flushes
+    buf.add(names[1], -INCREMENT_VALUE)
+    shards = query.fetch()
+    self.assertEquals(len(shards), len(names))
+    self.assertEquals(set(shard.sequence for shard in shards), set([1]))
+
+    # A retried flush rewrites the same shards
+    buf.add(names[0], INCREMENT_VALUE)
+    retried, _ = buf._take_shards()
+    ndb.put_multi(retried)
+    ndb.put_multi(retried)
+    self.assertEquals(buf.flush(), 0)
+    DC.minify(names[0])
+    DC.minify(names[1])
+    self.assertEquals(DC.get_value(names[0]),
+                      (INCREMENT_STEPS + 1) * INCREMENT_VALUE)
+    self.assertEquals(DC.get_value(names[1]), -INCREMENT_VALUE)
+
+  def test_buffer_request_end(self):
+    name = 'buffered-request'
+    buf = DynamicShardBuffer(flush_interval=3600, instance_id='request-end')
+    query = DynamicShard.query(
+        DynamicShard.counter_key == ndb.Key(DC, DC._format_key(name)))
+    buf.request_started()
+    buf.request_started()
+    buf.add(name, INCREMENT_VALUE)
+    buf.request_finished()
+    self.assertEquals(query.count(), 0)
+    # The last running request leaves nothing buffered
+    buf.request_finished()
+    self.assertEquals(query.count(), 1)
+
+  def test_buffer_failed_flush(self):
+    name = 'buffered-failure'
+    buf = DynamicShardBuffer(flush_interval=0, instance_id='failure')
+    with FaultInjector(error_probability=1).install([DATASTORE]):
+      # The failure is not raised to the caller whose delta is buffered
+      buf.add(name, INCREMENT_VALUE)
+    self.assertEquals(len(buf.pending), 1)
+    buf.add(name, INCREMENT_VALUE)
+    self.assertEquals(buf.pending, [])
+    DC.minify(name)
+    self.assertEquals(DC.get_value(name), 2 * INCREMENT_VALUE)
+
+  def test_buffer_failed_idempotent_flush(self):
+    name = 'buffered-idempotent'
+    request_id = DedupeCache.scoped_key(DC._get_kind(), name, 'request-1')
+    buf = DynamicShardBuffer(flush_interval=3600, instance_id='idempotent')
+    buf.add(name, INCREMENT_VALUE)
+    self.assertTrue(DedupeCache.DEFAULT_CACHE.claim(request_id))
+    buf.add(name, INCREMENT_VALUE, request_id)
+    # A failed flush drops the idempotent delta and lets the client retry
+    shards, keyed = buf._take_shards()
+    buf._release(keyed)
+    ndb.put_multi(shards)
+    self.assertTrue(DedupeCache.DEFAULT_CACHE.claim(request_id))
+    DC.minify(name)
+    self.assertEquals(DC.get_value(name), INCREMENT_VALUE)
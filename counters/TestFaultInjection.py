@@ -0,0 +1,76 @@
+import unittest
+from google.appengine.ext import testbed
+from google.appengine.ext import ndb
+from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
+from FaultInjection import DATASTORE
+from FaultInjection import MEMCACHE
+from FaultInjection import FaultInjector
+from FaultInjection import constant
+from FaultInjection import uniform
+
+class Entity(ndb.Model):
+  count = ndb.IntegerProperty(default=0)
+
+@ndb.transactional
+def increment(key):
+  entity = key.get() or Entity(key=key)
+  entity.count += 1
+  entity.put()
+
+class TestFaultInjection(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_datastore_v3_stub()
+    self.testbed.init_memcache_stub()
+    ndb.get_context().set_cache_policy(False)
+    ndb.get_context().set_memcache_policy(False)
+    ndb.get_context().clear_cache()
+    self.key = ndb.Key(Entity, 'entity')
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def test_conflicts(self):
+    with FaultInjector(conflict_probability=1).install() as injector:
+      self.assertRaises(datastore_errors.TransactionFailedError,
+                        increment, self.key)
+    # Every retry conflicted and nothing was applied
+    self.assertTrue(injector.stats['conflicts'] > 1)
+    self.assertEqual(self.key.get(), None)
+    increment(self.key)
+    self.assertEqual(self.key.get().count, 1)
+
+  def test_evictions(self):
+    memcache.set('key', 1)
+    with FaultInjector(eviction_probability=1).install([MEMCACHE]) as injector:
+      self.assertEqual(memcache.get('key'), None)
+      memcache.set('key', 1)
+      self.assertEqual(memcache.incr('key'), None)
+    self.assertEqual(injector.stats['evictions'], 2)
+
+  def test_errors(self):
+    memcache.set('key', 1)
+    with FaultInjector(error_probability=1).install() as injector:
+      self.assertRaises(datastore_errors.Timeout, Entity(key=self.key).put)
+      # The memcache API reports failures as misses
+      self.assertEqual(memcache.get('key'), None)
+      self.assertFalse(memcache.set('key', 2))
+    self.assertEqual(injector.stats['errors'], 3)
+    self.assertEqual(memcache.get('key'), 1)
+
+  def test_latency(self):
+    latency = {DATASTORE: constant(0.01), MEMCACHE: uniform(0, 0.001)}
+    with FaultInjector(latency=latency).install() as injector:
+      increment(self.key)
+      memcache.get('key')
+    calls = injector.stats['calls']
+    self.assertTrue(calls > 2)
+    self.assertTrue(0.01 * (calls - 1) <= injector.stats['delay'] <=
+                    0.01 * calls)
+    self.assertEqual(self.key.get().count, 1)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,38 @@
+import os
+import unittest
+from ImportTime import measure_import
+
+# Seconds a fresh import may take. Counter modules pay for the App Engine APIs.
+# Only meant to catch gross regressions (what gets loaded is checked exactly),
+# IMPORT_BUDGET_SCALE scales them on slow machines
+IMPORT_BUDGETS = {
+    'counters': 0.5,
+    'counters.CounterMetrics': 1.0,
+    'counters.CounterBackends': 5.0,
+}
+BUDGET_SCALE = float(os.environ.get('IMPORT_BUDGET_SCALE', 1.0))
+# Modules only some cron jobs need, never loaded by the request path
+HEAVY_MODULES = ('numpy', 'matplotlib')
+
+class TestImportTime(unittest.TestCase):
+
+  def test_package_is_lazy(self):
+    dummy, loaded = measure_import('counters', repeat=1)
+    self.assertFalse([name for name in loaded
+                      if name.startswith('google.appengine')])
+    self.assertFalse([name for name in loaded
+                      if name.startswith('counters.')])
+
+  def test_request_path_is_light(self):
+    dummy, loaded = measure_import('counters.CounterBackends', repeat=1)
+    for heavy in HEAVY_MODULES:
+      self.assertNotIn(heavy, loaded)
+
+  def test_budgets(self):
+    for module, budget in IMPORT_BUDGETS.iteritems():
+      seconds, dummy = measure_import(module)
+      self.assertLess(seconds, budget * BUDGET_SCALE,
+                      '%s took %.3fs' % (module, seconds))
+
+if __name__ == '__main__':
+  unittest.main()
@@ -1,4 +1,5 @@
 import unittest
+import functools
 import random
 import time
 from threading import Event
@@ -8,6 +9,7 @@ from google.appengine.datastore import datastore_stub_util
 from google.appengine.api import datastore_errors
 from google.appengine.ext import ndb
 from google.appengine.api import memcache
+import IncrementOnlyCounter as IOC_MODULE
 from IncrementOnlyCounter import IncrementOnlyCounter as IOC
 
 # Increment Test Constants
@@ -243,6 +245,150 @@ class TestIncrementOnlyTest(unittest.TestCase):
     self.assertEqual(len(idempotent_counter.get_all_tx_logs()), 0)
     self.assertEqual(len(highly_sharded_counter.get_all_tx_logs()), 0)
 
+  def test_increment_batch(self):
+    value = IOC.get(self.idempotent_key, force_fetch=True)
+    entries = [('batch-%d' % i, i) for i in range(60)]
+    status = IOC.increment_batch(self.idempotent_key, entries)
+    self.assertEqual(set(status.values()), set([IOC_MODULE.APPLIED]))
+    value += sum(delta for _, delta in entries)
+    self.assertEqual(IOC.get(self.idempotent_key, force_fetch=True), value)
+
+    # Replaying the batch must not change the counter
+    status = IOC.increment_batch(self.idempotent_key, entries[:30])
+    self.assertEqual(set(status.values()), set([IOC_MODULE.DUPLICATE]))
+    self.assertEqual(IOC.get(self.idempotent_key, force_fetch=True), value)
+
+    status = IOC.increment_batch('dummy', [('batch-dummy', 1)])
+    self.assertEqual(status, {'batch-dummy': IOC_MODULE.NOT_FOUND})
+
+  def test_sparse_read(self):
+    counter = IOC(num_shards=50, max_shards=50, id='sparse_counter',
+                  shards_tracked=True)
+    counter.put()
+    self.assertTrue(counter.shards_tracked)
+    self.assertEqual(len(counter._get_existing_shard_keys()), 0)
+    for _ in range(INCREMENT_STEPS):
+      IOC.increment('sparse_counter', INCREMENT_VALUE)
+
+    counter = ndb.Key(IOC, 'sparse_counter').get()
+    self.assertLessEqual(len(counter._get_existing_shard_keys()),
+                         INCREMENT_STEPS)
+    expected_val = INCREMENT_STEPS * INCREMENT_VALUE
+    self.assertEqual(counter.count, expected_val)
+    self.assertEqual(IOC.get('sparse_counter', force_fetch=True,
+                             eventual=True), expected_val)
+
+  def test_track_shards(self):
+    # Counter written before shards were tracked. Putting it again with
+    # new settings must not start trusting its empty bitmap
+    counter = IOC(num_shards=4, id='legacy_counter')
+    counter.put()
+    counter = IOC(num_shards=4, max_shards=8, id='legacy_counter')
+    counter.put()
+    IOC_MODULE.IncrementOnlyShard(id=counter._format_shard_key(2),
+                                  count=7).put()
+    self.assertEqual(len(counter._get_existing_shard_keys()), 4)
+
+    self.assertTrue(IOC.track_shards('legacy_counter'))
+    counter = ndb.Key(IOC, 'legacy_counter').get()
+    self.assertTrue(counter.shards_tracked)
+    self.assertEqual(counter._get_existing_shard_keys(),
+                     [counter._get_shard_key(2)])
+    self.assertEqual(counter.count, 7)
+    self.assertIsNone(IOC.track_shards('dummy'))
+
+  def test_minify_state(self):
+    IOC(num_shards=8, max_shards=8, id='minify_state_counter').put()
+    for _ in range(INCREMENT_STEPS):
+      IOC.increment('minify_state_counter', INCREMENT_VALUE)
+    expected_val = INCREMENT_STEPS * INCREMENT_VALUE
+
+    # Interrupted minify: increments avoid the shards being merged
+    counter = IOC._begin_minify('minify_state_counter')
+    self.assertEqual(counter.state, IOC.MINIFYING)
+    self.assertEqual(counter.writable_shards, 4)
+    self.assertFalse(IOC.expand_shards('minify_state_counter'))
+    self.assertFalse(IOC.reset('minify_state_counter'))
+    attempted = []
+    for _ in range(INCREMENT_STEPS):
+      IOC._with_recorded_shard('minify_state_counter', functools.partial(
+          IOC._increment_normal, 'minify_state_counter', 1, attempted))
+    self.assertTrue(all(index < 4 for index in attempted))
+    expected_val += INCREMENT_STEPS
+    self.assertEqual(IOC.get('minify_state_counter', force_fetch=True),
+                     expected_val)
+
+    self.assertEqual(IOC.resume_all(), 1)
+    counter = ndb.Key(IOC, 'minify_state_counter').get()
+    self.assertEqual(counter.state, IOC.READ_WRITE)
+    self.assertEqual(counter.num_shards, 5)
+    self.assertEqual(counter.count, expected_val)
+
+  def test_reset(self):
+    IOC(num_shards=30, max_shards=30, id='reset_counter',
+        shards_tracked=True).put()
+    for _ in range(INCREMENT_STEPS):
+      IOC.increment('reset_counter', INCREMENT_VALUE)
+    self.assertEqual(IOC.get('reset_counter'),
+                     INCREMENT_STEPS * INCREMENT_VALUE)
+
+    # Reads 0 right away, increments only go to drained shards
+    self.assertTrue(IOC.reset('reset_counter', wait=False))
+    self.assertEqual(IOC.get('reset_counter'), 0)
+    IOC.increment('reset_counter', INCREMENT_VALUE)
+    counter = ndb.Key(IOC, 'reset_counter').get()
+    self.assertEqual(counter.state, IOC.RESET)
+    self.assertEqual(counter._get_existing_shard_keys(),
+                     [counter._get_shard_key(0)])
+    self.assertEqual(counter.count, INCREMENT_VALUE)
+
+    # Draining takes two steps of at most 24 shards
+    self.assertTrue(IOC.drain('reset_counter'))
+    counter = ndb.Key(IOC, 'reset_counter').get()
+    self.assertEqual(counter.state, IOC.READ_WRITE)
+    self.assertEqual(counter.count, INCREMENT_VALUE)
+    self.assertTrue(IOC.reset('reset_counter'))
+    self.assertEqual(IOC.get('reset_counter', force_fetch=True), 0)
+    self.assertIsNone(IOC.reset('dummy'))
+
+  def test_set(self):
+    names = ['set_counter_%d' % i for i in range(3)]
+    ndb.put_multi([IOC(num_shards=30, max_shards=30, id=name)
+                   for name in names])
+    for name in names:
+      IOC.increment(name, INCREMENT_VALUE)
+    self.assertEqual(IOC.set_multi(dict.fromkeys(names, 7)),
+                     dict.fromkeys(names, True))
+    self.assertEqual(IOC.get_multi(names), dict.fromkeys(names, 7))
+    self.assertTrue(IOC.set(names[0], 3, wait=False))
+    IOC.increment(names[0], 1)
+    self.assertEqual(IOC.get(names[0]), 4)
+    self.assertEqual(IOC.reset_multi(names + ['dummy']),
+                     dict(dict.fromkeys(names, True), dummy=None))
+    self.assertEqual(IOC.get_multi(names), dict.fromkeys(names, 0))
+
+  def test_delete(self):
+    names = ['delete_counter_%d' % i for i in range(2)]
+    ndb.put_multi([IOC(num_shards=4, max_shards=4, id=name)
+                   for name in names])
+    for name in names:
+      for _ in range(INCREMENT_STEPS):
+        IOC.increment(name, INCREMENT_VALUE, idempotency=True)
+    counter = ndb.Key(IOC, names[0]).get()
+
+    # Paused after a few logs, the counter reads as missing meanwhile
+    self.assertFalse(IOC.delete(names[0], max_logs=2))
+    self.assertIsNone(IOC.get(names[0], force_fetch=True))
+    self.assertIsNone(IOC.increment(names[0]))
+    self.assertFalse(IOC.reset(names[0]))
+    self.assertEqual(len(counter.get_all_tx_logs()), INCREMENT_STEPS - 2)
+
+    self.assertEqual(IOC.delete_multi(names + ['dummy']),
+                     {names[0]: True, names[1]: True, 'dummy': None})
+    self.assertEqual(counter.get_all_tx_logs(), [])
+    self.assertFalse(any(ndb.get_multi(counter._get_all_shard_keys())))
+    self.assertEqual(IOC.get_multi(names), dict.fromkeys(names))
+
   def threadproc(self, idx, results):
     '''This function is executed by each thread.'''
     no_of_req = 0
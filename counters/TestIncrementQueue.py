@@ -0,0 +1,89 @@
+import unittest
+from google.appengine.ext import testbed
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from IncrementOnlyCounter import IncrementOnlyCounter as IOC
+from IncrementQueue import IncrementQueue
+from IncrementQueue import LocalQueue
+
+INCREMENT_STEPS = 50
+INCREMENT_VALUE = 3
+
+class TestIncrementQueue(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.testbed = testbed.Testbed()
+    cls.testbed.activate()
+    cls.policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+        probability=1)
+    cls.testbed.init_datastore_v3_stub(consistency_policy=cls.policy)
+    cls.testbed.init_memcache_stub()
+    ndb.get_context().set_cache_policy(False)
+    ndb.get_context().clear_cache()
+
+    cls.counter_key = 'queued_counter'
+    cls.other_key = 'other_queued_counter'
+    IOC(id=cls.counter_key).put()
+    IOC(id=cls.other_key).put()
+
+  def setUp(self):
+    self.local_queue = LocalQueue()
+    self.queue = IncrementQueue(self.local_queue)
+
+  def test_enqueue_and_process(self):
+    value = IOC.get(self.counter_key, force_fetch=True)
+    other_value = IOC.get(self.other_key, force_fetch=True)
+    for _ in range(INCREMENT_STEPS):
+      IOC.increment(self.counter_key, INCREMENT_VALUE, queue=self.queue)
+      self.queue.enqueue(self.other_key)
+
+    # Nothing is applied before a worker runs
+    self.assertEqual(IOC.get(self.counter_key, force_fetch=True), value)
+    self.assertEqual(self.local_queue.size(), 2 * INCREMENT_STEPS)
+
+    name, applied, failed = self.queue.process()
+    self.assertEqual(name, self.counter_key)
+    self.assertEqual((applied, failed), (INCREMENT_STEPS, 0))
+    self.assertEqual(IOC.get(self.counter_key, force_fetch=True),
+                     value + INCREMENT_STEPS * INCREMENT_VALUE)
+
+    self.assertEqual(self.queue.process_all(), INCREMENT_STEPS)
+    self.assertEqual(self.local_queue.size(), 0)
+    self.assertEqual(IOC.get(self.other_key, force_fetch=True),
+                     other_value + INCREMENT_STEPS)
+
+  def test_idempotency(self):
+    value = IOC.get(self.counter_key, force_fetch=True)
+    request_id = self.queue.enqueue(self.counter_key, 5)
+    self.assertEqual(self.queue.enqueue(self.counter_key, 5, request_id),
+                     request_id)
+    self.assertEqual(self.local_queue.size(), 1)
+    self.queue.process_all()
+
+    # A worker re-applying an already applied task must not count it again
+    self.local_queue = LocalQueue()
+    self.queue = IncrementQueue(self.local_queue)
+    self.queue.enqueue(self.counter_key, 5, request_id)
+    self.queue.process_all()
+    self.assertEqual(IOC.get(self.counter_key, force_fetch=True), value + 5)
+
+  def test_fallback_after_commit(self):
+    value = IOC.get(self.counter_key, force_fetch=True)
+    # The increment was committed but reported as failed to the caller, who
+    # hands it over to the queue with the same request id
+    IOC.increment(self.counter_key, 4, request_id='committed-request')
+    self.queue.enqueue(self.counter_key, 4, 'committed-request')
+    self.queue.process_all()
+    self.assertEqual(self.local_queue.size(), 0)
+    self.assertEqual(IOC.get(self.counter_key, force_fetch=True), value + 4)
+    self.assertIsNone(IOC.increment(self.counter_key, 4,
+                                    request_id='committed-request'))
+
+  def test_empty_queue(self):
+    self.assertEqual(self.queue.process(), (None, 0, 0))
+    self.assertEqual(self.queue.process_all(), 0)
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.testbed.deactivate()
@@ -99,6 +99,22 @@ class TestMemcacheCounter(unittest.TestCase):
     for counter_name in self.counter_name_list:
       self.assertFalse(MC.exist(counter_name))
 
+  def test_increment_multi(self):
+    names = ['multi-1', 'multi-2', 'multi-3']
+    expected_val = MC.get_multi(names)
+    deltas = {'multi-1': INCREMENT_VALUE, 'multi-2': -INCREMENT_VALUE,
+              'multi-3': 1}
+    values = MC.increment_multi(deltas, persist_delay=1000)
+    for name in names:
+      expected_val[name] += deltas[name]
+    self.assertDictEqual(expected_val, values)
+    self.assertDictEqual(expected_val, MC.get_multi(names))
+
+    # The first increment persists every counter
+    memcache.flush_all()
+    self.assertDictEqual(expected_val, MC.get_multi(names))
+    self.assertDictEqual({}, MC.increment_multi({}))
+
   def test_set_reset(self):
 
     # Setting the counter to a particular value
@@ -0,0 +1,87 @@
+import unittest
+import multiprocessing
+import os
+import shutil
+import tempfile
+from threading import Thread
+from MmapCounter import MmapCounter
+
+NUM_PROCESSES = 4
+NUM_THREADS = 4
+INCREMENT_STEPS = 500
+
+def increment_worker(path, name, steps):
+  with MmapCounter(path) as store:
+    for _ in range(steps):
+      store.increment(name)
+
+class TestMmapCounter(unittest.TestCase):
+
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.path = os.path.join(self.directory, 'counters.bin')
+    self.store = MmapCounter(self.path, capacity=16, shards=4)
+
+  def tearDown(self):
+    self.store.close()
+    shutil.rmtree(self.directory)
+
+  def test_increment(self):
+    self.assertEqual(self.store.get('a'), 0)
+    self.assertIsNone(self.store.get('a', default=None))
+    self.store.increment('a', 5)
+    self.store.incr('a')
+    self.store.increment(u'b', -2)
+    self.assertEqual(self.store.get('a'), 6)
+    self.assertEqual(self.store.get_multi(['a', 'b', 'c']),
+                     {'a': 6, 'b': -2, 'c': 0})
+    self.assertTrue(self.store.reset('a'))
+    self.assertFalse(self.store.reset('c'))
+    self.assertEqual(self.store.get('a'), 0)
+    self.assertRaises(ValueError, self.store.increment, '')
+    self.assertRaises(ValueError, self.store.increment, 'x' * 65)
+
+  def test_reopen(self):
+    self.store.increment('a', 3)
+    with MmapCounter(self.path, capacity=1024) as store:
+      self.assertEqual(store.capacity, 16)
+      self.assertEqual(store.shards, 4)
+      self.assertEqual(store.get('a'), 3)
+      store.increment('a')
+    self.assertEqual(self.store.get('a'), 4)
+
+    # Closing one instance keeps the file (and its locks) of the others
+    store = MmapCounter(self.path)
+    store.close()
+    store.close()
+    self.store.increment('a')
+    self.assertEqual(self.store.get('a'), 5)
+
+    other = os.path.join(self.directory, 'other.bin')
+    with open(other, 'w') as stream:
+      stream.write('x' * 64)
+    self.assertRaises(ValueError, MmapCounter, other)
+
+  def test_full(self):
+    for i in range(16):
+      self.store.increment('counter-%d' % i)
+    self.assertRaises(ValueError, self.store.increment, 'one-too-many')
+    self.assertEqual(self.store.get('counter-7'), 1)
+
+  def test_concurrent_increment(self):
+    processes = [multiprocessing.Process(target=increment_worker,
+                                         args=(self.path, 'hot',
+                                               INCREMENT_STEPS))
+                 for _ in range(NUM_PROCESSES)]
+    threads = [Thread(target=lambda: [self.store.increment('hot')
+                                      for _ in range(INCREMENT_STEPS)])
+               for _ in range(NUM_THREADS)]
+    for worker in processes + threads:
+      worker.start()
+    for worker in processes + threads:
+      worker.join()
+    self.assertEqual(self.store.get('hot'),
+                     (NUM_PROCESSES + NUM_THREADS) * INCREMENT_STEPS)
+
+if __name__ == '__main__':
+  unittest.main()
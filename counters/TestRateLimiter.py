@@ -0,0 +1,68 @@
+import unittest
+from google.appengine.ext import testbed
+from google.appengine.api import memcache
+import RateLimiter as LIMITER_MODULE
+from RateLimiter import FixedWindowLimiter
+from RateLimiter import SlidingWindowLimiter
+from RateLimiter import TokenBucketLimiter
+
+LIMIT = 5
+
+class TestRateLimiter(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.testbed.init_memcache_stub()
+    # No datastore stub: limiters must never touch datastore
+    self.now = 1000.0
+    self.time = LIMITER_MODULE.time.time
+    LIMITER_MODULE.time.time = lambda: self.now
+
+  def tearDown(self):
+    LIMITER_MODULE.time.time = self.time
+    self.testbed.deactivate()
+
+  def test_fixed_window(self):
+    limiter = FixedWindowLimiter(LIMIT, 10, fast_reject=False)
+    decisions = [limiter.check('user') for dummy in range(LIMIT + 1)]
+    self.assertEqual([d.allowed for d in decisions],
+                     [True] * LIMIT + [False])
+    self.assertEqual(decisions[0].remaining, LIMIT - 1)
+    self.assertEqual(decisions[-1].retry_after, 10)
+    self.assertTrue(limiter.allow('other-user'))
+    self.now += 10
+    self.assertTrue(limiter.allow('user'))
+
+  def test_sliding_window(self):
+    limiter = SlidingWindowLimiter(LIMIT, 10, fast_reject=False)
+    for dummy in range(LIMIT):
+      self.assertTrue(limiter.allow('user'))
+    # Half of the previous window still counts
+    self.now += 15
+    allowed = [limiter.allow('user') for dummy in range(LIMIT)]
+    self.assertEqual(allowed.count(True), 2)
+    # Rejected requests are not counted
+    self.now += 10
+    self.assertTrue(limiter.allow('user'))
+
+  def test_token_bucket(self):
+    limiter = TokenBucketLimiter(rate=1, capacity=LIMIT)
+    self.assertTrue(limiter.allow('user', LIMIT))
+    decision = limiter.check('user', 2)
+    self.assertFalse(decision.allowed)
+    self.assertEqual(decision.retry_after, 2)
+    self.now += 2
+    self.assertTrue(limiter.allow('user', 2))
+    self.assertFalse(limiter.allow('user'))
+
+  def test_multi_and_fast_reject(self):
+    limiter = FixedWindowLimiter(1, 10)
+    decisions = limiter.check_multi(['user', 'ip'])
+    self.assertTrue(all(d.allowed for d in decisions.values()))
+    self.assertFalse(limiter.allow_all(['user', 'new-ip']))
+    # Throttled keys are rejected in process until the window is over
+    memcache.flush_all()
+    self.assertFalse(limiter.allow('user'))
+    self.now += 10
+    self.assertTrue(limiter.allow('user'))
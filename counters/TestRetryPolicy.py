@@ -0,0 +1,102 @@
+import unittest
+import functools
+import time
+from google.appengine.ext import testbed
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.api import datastore_errors
+from FaultInjection import FaultInjector
+from IncrementOnlyCounter import IncrementOnlyCounter as IOC
+from IncrementQueue import IncrementQueue
+from IncrementQueue import LocalQueue
+from RetryPolicy import CircuitBreaker
+from RetryPolicy import RetryPolicy
+
+class TestRetryPolicy(unittest.TestCase):
+
+  @classmethod
+  def setUpClass(cls):
+    cls.testbed = testbed.Testbed()
+    cls.testbed.activate()
+    cls.policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+        probability=1)
+    cls.testbed.init_datastore_v3_stub(consistency_policy=cls.policy)
+    cls.testbed.init_memcache_stub()
+    ndb.get_context().set_cache_policy(False)
+    ndb.get_context().clear_cache()
+
+    cls.counter_key = 'retry_counter'
+    IOC(id=cls.counter_key, num_shards=4, max_shards=4).put()
+
+  def test_attempts(self):
+    policy = RetryPolicy(deadline=10, base_delay=0.01, max_delay=0.05,
+                         max_attempts=20)
+    sleeps = list(policy.attempts())
+    self.assertEqual(len(sleeps), 20)
+    self.assertEqual(sleeps[0], 0)
+    for sleep in sleeps[1:]:
+      self.assertGreaterEqual(sleep, 0.01)
+      self.assertLessEqual(sleep, 0.05)
+
+    # The deadline stops the retries before max_attempts
+    policy = RetryPolicy(deadline=0.05, base_delay=0.02, max_delay=0.02)
+    start = time.time()
+    attempts = 0
+    for sleep in policy.attempts():
+      time.sleep(sleep)
+      attempts += 1
+    self.assertLess(time.time() - start, 0.1)
+    self.assertLessEqual(attempts, 3)
+
+  def test_shard_reselection(self):
+    attempted = []
+    increment = functools.partial(IOC._increment_normal, self.counter_key, 1,
+                                  attempted)
+    for _ in range(4):
+      IOC._with_recorded_shard(self.counter_key, increment)
+    self.assertEqual(sorted(attempted), [0, 1, 2, 3])
+    # Once every shard was tried any shard may be picked again
+    IOC._with_recorded_shard(self.counter_key, increment)
+    self.assertEqual(len(attempted), 5)
+
+  def test_non_idempotent(self):
+    # A failed commit may have been applied, so increments without
+    # idempotency are only retried when the policy allows it
+    conflicts = []
+    for retry in (False, True):
+      policy = RetryPolicy(deadline=10, base_delay=0, max_delay=0,
+                           max_attempts=3, expand_shards=False,
+                           retry_non_idempotent=retry)
+      with FaultInjector(conflict_probability=1).install() as injector:
+        self.assertRaises(datastore_errors.TransactionFailedError,
+                          IOC.increment, self.counter_key, 1,
+                          retry_policy=policy)
+      conflicts.append(injector.stats['conflicts'])
+    self.assertEqual(conflicts[1], 3 * conflicts[0])
+
+  def test_circuit_breaker(self):
+    local_queue = LocalQueue()
+    breaker = CircuitBreaker(IncrementQueue(local_queue), threshold=3,
+                             window=10, cooldown=0.2)
+    policy = RetryPolicy(breaker=breaker)
+    value = IOC.get(self.counter_key, force_fetch=True)
+
+    for _ in range(3):
+      breaker.record_failure(self.counter_key)
+    self.assertFalse(breaker.allow(self.counter_key))
+    IOC.increment(self.counter_key, 5, True, retry_policy=policy)
+    self.assertEqual(local_queue.size(), 1)
+    self.assertEqual(IOC.get(self.counter_key, force_fetch=True), value)
+
+    # After the cooldown increments are applied directly again
+    time.sleep(0.2)
+    self.assertTrue(breaker.allow(self.counter_key))
+    IOC.increment(self.counter_key, 5, True, retry_policy=policy)
+    self.assertEqual(IOC.get(self.counter_key, force_fetch=True), value + 5)
+
+    IncrementQueue(local_queue).process_all()
+    self.assertEqual(IOC.get(self.counter_key, force_fetch=True), value + 10)
+
+  @classmethod
+  def tearDownClass(cls):
+    cls.testbed.deactivate()
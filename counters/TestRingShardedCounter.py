@@ -0,0 +1,104 @@
+import random
+import unittest
+from google.appengine.ext import testbed
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from RingShardedCounter import RingShardedCounter as RSC
+from RingShardedCounter import ShardRing
+
+INCREMENT_STEPS = 40
+NUM_TOKENS = 2000
+
+class TestRingShardedCounter(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+        probability=1)
+    self.testbed.init_datastore_v3_stub(consistency_policy=self.policy)
+    self.testbed.init_memcache_stub()
+    ndb.get_context().set_cache_policy(False)
+    ndb.get_context().clear_cache()
+    RSC(id='ring', num_shards=4, max_shards=6).put()
+
+  def tearDown(self):
+    self.testbed.deactivate()
+
+  def test_ring(self):
+    tokens = [random.getrandbits(64) for dummy in range(NUM_TOKENS)]
+    ring = ShardRing(range(4))
+    owners = [ring.lookup(token) for token in tokens]
+    self.assertEqual(set(owners), set(range(4)))
+    # Adding a shard only moves tokens to the new shard
+    grown = ShardRing(range(5))
+    moved = [(old, grown.lookup(token))
+             for old, token in zip(owners, tokens)
+             if grown.lookup(token) != old]
+    self.assertTrue(all(new == 4 for _, new in moved))
+    self.assertTrue(0 < len(moved) < NUM_TOKENS / 2)
+    # The successor of a removed shard is what took over its points
+    self.assertTrue(ring.successor(4) in range(4))
+    self.assertEqual(ShardRing([]).lookup(1), None)
+
+  def test_expand_and_shrink(self):
+    for dummy in range(INCREMENT_STEPS):
+      RSC.increment('ring')
+    self.assertEqual(RSC.get('ring', force_fetch=True), INCREMENT_STEPS)
+
+    # Grows one shard at a time up to max_shards
+    self.assertTrue(RSC.expand_shards('ring'))
+    self.assertTrue(RSC.expand_shards('ring'))
+    self.assertFalse(RSC.expand_shards('ring'))
+    counter = ndb.Key(RSC, 'ring').get()
+    self.assertEqual(counter.members, range(6))
+    self.assertEqual(counter.num_shards, 6)
+
+    # A removed shard stops receiving writes but is still read
+    self.assertTrue(RSC.shrink_shards('ring'))
+    counter = ndb.Key(RSC, 'ring').get()
+    self.assertEqual(counter.draining, [5])
+    self.assertEqual(len(counter._get_shard_keys()), 6)
+    for dummy in range(INCREMENT_STEPS):
+      self.assertNotEqual(counter.ring.random_member(), 5)
+      RSC.increment('ring', idempotency=True)
+    self.assertEqual(RSC.get('ring', force_fetch=True), 2 * INCREMENT_STEPS)
+
+    self.assertEqual(RSC.merge_all(), 1)
+    counter = ndb.Key(RSC, 'ring').get()
+    self.assertEqual(counter.draining, [])
+    self.assertEqual(counter._get_shard_keys()[-1],
+                     counter._get_shard_key(4))
+    self.assertEqual(RSC.get('ring', force_fetch=True), 2 * INCREMENT_STEPS)
+
+    # minify removes and merges a single shard
+    while RSC.minify('ring'):
+      pass
+    counter = ndb.Key(RSC, 'ring').get()
+    self.assertEqual(counter.members, [0])
+    self.assertEqual(counter.draining, [])
+    shards = [shard for shard in counter._get_shards() if shard]
+    self.assertEqual([shard.count for shard in shards], [2 * INCREMENT_STEPS])
+    self.assertEqual(RSC.minify('ring'), False)
+    self.assertEqual(RSC.minify('missing'), None)
+
+  def test_deleting(self):
+    # The ring of a counter being deleted is left alone
+    RSC._begin_delete_async('ring').get_result()
+    self.assertFalse(RSC.expand_shards('ring'))
+    self.assertFalse(RSC.shrink_shards('ring'))
+    counter = ndb.Key(RSC, 'ring').get()
+    self.assertEqual(counter.ring_members, range(4))
+    self.assertEqual(counter.draining, [])
+
+  def test_set(self):
+    # Ring sharded counters refuse to be set, without raising
+    RSC.increment('ring', 3)
+    self.assertFalse(RSC.reset('ring'))
+    self.assertFalse(RSC.set('ring', 5))
+    self.assertEqual(RSC.reset_multi(['ring', 'missing']),
+                     {'ring': False, 'missing': None})
+    self.assertEqual(RSC.get('ring', force_fetch=True), 3)
+
+if __name__ == '__main__':
+  unittest.main()
@@ -0,0 +1,69 @@
+import unittest
+from google.appengine.ext import testbed
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.api import memcache
+import RollupCounter as ROLLUP_MODULE
+from RollupCounter import RollupCounter
+from RollupCounter import split_path
+
+LEAVES = {
+    'emea/de/berlin': 3,
+    'emea/de/munich': 5,
+    'emea/fr/paris': 7,
+    'amer/us/nyc': 11,
+}
+
+class TestRollupCounter(unittest.TestCase):
+
+  def setUp(self):
+    self.testbed = testbed.Testbed()
+    self.testbed.activate()
+    self.policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+        probability=1)
+    self.testbed.init_datastore_v3_stub(consistency_policy=self.policy)
+    self.testbed.init_memcache_stub()
+    ndb.get_context().set_cache_policy(False)
+    ndb.get_context().clear_cache()
+    memcache.flush_all()
+    self.page_size = ROLLUP_MODULE.PAGE_SIZE
+    ROLLUP_MODULE.PAGE_SIZE = 2
+    for path, delta in LEAVES.iteritems():
+      RollupCounter.increment(path, delta)
+
+  def test_split_path(self):
+    self.assertEqual(split_path('emea/de/berlin'), ['emea', 'emea/de'])
+    self.assertEqual(split_path('emea'), [])
+
+  def test_exact_reads(self):
+    values = RollupCounter.get_multi(['emea', 'emea/de', 'emea/de/berlin',
+                                      'apac'])
+    self.assertDictEqual(values, {'emea': 15, 'emea/de': 8,
+                                  'emea/de/berlin': 3, 'apac': 0})
+
+  def test_rollup(self):
+    totals = RollupCounter.rollup()
+    self.assertDictEqual(totals, {'emea': 15, 'emea/de': 8, 'emea/fr': 7,
+                                  'amer': 11, 'amer/us': 11})
+    RollupCounter.increment('emea/de/berlin', 10)
+    # Parents are updated lazily, leaves immediately
+    self.assertEqual(RollupCounter.get('emea'), 15)
+    self.assertEqual(RollupCounter.get('emea', exact=True), 25)
+    self.assertEqual(RollupCounter.get('emea/de/berlin'), 13)
+
+    self.assertDictEqual(RollupCounter.rollup('emea/de'), {'emea/de': 18})
+    self.assertEqual(RollupCounter.get('emea/de'), 18)
+    self.assertEqual(RollupCounter.get('emea'), 15)
+    RollupCounter.rollup()
+    self.assertEqual(RollupCounter.get('emea'), 25)
+
+  def test_parent_leaf(self):
+    # A path can be incremented and have children at the same time
+    RollupCounter.increment('emea/de', 100)
+    self.assertEqual(RollupCounter.get('emea/de', exact=True), 108)
+    self.assertEqual(RollupCounter.rollup()['emea/de'], 108)
+    self.assertEqual(RollupCounter.get('emea'), 115)
+
+  def tearDown(self):
+    ROLLUP_MODULE.PAGE_SIZE = self.page_size
+    self.testbed.deactivate()
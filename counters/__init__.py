@@ -0,0 +1,54 @@
+'''
+  Counter types and tools. Importing the package is cheap: a module (and the
+  App Engine APIs or numpy it needs) is only imported the first time one of
+  its components is loaded, which keeps instance cold starts short.
+
+    IOC = counters.load('sharded')
+    report = counters.load('audit')(repair=True).run()
+    counters.get_backend('memcache').increment('page-views')
+'''
+import importlib
+
+# Component name -> (module, attribute)
+REGISTRY = {
+    # Counter types, named like the CounterBackends types where they match
+    'sharded': ('IncrementOnlyCounter', 'IncrementOnlyCounter'),
+    'memcache': ('MemcacheCounter', 'MemcacheCounter'),
+    'dynamic': ('DynamicCounter', 'DynamicCounter'),
+    'bounded': ('BoundedCounter', 'BoundedCounter'),
+    'ring': ('RingShardedCounter', 'RingShardedCounter'),
+    'rollup': ('RollupCounter', 'RollupCounter'),
+    'counter': ('Counter', 'Counter'),
+    'mmap': ('MmapCounter', 'MmapCounter'),
+    # Tools
+    'audit': ('CounterAudit', 'CounterAudit'),
+    'batch': ('CounterBatch', 'CounterBatch'),
+    'dedupe': ('DedupeCache', 'DedupeCache'),
+    'history': ('CounterHistory', 'CounterHistory'),
+    'migrator': ('CounterMigration', 'CounterMigrator'),
+    'queue': ('IncrementQueue', 'IncrementQueue'),
+}
+
+_loaded = {}
+
+def load(name):
+  '''
+    Returns a registered component, importing its module on first use
+    Raises: ValueError if the name is not registered
+  '''
+  component = _loaded.get(name)
+  if component is None:
+    try:
+      module_name, attribute = REGISTRY[name]
+    except KeyError:
+      raise ValueError('Unknown counter component %r' % name)
+    module = importlib.import_module('.' + module_name, __name__)
+    component = _loaded[name] = getattr(module, attribute)
+  return component
+
+def get_backend(counter_type):
+  '''
+    Returns the CounterBackends adapter of a counter type
+  '''
+  return importlib.import_module('.CounterBackends', __name__).get_backend(
+      counter_type)
@@ -48,6 +48,7 @@ MIDDLEWARE_CLASSES = (
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'shard_app.middleware.CounterBatchMiddleware',
 )
 
 ROOT_URLCONF = 'hrd_sharded_counters.urls'
@@ -17,13 +17,35 @@ from django.conf.urls import include, url
 from django.contrib import admin
 from shard_app.views import minify_shard
 from shard_app.views import increment_counter
+from shard_app.views import increment_batch
 from shard_app.views import status
+from shard_app.views import status_multi
 from shard_app.views import minify_dynamic
+from shard_app.views import process_increments
+from shard_app.views import advance_migrations
+from shard_app.views import rebalance_counters
+from shard_app.views import audit_counters
+from shard_app.views import rollup_counters
+from shard_app.views import rebalance_bounded
+from shard_app.views import snapshot_counters
+from shard_app.views import merge_ring_shards
+from shard_app.views import purge_dedupe
 
 urlpatterns = [
     url(r'^admin/', include(admin.site.urls)),
     url(r'^cron/minify_shard/?$', minify_shard),
     url(r'^cron/minify_dynamic', minify_dynamic),
+    url(r'^cron/process_increments/?$', process_increments),
+    url(r'^cron/advance_migrations/?$', advance_migrations),
+    url(r'^cron/rebalance_counters/?$', rebalance_counters),
+    url(r'^cron/audit_counters/?$', audit_counters),
+    url(r'^cron/rollup_counters/?$', rollup_counters),
+    url(r'^cron/rebalance_bounded/?$', rebalance_bounded),
+    url(r'^cron/snapshot_counters/?$', snapshot_counters),
+    url(r'^cron/merge_ring_shards/?$', merge_ring_shards),
+    url(r'^cron/purge_dedupe/?$', purge_dedupe),
     url(r'^increment/?$', increment_counter),
+    url(r'^increment/batch/?$', increment_batch),
     url(r'^status/?$', status),
+    url(r'^status/multi/?$', status_multi),
 ]
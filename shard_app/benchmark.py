@@ -1,134 +1,271 @@
+'''
+  Analyzer for JMeter load test logs. The CSV files are streamed in chunks and
+  folded into fixed size per-window statistics (request count, successes,
+  latency sum and a log-scale latency histogram), so memory stays bounded no
+  matter how large the log is. Histograms of different chunks / files can be
+  merged by simple addition.
+
+  Usage:
+    python benchmark.py [--plot-dir DIR] [--show] label=path.csv ...
+'''
+import argparse
 import csv
-import matplotlib.pyplot as mpplt
-from matplotlib.font_manager import FontProperties
+import itertools
+import json
+import os
+import sys
+import numpy
 
-class GraphPlotter(object):
+WINDOW_MS = 120000 # Bucket size used to compute the request rate
+CHUNK_ROWS = 200000
+MIN_WINDOW_REQUESTS = 20 # Windows with less requests are ignored while plotting
+# Upper edges (ms) of the latency histogram buckets: 1 ms to 100 s, log scale
+LATENCY_EDGES = numpy.logspace(0, 5, 121)
+PERCENTILES = (50, 95, 99)
+DEFAULT_RUNS = (
+    ('Sharded Counter', 'load_test/data/sharded.csv'),
+    ('Unsharded Counter', 'load_test/data/unsharded.csv'),
+    ('Memcache Counter', 'load_test/data/memcache.csv'),
+)
+LINE_STYLES = (
+    {'linestyle': '-', 'dashes': [4, 4], 'color': 'green'},
+    {'linestyle': '-', 'color': 'red'},
+    {'linestyle': ':', 'color': 'blue'},
+    {'linestyle': '-.', 'color': 'black'},
+    {'linestyle': '--', 'color': 'magenta'},
+)
 
-  @classmethod
-  def read_csv(cls, filename):
+class WindowStats(object):
+  '''
+    Per-window aggregates of a load test. Rows of `totals` are
+    [requests, successes, latency sum], rows of `histograms` are latency bucket
+    counts. Both are indexed by the position of the window in `windows`.
+  '''
+
+  def __init__(self):
+    self.windows = numpy.zeros(0, dtype=numpy.int64)
+    self.totals = numpy.zeros((0, 3), dtype=numpy.int64)
+    self.histograms = numpy.zeros((0, len(LATENCY_EDGES) + 1),
+                                  dtype=numpy.int64)
+
+  def _rows_for(self, windows):
+    '''
+      Returns the row index of every window id, adding missing windows
+    '''
+    missing = numpy.setdiff1d(windows, self.windows)
+    if len(missing):
+      self.windows = numpy.concatenate((self.windows, missing))
+      order = numpy.argsort(self.windows)
+      self.windows = self.windows[order]
+      self.totals = numpy.vstack(
+          (self.totals, numpy.zeros((len(missing), 3), dtype=numpy.int64))
+      )[order]
+      self.histograms = numpy.vstack(
+          (self.histograms,
+           numpy.zeros((len(missing), self.histograms.shape[1]),
+                       dtype=numpy.int64))
+      )[order]
+    return numpy.searchsorted(self.windows, windows)
 
-    def process_row(row):
-      return [int(row[0]), int(row[1]), int(row[3])]
+  def add(self, timestamps, elapsed, success):
+    '''
+      Folds a chunk of requests into the window statistics
+      Args:
+        timestamps : numpy array of request start times (ms)
+        elapsed : numpy array of response times (ms)
+        success : boolean numpy array, True for HTTP 200 responses
+    '''
+    if not len(timestamps):
+      return
+    windows, inverse = numpy.unique(timestamps // WINDOW_MS,
+                                    return_inverse=True)
+    rows = self._rows_for(windows)[inverse]
+    numpy.add.at(self.totals[:, 0], rows, 1)
+    numpy.add.at(self.totals[:, 1], rows, success.astype(numpy.int64))
+    numpy.add.at(self.totals[:, 2], rows, elapsed)
+    buckets = numpy.searchsorted(LATENCY_EDGES, elapsed)
+    numpy.add.at(self.histograms, (rows, buckets), 1)
 
-    # Read Content from file
+  def merge(self, other):
+    rows = self._rows_for(other.windows)
+    self.totals[rows] += other.totals
+    self.histograms[rows] += other.histograms
+
+  def summary(self):
+    '''
+      Returns the overall statistics of the run as a dictionary
+    '''
+    requests, successes, latency = self.totals.sum(axis=0)
+    span = (len(self.windows) * WINDOW_MS) / 1000.0
+    result = {
+        'requests': int(requests),
+        'success_rate': 100.0 * successes / requests if requests else 0.0,
+        'throughput': requests / span if span else 0.0,
+        'mean_ms': float(latency) / requests if requests else 0.0,
+    }
+    overall = self.histograms.sum(axis=0)
+    for pct in PERCENTILES:
+      result['p%d_ms' % pct] = histogram_percentile(overall, pct)
+    return result
+
+  def load_curve(self):
+    '''
+      Groups windows by their request count and averages the success rate and
+      response time of each group. Windows with very few requests (ramp up /
+      ramp down) are skipped.
+      Returns : (requests per minute, success %, average response time) lists
+    '''
+    totals = self.totals[self.totals[:, 0] >= MIN_WINDOW_REQUESTS]
+    if not len(totals):
+      return [], [], []
+    loads, inverse = numpy.unique(totals[:, 0], return_inverse=True)
+    success = numpy.bincount(inverse, weights=totals[:, 1])
+    latency = numpy.bincount(inverse, weights=totals[:, 2])
+    requests = numpy.bincount(inverse, weights=totals[:, 0])
+    per_minute = loads * 60000.0 / WINDOW_MS
+    return (per_minute.tolist(), (success * 100.0 / requests).tolist(),
+            (latency / requests).tolist())
+
+def histogram_percentile(histogram, pct):
+  '''
+    Returns the upper edge of the latency bucket containing the percentile
+  '''
+  total = histogram.sum()
+  if not total:
+    return None
+  index = int(numpy.searchsorted(numpy.cumsum(histogram), pct * total / 100.0))
+  if index >= len(LATENCY_EDGES):
+    return float('inf')
+  return float(LATENCY_EDGES[index])
+
+class GraphPlotter(object):
+
+  @classmethod
+  def read_chunks(cls, filename, chunk_rows=CHUNK_ROWS):
+    '''
+      Streams a JMeter CSV log as numpy arrays of at most chunk_rows requests.
+      Yields : (timestamps, elapsed, success) tuples
+    '''
     with open(filename, 'r') as fstream:
       reader = csv.reader(fstream, quotechar='"')
-      data = [process_row(row) for row in reader if len(row) > 0]
-    return sorted(data, key=lambda x: x[0])
+      while True:
+        rows = list(itertools.islice(reader, chunk_rows))
+        if not rows:
+          break
+        stamps, elapsed, codes = [], [], []
+        for row in rows:
+          # Skips empty rows and the header line, if any
+          if len(row) < 4 or not row[0].isdigit():
+            continue
+          stamps.append(row[0])
+          elapsed.append(row[1])
+          codes.append(row[3])
+        yield (numpy.array(stamps, dtype=numpy.int64),
+               numpy.array(elapsed, dtype=numpy.int64),
+               numpy.array(codes) == '200')
 
   @classmethod
-  def process_minute(cls, minute):
-    zipped = zip(*minute)
-    return [len(minute), zipped[2].count(200), sum(zipped[1])]
+  def analyze(cls, filename, chunk_rows=CHUNK_ROWS):
+    '''
+      Returns the WindowStats of a JMeter CSV log
+    '''
+    stats = WindowStats()
+    for chunk in cls.read_chunks(filename, chunk_rows):
+      stats.add(*chunk)
+    return stats
 
   @classmethod
   def parse_jmeter_log(cls, filename):
-    # Each Request Data
-    req_list = cls.read_csv(filename)
-    req_list.sort(key=lambda x: x[0])
-    total_min = (((req_list[-1][0] - req_list[0][0]) / 120000) + 1)
-    minutes = [[] for i in range(total_min)]
-    for req in req_list:
-      minutes[(req[0] - req_list[0][0]) / 120000].append(req)
-
-    # Each Minute [no_of req, success, total_resp_time]
-    data = [cls.process_minute(i) for i in minutes if len(i) >= 20]
-    data.sort(key=lambda x: x[0])
-    final_data = []
-    i = 0
-
-    while i < len(data):
-      j = i
-      tmp = [0, 0, 0]
-      while j < len(data) and data[i][0] == data[j][0]:
-        tmp[0] += data[j][0]
-        tmp[1] += data[j][1]
-        tmp[2] += data[j][2]
-        j += 1
-      diff = j - i
-      tmp[0] = tmp[0] / diff
-      tmp[1] = (tmp[1] * 100.0) / (diff * tmp[0])
-      tmp[2] = float(tmp[2]) / (diff * tmp[0])
-      tmp[0] = tmp[0] / 2
-      i = j
-      final_data.append(tmp)
-    final_list = zip(*final_data)
-    return final_list
+    return cls.analyze(filename).load_curve()
 
   @classmethod
-  def plot_graphs(cls):
-    #Parsing Data from log File
-    sharded_test = cls.parse_jmeter_log('load_test/data/sharded.csv')
-    unsharded_test = cls.parse_jmeter_log('load_test/data/unsharded.csv')
-    memcache_test = cls.parse_jmeter_log('load_test/data/memcache.csv')
-
-    figure = mpplt.figure()
-    plt = figure.add_subplot(2, 1, 1)
-    plt.set_title("Average Response Time")
-    plt.plot(sharded_test[0], sharded_test[2], '-', dashes=[4, 4],
-             color='green', label='Sharded Counter')
-    plt.plot(unsharded_test[0], unsharded_test[2], color='red',
-             label='Unsharded Counter')
-    plt.plot(memcache_test[0], memcache_test[2], '.', dashes=[4, 4, 4],
-             color='blue', label='Memcache Counter')
-    plt.legend()
-    plt.set_xlabel('Request Rate / Min')
-    plt.set_ylabel('Response Time (ms)')
-
-    plt = figure.add_subplot(2, 1, 2)
-    plt.set_title("Transaction Success Rate")
-    plt.plot(sharded_test[0], sharded_test[1], '-', dashes=[4, 4],
-             color='green', label='Sharded Counter')
-    plt.plot(unsharded_test[0], unsharded_test[1], color='red',
-             label='Unsharded Counter')
-    plt.plot(memcache_test[0], memcache_test[1], '.', dashes=[4, 4, 4],
-             color='blue', label='Memcache Counter')
-    plt.legend()
-    plt.set_xlabel("Request Rate / Min")
-    plt.set_ylabel('% of requests succeeded')
-
-    mpplt.show()
-
-    # Only for saving to file
-    figure = mpplt.figure()
-    plt = figure.add_subplot(1, 1, 1)
-    plt.set_title("Average Response Time")
-    plt.plot(sharded_test[0], sharded_test[2], '-', dashes=[4, 4],
-             color='green', label='Sharded Counter')
-    plt.plot(unsharded_test[0], unsharded_test[2], color='red',
-             label='Unsharded  Counter')
-    plt.plot(memcache_test[0], memcache_test[2], '.', dashes=[4, 4, 4],
-             color='blue', label='Memcache Counter')
-    plt.set_xlabel('Request Rate / Min')
-    plt.set_ylabel('Response Time (ms)')
-    box = plt.get_position()
-    plt.set_position([box.x0, box.y0 + box.height * 0.1, box.width,
-                      box.height * 0.9])
-    font = FontProperties()
-    font.set_size('small')
-    plt.legend(loc='upper center', bbox_to_anchor=(0.5, -0.1),
-               fancybox=True, shadow=True, ncol=5, prop=font)
-    figure.savefig('avg_resp_time.pdf', facecolor='white', edgecolor='black')
-
-    figure.clf()
-    plt = figure.add_subplot(1, 1, 1)
-    plt.set_ylim([0, 110])
-    plt.set_title("Transaction Success Rate")
-    plt.plot(unsharded_test[0], unsharded_test[1], '-', dashes=[4, 4],
-             color='green', label='Sharded Counter')
-    plt.plot(sharded_test[0], sharded_test[1], color='red',
-             label='Unsharded Counter')
-    plt.plot(memcache_test[0], memcache_test[1], '.', dashes=[4, 4, 4],
-             color='blue', label='Memcache Counter')
-    plt.set_xlabel("Request Rate / Min")
-    plt.set_ylabel('% of requests succeeded')
-    box = plt.get_position()
-    plt.set_position([box.x0, box.y0 + box.height * 0.1, box.width,
-                      box.height * 0.9])
+  def summary_table(cls, summaries):
+    '''
+      Formats run summaries as a fixed width text table
+      Args:
+        summaries : list of (label, summary dictionary) tuples
+    '''
+    columns = ['requests', 'throughput', 'success_rate', 'mean_ms']
+    columns += ['p%d_ms' % pct for pct in PERCENTILES]
+    width = max([len(label) for label, _ in summaries] + [5])
+    lines = ['%-*s ' % (width, 'run') +
+             ' '.join('%12s' % column for column in columns)]
+    for label, summary in summaries:
+      cells = []
+      for column in columns:
+        value = summary[column]
+        cells.append('%12s' % ('-' if value is None else '%.2f' % value))
+      lines.append('%-*s ' % (width, label) + ' '.join(cells))
+    return '\n'.join(lines)
+
+  @classmethod
+  def plot_graphs(cls, runs=DEFAULT_RUNS, output_dir='.', show=False):
+    '''
+      Plots the response time and success rate curves of any number of runs.
+      The figures are saved as PDF files in output_dir. An interactive window
+      is only opened when show is True.
+      Args:
+        runs : list of (label, filename) tuples
+    '''
+    import matplotlib
+    if not show:
+      matplotlib.use('Agg')
+    import matplotlib.pyplot as mpplt
+    from matplotlib.font_manager import FontProperties
+
+    curves = [(label, cls.parse_jmeter_log(filename))
+              for label, filename in runs]
     font = FontProperties()
     font.set_size('small')
-    plt.legend(loc='upper center', bbox_to_anchor=(0.5, -0.1),
-               fancybox=True, shadow=True, ncol=5, prop=font)
-    figure.savefig('success_rate.pdf', facecolor='white', edgecolor='black')
+    charts = (
+        ('Average Response Time', 2, 'Response Time (ms)',
+         'avg_resp_time.pdf', None),
+        ('Transaction Success Rate', 1, '% of requests succeeded',
+         'success_rate.pdf', [0, 110]),
+    )
+    for title, column, ylabel, filename, ylim in charts:
+      figure = mpplt.figure()
+      plt = figure.add_subplot(1, 1, 1)
+      if ylim:
+        plt.set_ylim(ylim)
+      plt.set_title(title)
+      for i, (label, curve) in enumerate(curves):
+        plt.plot(curve[0], curve[column], label=label,
+                 **LINE_STYLES[i % len(LINE_STYLES)])
+      plt.set_xlabel('Request Rate / Min')
+      plt.set_ylabel(ylabel)
+      box = plt.get_position()
+      plt.set_position([box.x0, box.y0 + box.height * 0.1, box.width,
+                        box.height * 0.9])
+      plt.legend(loc='upper center', bbox_to_anchor=(0.5, -0.1),
+                 fancybox=True, shadow=True, ncol=5, prop=font)
+      figure.savefig(os.path.join(output_dir, filename), facecolor='white',
+                     edgecolor='black')
+    if show:
+      mpplt.show()
+
+def main(argv=None):
+  parser = argparse.ArgumentParser(description='JMeter load test analyzer')
+  parser.add_argument('runs', nargs='*', metavar='label=path.csv',
+                      help='runs to analyze (defaults to the sharded, '
+                      'unsharded and memcache logs in load_test/data)')
+  parser.add_argument('--json', action='store_true',
+                      help='print the summaries as JSON instead of a table')
+  parser.add_argument('--plot-dir', default=None,
+                      help='save response time / success rate plots here')
+  parser.add_argument('--show', action='store_true',
+                      help='open the plots in an interactive window')
+  args = parser.parse_args(sys.argv[1:] if argv is None else argv)
+
+  runs = [run.split('=', 1) for run in args.runs] or list(DEFAULT_RUNS)
+  summaries = [(label, GraphPlotter.analyze(path).summary())
+               for label, path in runs]
+  if args.json:
+    print json.dumps(dict(summaries), indent=2, sort_keys=True)
+  else:
+    print GraphPlotter.summary_table(summaries)
+  if args.plot_dir or args.show:
+    GraphPlotter.plot_graphs(runs, args.plot_dir or '.', args.show)
 
-GraphPlotter.plot_graphs()
+if __name__ == '__main__':
+  main()
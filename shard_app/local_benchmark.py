@@ -0,0 +1,345 @@
+'''
+  Local load generator for the counters. Drives IncrementOnlyCounter,
+  MemcacheCounter and DynamicCounter through the App Engine testbed stubs with
+  a configurable number of workers, key skew and read / write mix, and prints a
+  JSON report (throughput, latency percentiles, conflict and retry rates) that
+  can be diffed between versions.
+
+  Usage:
+    python -m shard_app.local_benchmark --counter sharded --workers 8 \\
+        --duration 10 --keys 100 --skew 1.2 --read-ratio 0.1
+
+  Degraded conditions are simulated with counters.FaultInjection, e.g.
+    --conflict-rate 0.1 --eviction-rate 0.01 --error-rate 0.001 --latency-ms 5
+
+  Note: In process mode every worker owns a private testbed, so workers only
+  contend with threads of the same process.
+'''
+import argparse
+import bisect
+import json
+import multiprocessing
+import random
+import sys
+import threading
+import time
+from google.appengine.ext import testbed
+from google.appengine.datastore import datastore_stub_util
+from google.appengine.ext import ndb
+from google.appengine.api import datastore_errors
+import counters
+from counters import CounterMetrics as metrics
+from counters.FaultInjection import FaultInjector
+from counters.FaultInjection import exponential
+
+COUNTER_SHARDED = 'sharded'
+COUNTER_MEMCACHE = 'memcache'
+COUNTER_DYNAMIC = 'dynamic'
+COUNTER_TYPES = (COUNTER_SHARDED, COUNTER_MEMCACHE, COUNTER_DYNAMIC)
+MODE_THREAD = 'thread'
+MODE_PROCESS = 'process'
+KEY_TEMPLATE = 'bench-{0}-{1}'
+PERCENTILES = (50, 95, 99)
+
+class BenchmarkConfig(object):
+  '''
+    All knobs of a single benchmark run
+  '''
+
+  def __init__(self, counter_type=COUNTER_SHARDED, workers=4,
+               mode=MODE_THREAD, duration=5.0, num_keys=1, skew=0.0,
+               read_ratio=0.0, num_shards=10, max_shards=20, idempotency=True,
+               consistency=1.0, seed=None, conflict_rate=0.0,
+               eviction_rate=0.0, error_rate=0.0, latency_ms=0.0):
+    if counter_type not in COUNTER_TYPES:
+      raise ValueError('Unknown counter type %r' % counter_type)
+    if mode not in (MODE_THREAD, MODE_PROCESS):
+      raise ValueError('Unknown concurrency mode %r' % mode)
+    self.counter_type = counter_type
+    self.workers = workers
+    self.mode = mode
+    self.duration = duration
+    self.num_keys = num_keys
+    self.skew = skew
+    self.read_ratio = read_ratio
+    self.num_shards = num_shards
+    self.max_shards = max_shards
+    self.idempotency = idempotency
+    self.consistency = consistency
+    self.seed = seed if seed is not None else random.randint(0, 2 ** 31)
+    self.conflict_rate = conflict_rate
+    self.eviction_rate = eviction_rate
+    self.error_rate = error_rate
+    self.latency_ms = latency_ms
+
+  def fault_injector(self, seed):
+    return FaultInjector(conflict_probability=self.conflict_rate,
+                         eviction_probability=self.eviction_rate,
+                         error_probability=self.error_rate,
+                         latency=exponential(self.latency_ms / 1000.0),
+                         seed=seed)
+
+  def to_dict(self):
+    return dict(self.__dict__)
+
+class KeyPicker(object):
+  '''
+    Picks counter names following a zipf distribution with exponent `skew`.
+    A skew of 0 picks every key with equal probability.
+  '''
+
+  def __init__(self, counter_type, num_keys, skew, rng):
+    self.rng = rng
+    self.names = [KEY_TEMPLATE.format(counter_type, i) for i in range(num_keys)]
+    self.cumulative = []
+    total = 0.0
+    for rank in range(1, num_keys + 1):
+      total += 1.0 / (rank ** skew)
+      self.cumulative.append(total)
+
+  def pick(self):
+    point = self.rng.random() * self.cumulative[-1]
+    index = bisect.bisect_left(self.cumulative, point)
+    return self.names[min(index, len(self.names) - 1)]
+
+def percentile(sorted_values, pct):
+  '''
+    Nearest rank percentile of an already sorted list. None for empty lists.
+  '''
+  if not sorted_values:
+    return None
+  rank = int(round(pct / 100.0 * (len(sorted_values) - 1)))
+  return sorted_values[rank]
+
+def activate_testbed(consistency):
+  bed = testbed.Testbed()
+  bed.activate()
+  policy = datastore_stub_util.PseudoRandomHRConsistencyPolicy(
+      probability=consistency)
+  bed.init_datastore_v3_stub(consistency_policy=policy)
+  bed.init_memcache_stub()
+  return bed
+
+def create_counters(config):
+  '''
+    Creates the counter entities used by a run. Only the sharded counter needs
+    an entity upfront, the others are created on first use.
+  '''
+  if config.counter_type != COUNTER_SHARDED:
+    return
+  picker = KeyPicker(config.counter_type, config.num_keys, 0, None)
+  counter_class = counters.load(COUNTER_SHARDED)
+  ndb.put_multi([counter_class(id=name, num_shards=config.num_shards,
+                               max_shards=config.max_shards,
+                               shards_tracked=True)
+                 for name in picker.names])
+
+def read_counter(counter_type, name):
+  # Only the benchmarked counter type is imported
+  counter_class = counters.load(counter_type)
+  if counter_type == COUNTER_SHARDED:
+    return counter_class.get(name, force_fetch=True)
+  elif counter_type == COUNTER_MEMCACHE:
+    return counter_class.get(name)
+  else:
+    return counter_class.get_value(name)
+
+def write_counter(config, name):
+  counter_class = counters.load(config.counter_type)
+  if config.counter_type == COUNTER_SHARDED:
+    counter_class.increment(name, 1, idempotency=config.idempotency)
+  else:
+    counter_class.increment(name)
+
+def run_worker(config, seed, deadline, results, index):
+  '''
+    Issues operations back to back until the deadline. Stores a tuple of
+    (read latencies, write latencies, failed writes, writes per key) in
+    results[index].
+  '''
+  ndb.get_context().set_cache_policy(False)
+  rng = random.Random(seed)
+  picker = KeyPicker(config.counter_type, config.num_keys, config.skew, rng)
+  reads, writes, failures, written = [], [], 0, {}
+  while time.time() < deadline:
+    name = picker.pick()
+    start = time.time()
+    if rng.random() < config.read_ratio:
+      read_counter(config.counter_type, name)
+      reads.append((time.time() - start) * 1000.0)
+      continue
+    try:
+      write_counter(config, name)
+    except datastore_errors.Error:
+      # Conflicts that outlived the retries, injected timeouts
+      failures += 1
+    else:
+      written[name] = written.get(name, 0) + 1
+    writes.append((time.time() - start) * 1000.0)
+  results[index] = (reads, writes, failures, written)
+
+def run_threads(config, num_threads, base_seed):
+  '''
+    Runs num_threads workers against the stubs of the current process, with
+    the configured faults injected.
+    Returns (worker results, final counter values, metric counts, fault
+    counts).
+  '''
+  sink = metrics.add_sink(metrics.InMemorySink())
+  injector = config.fault_injector(base_seed).install()
+  try:
+    deadline = time.time() + config.duration
+    results = [None] * num_threads
+    threads = []
+    for i in range(num_threads):
+      thread = threading.Thread(target=run_worker,
+                                args=(config, base_seed + i, deadline,
+                                      results, i))
+      thread.start()
+      threads.append(thread)
+    for thread in threads:
+      thread.join()
+  finally:
+    injector.uninstall()
+    metrics.remove_sink(sink)
+
+  names = set()
+  for result in results:
+    names.update(result[3])
+  if config.counter_type == COUNTER_DYNAMIC:
+    for name in names:
+      counters.load(COUNTER_DYNAMIC).minify(name)
+  final = dict((name, read_counter(config.counter_type, name))
+               for name in names)
+  return results, final, sink.snapshot()['counts'], injector.stats
+
+def _process_entry(args):
+  config, seed = args
+  bed = activate_testbed(config.consistency)
+  try:
+    create_counters(config)
+    return run_threads(config, 1, seed)
+  finally:
+    bed.deactivate()
+
+def summarize(config, elapsed, runs):
+  '''
+    Merges the output of every run_threads call into the JSON report
+  '''
+  reads, writes, failures, lost = [], [], 0, 0
+  counts = {}
+  faults = {}
+  for results, final, run_counts, run_faults in runs:
+    written = {}
+    for result in results:
+      reads.extend(result[0])
+      writes.extend(result[1])
+      failures += result[2]
+      for name, hits in result[3].iteritems():
+        written[name] = written.get(name, 0) + hits
+    for name, hits in written.iteritems():
+      lost += hits - (final.get(name) or 0)
+    for name, value in run_counts.iteritems():
+      counts[name] = counts.get(name, 0) + value
+    for name, value in run_faults.iteritems():
+      faults[name] = faults.get(name, 0) + value
+  reads.sort()
+  writes.sort()
+
+  def latency(values):
+    return dict(('p%d' % pct, percentile(values, pct)) for pct in PERCENTILES)
+
+  num_writes = len(writes)
+  conflicts = counts.get('ioc.increment.conflict', 0)
+  return {
+      'config': config.to_dict(),
+      'elapsed': elapsed,
+      'operations': len(reads) + num_writes,
+      'throughput': (len(reads) + num_writes) / elapsed if elapsed else 0.0,
+      'reads': {'count': len(reads), 'latency_ms': latency(reads)},
+      'writes': {
+          'count': num_writes,
+          'failed': failures,
+          'latency_ms': latency(writes),
+      },
+      'conflict_rate': float(conflicts) / num_writes if num_writes else 0.0,
+      'retry_rate': (float(counts.get('ioc.increment.retry', 0)) / num_writes
+                     if num_writes else 0.0),
+      'lost_increments': lost,
+      'rpc': dict((name, value) for name, value in counts.iteritems()
+                  if name.startswith('rpc.')),
+      'faults': faults,
+  }
+
+def run_benchmark(config):
+  '''
+    Runs a complete benchmark and returns the report as a dictionary
+  '''
+  start = time.time()
+  if config.mode == MODE_PROCESS:
+    pool = multiprocessing.Pool(config.workers)
+    try:
+      runs = pool.map(_process_entry, [(config, config.seed + i)
+                                       for i in range(config.workers)])
+    finally:
+      pool.close()
+      pool.join()
+  else:
+    bed = activate_testbed(config.consistency)
+    try:
+      create_counters(config)
+      runs = [run_threads(config, config.workers, config.seed)]
+    finally:
+      bed.deactivate()
+  return summarize(config, time.time() - start, runs)
+
+def parse_args(argv):
+  parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+  parser.add_argument('--counter', choices=COUNTER_TYPES,
+                      default=COUNTER_SHARDED)
+  parser.add_argument('--workers', type=int, default=4)
+  parser.add_argument('--mode', choices=(MODE_THREAD, MODE_PROCESS),
+                      default=MODE_THREAD)
+  parser.add_argument('--duration', type=float, default=5.0,
+                      help='seconds of load per run')
+  parser.add_argument('--keys', type=int, default=1,
+                      help='number of distinct counters')
+  parser.add_argument('--skew', type=float, default=0.0,
+                      help='zipf exponent of the key distribution')
+  parser.add_argument('--read-ratio', type=float, default=0.0)
+  parser.add_argument('--num-shards', type=int, default=10)
+  parser.add_argument('--max-shards', type=int, default=20)
+  parser.add_argument('--no-idempotency', action='store_true')
+  parser.add_argument('--consistency', type=float, default=1.0,
+                      help='probability of strongly consistent datastore reads')
+  parser.add_argument('--seed', type=int, default=None)
+  parser.add_argument('--conflict-rate', type=float, default=0.0,
+                      help='probability of a commit failing with a conflict')
+  parser.add_argument('--eviction-rate', type=float, default=0.0,
+                      help='probability of a memcache read evicting its keys')
+  parser.add_argument('--error-rate', type=float, default=0.0,
+                      help='probability of an RPC failing')
+  parser.add_argument('--latency-ms', type=float, default=0.0,
+                      help='mean of the exponential latency added to RPCs')
+  parser.add_argument('--output', default=None,
+                      help='write the JSON report to this file')
+  return parser.parse_args(argv)
+
+def main(argv=None):
+  args = parse_args(sys.argv[1:] if argv is None else argv)
+  config = BenchmarkConfig(
+      counter_type=args.counter, workers=args.workers, mode=args.mode,
+      duration=args.duration, num_keys=args.keys, skew=args.skew,
+      read_ratio=args.read_ratio, num_shards=args.num_shards,
+      max_shards=args.max_shards, idempotency=not args.no_idempotency,
+      consistency=args.consistency, seed=args.seed,
+      conflict_rate=args.conflict_rate, eviction_rate=args.eviction_rate,
+      error_rate=args.error_rate, latency_ms=args.latency_ms)
+  report = json.dumps(run_benchmark(config), indent=2, sort_keys=True)
+  if args.output:
+    with open(args.output, 'w') as fstream:
+      fstream.write(report)
+  print report
+
+if __name__ == '__main__':
+  main()
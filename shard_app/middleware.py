@@ -0,0 +1,41 @@
+import logging
+from django.http import HttpResponse
+from counters.CounterBatch import CounterBatch
+from counters.DynamicCounter import get_buffer
+
+class CounterBatchMiddleware(object):
+  '''
+    Runs every request inside a CounterBatch, so the counter calls of a view
+    made through it are applied with a few batched calls when the response is
+    returned. Increments of requests that raised are dropped. If the batched
+    increments fail, the response is replaced by an error. Also tells the
+    DynamicShardBuffer of the instance when requests start and finish.
+  '''
+
+  def process_request(self, request):
+    request.counter_buffer = get_buffer()
+    request.counter_buffer.request_started()
+    request.counter_batch = CounterBatch().begin()
+
+  def process_exception(self, request, exception):
+    #pylint: disable=unused-argument
+    batch = getattr(request, 'counter_batch', None)
+    if batch is not None:
+      batch.end(flush=False)
+      request.counter_batch = None
+
+  def process_response(self, request, response):
+    batch = getattr(request, 'counter_batch', None)
+    if batch is not None:
+      failed = batch.end()
+      request.counter_batch = None
+      if failed:
+        logging.error('Dropped counter increments of %s: %r', request.path,
+                      failed)
+        if response.status_code < 400:
+          response = HttpResponse("Counter increments failed", status=500)
+    counter_buffer = getattr(request, 'counter_buffer', None)
+    if counter_buffer is not None:
+      counter_buffer.request_finished()
+      request.counter_buffer = None
+    return response
@@ -1,11 +1,28 @@
+import hashlib
+import json
+import struct
+import time
 import uuid
 from django.shortcuts import render
 from django.http import HttpResponse
+from django.http import HttpResponseBadRequest
+from django.http import HttpResponseNotModified
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_POST
 from google.appengine.ext import ndb
 from google.appengine.api import datastore_errors
+from google.appengine.api import memcache
+import counters
 from counters import IncrementOnlyCounter as IOC
+from counters import MemcacheCounter as MC_MODULE
 from counters.MemcacheCounter import MemcacheCounter as MC
 from counters.DynamicCounter import DynamicCounter as DC
+from counters import CounterBackends
+from counters import DedupeCache
+from counters.CounterBatch import CounterBatch
+from counters.IncrementQueue import IncrementQueue
+from counters.RetryPolicy import CircuitBreaker
+from counters.RetryPolicy import RetryPolicy
 from models import IncrementTransaction
 
 UNSHARDED_COUNTER_KEY = 'unsharded_counter'
@@ -16,6 +33,29 @@ REQ_UNSHARDED = "0"
 REQ_SHARDED_INCREMENT = "1"
 REQ_MEMCACHE = "2"
 REQ_DYNAMIC = "3"
+DEFAULT_COUNTER_KEYS = {
+    REQ_UNSHARDED: UNSHARDED_COUNTER_KEY,
+    REQ_SHARDED_INCREMENT: SHARDED_COUNTER_KEY,
+    REQ_MEMCACHE: MEMCACHE_COUNTER_KEY,
+    REQ_DYNAMIC: DYNAMIC_COUNTER_KEY,
+}
+# Binary batch record: type, name length, request id length, delta followed by
+# the name and the request id
+BATCH_RECORD = struct.Struct('!BBBq')
+BINARY_CONTENT_TYPE = 'application/octet-stream'
+INVALID = 'invalid'
+# Sustained conflicts on the sharded counter divert increments to the queue
+SHARDED_RETRY_POLICY = RetryPolicy(breaker=CircuitBreaker(IncrementQueue()))
+MODE_QUEUE = 'queue'
+# Seconds a queue worker / audit request may spend
+QUEUE_WORKER_BUDGET = 50
+AUDIT_BUDGET = 50
+AUDIT_CURSOR_KEY = 'counter-audit-cursors'
+# Seconds for which computed counter values / status responses are cached
+STATUS_VALUE_CACHE = 30
+STATUS_RESPONSE_CACHE = 2
+STATUS_VALUE_KEY_TEMPLATE = 'status-{0}-{1}'
+STATUS_RESPONSE_KEY_TEMPLATE = 'status-multi-{0}'
 
 @ndb.transactional(xg=True)
 def increment_unsharded_counter(delta, request_id):
@@ -31,17 +71,172 @@ def increment_unsharded_counter(delta, request_id):
   trx = IncrementTransaction(id=request_id, shard_key=key)
   trx.put()
 
+@ndb.transactional(xg=True)
+def increment_unsharded_batch(entries):
+  '''
+    Batched version of increment_unsharded_counter. Entries is a list of
+    (request_id, delta) tuples small enough for a single transaction.
+    Returns: A dictionary mapping every request id to its status
+  '''
+  logs = ndb.get_multi([ndb.Key(IncrementTransaction, request_id)
+                        for request_id, _ in entries])
+  status = {}
+  pending = []
+  for (request_id, delta), log in zip(entries, logs):
+    if log is None:
+      pending.append((request_id, delta))
+    else:
+      status[request_id] = IOC.DUPLICATE
+  if pending:
+    counter = IOC.IncrementOnlyShard.get_or_insert(UNSHARDED_COUNTER_KEY)
+    counter.count += sum(delta for _, delta in pending)
+    key = counter.put()
+    ndb.put_multi([IncrementTransaction(id=request_id, shard_key=key)
+                   for request_id, _ in pending])
+    status.update((request_id, IOC.APPLIED) for request_id, _ in pending)
+  return status
+
 def unsharded_counter_value():
   return IOC.IncrementOnlyShard.get_or_insert(UNSHARDED_COUNTER_KEY).count
 
 #pylint: disable=unused-argument
 def minify_shard(request):
-  counters = IOC.IncrementOnlyCounter.query()
-  for counter in counters.iter():
-    counter.minify_shards()
+  # Finish minifies and resets that were interrupted first
+  IOC.IncrementOnlyCounter.resume_all()
+  query = IOC.IncrementOnlyCounter.query()
+  for counter in query.iter():
+    counter.minify_shards(counter.key.id())
     return HttpResponse("Successfully minified")
   return HttpResponse("No Shard to Minify")
 
+def _status_cache_key(counter_type, name):
+  '''
+    Returns the memcache key under which the value of a counter is looked up.
+    Sharded and memcache counters reuse the keys of their own get functions.
+  '''
+  if counter_type == REQ_SHARDED_INCREMENT:
+    return name
+  elif counter_type == REQ_MEMCACHE:
+    return MC._get_memcache_id(name)
+  return STATUS_VALUE_KEY_TEMPLATE.format(counter_type, name)
+
+def _status_entity_key(counter_type, name):
+  if counter_type == REQ_UNSHARDED:
+    return ndb.Key(IOC.IncrementOnlyShard, name)
+  elif counter_type == REQ_SHARDED_INCREMENT:
+    return ndb.Key(IOC.IncrementOnlyCounter, name)
+  elif counter_type == REQ_MEMCACHE:
+    return ndb.Key(MC, MC._get_memcache_id(name))
+  return ndb.Key(DC, DC._format_key(name))
+
+def fetch_counter_values(specs):
+  '''
+    Reads many counters of any type without creating missing ones. Cached
+    values are fetched with one memcache call, the remaining counters with one
+    datastore batch get (plus one more for the shards of sharded counters).
+    Args:
+      specs : list of (counter_type, name) tuples
+    Returns: A dictionary mapping every spec to its value. Missing sharded
+             counters map to None, other missing counters to 0
+  '''
+  specs = list(set(specs))
+  cache_keys = dict((spec, _status_cache_key(*spec)) for spec in specs)
+  cached = memcache.get_multi(cache_keys.values())
+  values = {}
+  misses = []
+  for spec in specs:
+    val = cached.get(cache_keys[spec])
+    if val is None:
+      misses.append(spec)
+    elif spec[0] == REQ_MEMCACHE:
+      values[spec] = val - MC_MODULE.MIDDLE_VALUE
+    else:
+      values[spec] = val
+  if not misses:
+    return values
+
+  entities = ndb.get_multi([_status_entity_key(*spec) for spec in misses])
+  sharded = []
+  for spec, entity in zip(misses, entities):
+    if spec[0] == REQ_SHARDED_INCREMENT:
+      if entity is None:
+        values[spec] = None
+      else:
+        sharded.append((spec, entity))
+    elif entity is None:
+      values[spec] = 0
+    elif spec[0] == REQ_UNSHARDED:
+      values[spec] = entity.count
+    elif spec[0] == REQ_MEMCACHE:
+      values[spec] = entity.data
+    else:
+      values[spec] = entity.count
+
+  shard_keys = [counter._get_existing_shard_keys()
+                for _, counter in sharded]
+  shards = ndb.get_multi([key for keys in shard_keys for key in keys])
+  offset = 0
+  for (spec, _), keys in zip(sharded, shard_keys):
+    values[spec] = sum(shard.count for shard in
+                       shards[offset:offset + len(keys)] if shard is not None)
+    offset += len(keys)
+
+  mc_values = {}
+  other_values = {}
+  for spec in misses:
+    if spec[0] == REQ_MEMCACHE:
+      mc_values[cache_keys[spec]] = values[spec] + MC_MODULE.MIDDLE_VALUE
+    elif values[spec] is not None:
+      other_values[cache_keys[spec]] = values[spec]
+  memcache.add_multi(mc_values)
+  memcache.add_multi(other_values, time=STATUS_VALUE_CACHE)
+  return values
+
+def parse_counter_specs(params):
+  '''
+    Parses the repeated counter=<type>:<name> query parameters. A missing name
+    selects the default counter of that type.
+    Raises: ValueError on unknown counter types
+  '''
+  specs = []
+  for value in params.getlist('counter'):
+    counter_type, _, name = value.partition(':')
+    if counter_type not in DEFAULT_COUNTER_KEYS:
+      raise ValueError('Unknown counter type %r' % counter_type)
+    specs.append((counter_type, name or DEFAULT_COUNTER_KEYS[counter_type]))
+  return specs
+
+def status_multi(request):
+  '''
+    Returns the values of the counters given as counter=<type>:<name> query
+    parameters as JSON. Responses are cached for a few seconds and carry an
+    ETag, so polling clients get a 304 until a value changes.
+  '''
+  try:
+    specs = parse_counter_specs(request.GET)
+  except ValueError:
+    return HttpResponseBadRequest("Invalid counter type")
+
+  query = '&'.join(sorted('%s:%s' % spec for spec in specs))
+  cache_key = STATUS_RESPONSE_KEY_TEMPLATE.format(
+      hashlib.md5(query.encode('utf-8')).hexdigest())
+  body = memcache.get(cache_key)
+  if body is None:
+    values = fetch_counter_values(specs)
+    body = json.dumps([{'type': counter_type, 'name': name,
+                        'value': values[(counter_type, name)]}
+                       for counter_type, name in specs])
+    memcache.add(cache_key, body, STATUS_RESPONSE_CACHE)
+
+  etag = '"%s"' % hashlib.md5(body).hexdigest()
+  if etag in request.META.get('HTTP_IF_NONE_MATCH', ''):
+    response = HttpResponseNotModified()
+  else:
+    response = HttpResponse(body, content_type='application/json')
+  response['ETag'] = etag
+  response['Cache-Control'] = 'max-age=%d' % STATUS_RESPONSE_CACHE
+  return response
+
 def status(request):
   params = request.GET
   counter_type = params.get('type', '-1')
@@ -54,7 +249,8 @@ def status(request):
       IOC.IncrementOnlyCounter.get_or_insert(SHARDED_COUNTER_KEY,
                                              max_shards=80,
                                              num_shards=40,
-                                             dynamic_growth=False)
+                                             dynamic_growth=False,
+                                             shards_tracked=True)
       val = IOC.IncrementOnlyCounter.get(SHARDED_COUNTER_KEY)
     response = HttpResponse(str(val))
   elif counter_type == REQ_MEMCACHE:
@@ -63,17 +259,21 @@ def status(request):
     response = HttpResponse(str(DC.get_value(DYNAMIC_COUNTER_KEY)))
   else:
     # Status of all counters
-    sharded_val = IOC.IncrementOnlyCounter.get(SHARDED_COUNTER_KEY)
-    if sharded_val is None:
+    specs = DEFAULT_COUNTER_KEYS.items()
+    values = fetch_counter_values(specs)
+    if values[(REQ_SHARDED_INCREMENT, SHARDED_COUNTER_KEY)] is None:
       IOC.IncrementOnlyCounter.get_or_insert(SHARDED_COUNTER_KEY,
                                              num_shards=40,
                                              max_shards=80,
-                                             dynamic_growth=False)
+                                             dynamic_growth=False,
+                                             shards_tracked=True)
+      values[(REQ_SHARDED_INCREMENT, SHARDED_COUNTER_KEY)] = 0
     response = render(request, 'status.html', {
-        'unsharded_counter' : unsharded_counter_value(),
-        'sharded_counter' : IOC.IncrementOnlyCounter.get(SHARDED_COUNTER_KEY),
-        'memcache_counter' : MC.get(MEMCACHE_COUNTER_KEY),
-        'dynamic_counter' : DC.get_value(DYNAMIC_COUNTER_KEY)
+        'unsharded_counter' : values[(REQ_UNSHARDED, UNSHARDED_COUNTER_KEY)],
+        'sharded_counter' : values[(REQ_SHARDED_INCREMENT,
+                                    SHARDED_COUNTER_KEY)],
+        'memcache_counter' : values[(REQ_MEMCACHE, MEMCACHE_COUNTER_KEY)],
+        'dynamic_counter' : values[(REQ_DYNAMIC, DYNAMIC_COUNTER_KEY)]
     })
   return response
 
@@ -99,11 +299,22 @@ def increment_counter(request):
 
   elif counter_type == REQ_SHARDED_INCREMENT:
     # Increment Sharded Counter
+    queue = IncrementQueue()
+    if params.get('mode') == MODE_QUEUE:
+      IOC.IncrementOnlyCounter.increment(SHARDED_COUNTER_KEY, delta,
+                                         queue=queue)
+      return HttpResponse("Request Queued", status=202)
+    request_id = str(uuid.uuid4())
     try:
       IOC.IncrementOnlyCounter.increment(SHARDED_COUNTER_KEY, delta,
-                                         idempotency=True)
+                                         request_id=request_id,
+                                         retry_policy=SHARDED_RETRY_POLICY)
     except datastore_errors.TransactionFailedError:
-      response = HttpResponse("Request Dropped", status=250)
+      # Hand the increment over to the queue workers instead of dropping it.
+      # It may have been committed after all, in which case the worker finds
+      # the log of its request id and skips it
+      queue.enqueue(SHARDED_COUNTER_KEY, delta, request_id)
+      response = HttpResponse("Request Queued", status=202)
     else:
       response = HttpResponse("Request Successful")
   elif counter_type == REQ_MEMCACHE:
@@ -114,13 +325,238 @@ def increment_counter(request):
     else:
       response = HttpResponse("Request Successful")
   elif counter_type == REQ_DYNAMIC:
-    DC.increment(DYNAMIC_COUNTER_KEY)
+    # Written with the other increments of the request, see CounterBatch
+    CounterBatch.add(DYNAMIC_COUNTER_KEY,
+                     counter_type=CounterBackends.DYNAMIC)
     response = HttpResponse("Request Successful")
   else:
     response = HttpResponse("Invalid parameters" + str(counter_type))
 
   return response
 
+def process_increments(request):
+  applied = IncrementQueue().process_all(
+      deadline=time.time() + QUEUE_WORKER_BUDGET)
+  return HttpResponse("Applied %d queued increments" % applied)
+
+def advance_migrations(request):
+  advanced = counters.load('migrator')().advance()
+  return HttpResponse("Advanced %d counter migrations" % advanced)
+
+def audit_counters(request):
+  '''
+    Audits memcache against datastore values. Audits stopped by the time
+    budget resume from their cursor on the next run.
+    Pass repair=1 to overwrite stale values.
+  '''
+  cursors = memcache.get(AUDIT_CURSOR_KEY) or {}
+  audit = counters.load('audit')(repair=request.GET.get('repair') == '1')
+  reports = audit.run(
+      dict((counter_type, ndb.Cursor(urlsafe=cursor))
+           for counter_type, cursor in cursors.iteritems()),
+      deadline=time.time() + AUDIT_BUDGET)
+  for report in reports:
+    if report.done or report.cursor is None:
+      cursors.pop(report.counter_type, None)
+    else:
+      cursors[report.counter_type] = report.cursor.urlsafe()
+  memcache.set(AUDIT_CURSOR_KEY, cursors)
+  return HttpResponse(json.dumps([report.summary() for report in reports]),
+                      content_type='application/json')
+
+def rebalance_bounded(request):
+  rebalanced = counters.load('bounded').rebalance_all()
+  return HttpResponse("Rebalanced %d bounded counters" % rebalanced)
+
+def merge_ring_shards(request):
+  merged = counters.load('ring').merge_all()
+  return HttpResponse("Merged %d ring shards" % merged)
+
+def purge_dedupe(request):
+  purged = counters.load('dedupe').purge()
+  return HttpResponse("Purged %d dedupe records" % purged)
+
+def snapshot_counters(request):
+  '''
+    Records the values of the demo counters in their history
+  '''
+  values = fetch_counter_values(DEFAULT_COUNTER_KEYS.items())
+  written = counters.load('history')().snapshot(
+      dict((name, value) for (_, name), value in values.iteritems()
+           if value is not None))
+  return HttpResponse("Recorded %d counter values" % written)
+
+def rollup_counters(request):
+  totals = counters.load('rollup').rollup()
+  return HttpResponse("Rolled up %d parent counters" % len(totals))
+
+def rebalance_counters(request):
+  demoted = counters.load('counter').rebalance()
+  return HttpResponse("Demoted %d cooled down counters" % len(demoted))
+
 def minify_dynamic(request):
   DC.minify(DYNAMIC_COUNTER_KEY)
   return HttpResponse("Successfully minified")
+
+def parse_batch(request):
+  '''
+    Decodes the body of a batch increment request. JSON bodies hold a list of
+    [type, name, delta, request_id] entries (or objects with these keys),
+    binary bodies a sequence of BATCH_RECORD records.
+    Returns: A list of (counter_type, name, delta, request_id) tuples
+    Raises: ValueError if the body is malformed
+  '''
+  entries = []
+  if request.META.get('CONTENT_TYPE', '').startswith(BINARY_CONTENT_TYPE):
+    body = request.body
+    offset = 0
+    while offset < len(body):
+      counter_type, name_len, id_len, delta = BATCH_RECORD.unpack_from(
+          body, offset)
+      offset += BATCH_RECORD.size
+      name = body[offset:offset + name_len]
+      request_id = body[offset + name_len:offset + name_len + id_len]
+      offset += name_len + id_len
+      if offset > len(body):
+        raise ValueError('Truncated batch record')
+      entries.append((str(counter_type), name, delta, request_id))
+  else:
+    for entry in json.loads(request.body):
+      if isinstance(entry, dict):
+        entry = [entry.get(field) for field in
+                 ('type', 'name', 'delta', 'request_id')]
+      counter_type, name, delta, request_id = entry
+      entries.append((str(counter_type), name, int(delta), request_id))
+
+  result = []
+  for counter_type, name, delta, request_id in entries:
+    name = name or DEFAULT_COUNTER_KEYS.get(counter_type)
+    result.append((counter_type, name, delta,
+                   str(request_id or uuid.uuid4())))
+  return result
+
+def batch_kind(counter_type):
+  '''
+    Returns the kind request ids of a batch entry are scoped by
+  '''
+  return {
+      REQ_UNSHARDED: IOC.IncrementOnlyShard,
+      REQ_SHARDED_INCREMENT: IOC.IncrementOnlyCounter,
+      REQ_MEMCACHE: MC,
+      REQ_DYNAMIC: DC,
+  }[counter_type]._get_kind()
+
+def claim_batch(items):
+  '''
+    Claims the request ids of memcache and dynamic counter entries, which keep
+    no logs of their own (see DedupeCache.claim)
+    Returns: The claimed items and a dictionary with the status of the others
+  '''
+  claimed = []
+  status = {}
+  for item in items:
+    request_id = item[1]
+    try:
+      if DedupeCache.DEFAULT_CACHE.claim(request_id):
+        claimed.append(item)
+      else:
+        status[request_id] = IOC.DUPLICATE
+    except datastore_errors.TransactionFailedError:
+      status[request_id] = IOC.FAILED
+  return claimed, status
+
+def apply_batch(entries):
+  '''
+    Groups the entries per counter, sums their deltas and applies every group
+    with the batched counter APIs. Request ids are scoped by counter, so the
+    same id may be used for different counters. Datastore commits of all
+    groups run concurrently, except for the unsharded counter whose chunks all
+    write the same entity and are applied one after another.
+    Returns: A list with the status of every entry, in order
+  '''
+  results = [None] * len(entries)
+  groups = {}
+  seen = set()
+  for index, (counter_type, name, delta, request_id) in enumerate(entries):
+    if counter_type not in DEFAULT_COUNTER_KEYS:
+      results[index] = INVALID
+      continue
+    request_id = DedupeCache.scoped_key(batch_kind(counter_type), name,
+                                        request_id)
+    if request_id in seen:
+      results[index] = IOC.DUPLICATE
+    else:
+      seen.add(request_id)
+      groups.setdefault((counter_type, name), []).append(
+          (index, request_id, delta))
+
+  chunked = []
+  claimed = {}
+  memcache_deltas = {}
+  dynamic_deltas = {}
+  for (counter_type, name), items in groups.iteritems():
+    pairs = [(request_id, delta) for _, request_id, delta in items]
+    if counter_type == REQ_SHARDED_INCREMENT:
+      futures = IOC.IncrementOnlyCounter.increment_batch_async(name, pairs)
+      chunked.append((items, futures))
+    elif counter_type == REQ_UNSHARDED:
+      for start in range(0, len(pairs), IOC.BATCH_CHUNK_SIZE):
+        chunk = pairs[start:start + IOC.BATCH_CHUNK_SIZE]
+        try:
+          status = increment_unsharded_batch(chunk)
+        except datastore_errors.TransactionFailedError:
+          status = dict((request_id, IOC.FAILED) for request_id, _ in chunk)
+        for position, request_id, _ in items[start:start + len(chunk)]:
+          results[position] = status[request_id]
+    else:
+      items, status = claim_batch(items)
+      for position, request_id, _ in groups[counter_type, name]:
+        results[position] = status.get(request_id)
+      if not items:
+        continue
+      claimed[counter_type, name] = items
+      deltas = (memcache_deltas if counter_type == REQ_MEMCACHE
+                else dynamic_deltas)
+      deltas[name] = sum(delta for _, _, delta in items)
+
+  dynamic_futures = DC.increment_multi_async(dynamic_deltas)
+  memcache_values = MC.increment_multi(memcache_deltas)
+
+  for items, futures in chunked:
+    for index, future in enumerate(futures):
+      chunk = items[index * IOC.BATCH_CHUNK_SIZE:
+                    (index + 1) * IOC.BATCH_CHUNK_SIZE]
+      try:
+        status = future.get_result()
+      except datastore_errors.TransactionFailedError:
+        status = dict((request_id, IOC.FAILED) for _, request_id, _ in chunk)
+      for position, request_id, _ in chunk:
+        results[position] = status[request_id]
+
+  dynamic_status = {}
+  for name, future in zip(dynamic_deltas, dynamic_futures):
+    try:
+      future.get_result()
+    except datastore_errors.Error:
+      dynamic_status[name] = IOC.FAILED
+  for (counter_type, name), items in claimed.iteritems():
+    if counter_type == REQ_MEMCACHE:
+      status = IOC.FAILED if memcache_values[name] is None else IOC.APPLIED
+    else:
+      status = dynamic_status.get(name, IOC.APPLIED)
+    for position, request_id, _ in items:
+      results[position] = status
+      if status == IOC.FAILED:
+        # Let the client retry
+        DedupeCache.DEFAULT_CACHE.release(request_id)
+  return results
+
+@csrf_exempt
+@require_POST
+def increment_batch(request):
+  try:
+    entries = parse_batch(request)
+  except (ValueError, TypeError, struct.error):
+    return HttpResponseBadRequest("Malformed batch")
+  return HttpResponse(json.dumps({'results': apply_batch(entries)}),
+                      content_type='application/json')